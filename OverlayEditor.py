@@ -2,6 +2,7 @@
 
 from glob import glob
 from math import cos, floor, sin, pi, radians, sqrt
+import atexit
 import os	# for startfile
 from os import chdir, getenv, listdir, mkdir, walk
 from os.path import abspath, basename, curdir, dirname, exists, expanduser, isdir, join, normpath, pardir, sep
@@ -17,6 +18,21 @@ if platform.lower().startswith('linux') and not getenv("DISPLAY"):
 elif platform=='darwin':
     sys.path.insert(0, join(sys.path[0], version[:3]))
 
+# Worker processes for draping airport pavements, see MyGL.drapeall. Forked now, before wx and
+# OpenGL are loaded, since forking a process that has started them isn't safe - especially on Mac.
+# Only if asked for in the preferences file, since they're kept for the whole session.
+# Not on Windows, which can't fork, so workers would re-run this file.
+pool=None
+if platform!='win32':
+    try:
+        from prefs import Prefs
+        from multiprocessing import Pool, cpu_count
+        if Prefs().options&Prefs.WORKERS and cpu_count()>1:
+            pool=Pool(min(cpu_count(), 4))	# airports rarely have enough pavement groups to use more
+            atexit.register(pool.terminate)	# even if startup fails
+    except:
+        if __debug__: print_exc()
+
 try:
     import wx
 except:
@@ -42,7 +58,7 @@ if not 'startfile' in dir(os):
 
 from clutter import round2res, minres, latlondisp, Exclude	# for loading exclusions into palette
 from clutterdef import KnownDefs, ExcludeDef, NetworkDef, previewsize
-from draw import MyGL
+from draw import MyGL, Selection
 from files import importObj, scanApt, readApt, readNav, readLib, readNet, sortfolded
 from lock import LockDialog
 from palette import Palette, PaletteEntry
@@ -376,8 +392,15 @@ class PreferencesDialog(wx.Dialog):
             self.display.SetSelection(2)
         elif prefs.options&Prefs.TERRAIN:
             self.display.SetSelection(1)
+        self.texquality = wx.RadioBox(panel2, -1, "Terrain textures", style=wx.VERTICAL,
+                                      choices=["Low", "Medium", "High"])
+        if prefs.options&Prefs.TEXHIGH:
+            self.texquality.SetSelection(2)
+        elif prefs.options&Prefs.TEXMEDIUM:
+            self.texquality.SetSelection(1)
         box2 = wx.BoxSizer()
         box2.Add(self.display, 1)
+        box2.Add(self.texquality, 0, wx.LEFT, 10)
         panel2.SetSizer(box2)
 
         self.latlon = wx.RadioBox(panel3, -1, "Latitude && Longitude", style=wx.VERTICAL,
@@ -1587,7 +1610,7 @@ class MainWindow(wx.Frame):
         dlg.CenterOnParent()	# Otherwise is top-left on Mac
         if dlg.ShowModal()==wx.ID_OK:
             # apply to currently selected
-            self.canvas.selected=[x for x in self.canvas.selected if not x.definition.type & self.canvas.locked]
+            self.canvas.selected=Selection([x for x in self.canvas.selected if not x.definition.type & self.canvas.locked])
             self.canvas.Refresh()
             self.ShowSel()
 
@@ -1598,6 +1621,7 @@ class MainWindow(wx.Frame):
         if x!=wx.ID_OK:
             if x: dlg.Destroy()
             return
+        hidden=prefs.options&(Prefs.PICKCOLOUR|Prefs.WORKERS)	# not in the dialog - only set in the preferences file
         if dlg.display.GetSelection()==3:
             prefs.options=Prefs.TERRAIN|Prefs.ELEVATION|Prefs.NETWORK
         elif dlg.display.GetSelection()==2:
@@ -1608,6 +1632,11 @@ class MainWindow(wx.Frame):
             prefs.options=0
         if dlg.latlon.GetSelection():
             prefs.options|=Prefs.DMS
+        if dlg.texquality.GetSelection()==2:
+            prefs.options|=Prefs.TEXHIGH
+        elif dlg.texquality.GetSelection()==1:
+            prefs.options|=Prefs.TEXMEDIUM
+        prefs.options|=hidden
         if dlg.path.GetValue()!=prefs.xplane:
             # Make untitled
             prefs.xplane=dlg.path.GetValue()
@@ -1730,6 +1759,7 @@ if platform=='win32':
 
 frame=MainWindow(None, wx.ID_ANY, appname)
 app.SetTopWindow(frame)
+frame.canvas.pool=pool
 
 # user prefs
 prefs=Prefs()
@@ -1777,7 +1807,10 @@ if False:	# XXX trace
           ignoremods=['codecs','fnmatch','glob','posixpath','_core']
           ).runfunc(app.MainLoop)
 else:
-    app.MainLoop()
+    try:
+        app.MainLoop()
+    finally:
+        if pool: pool.terminate()
 
 # Save prefs
 prefs.write()
@@ -45,6 +45,7 @@ from math import atan2, ceil, cos, floor, hypot, pi, radians, sin
 from OpenGL.GL import *
 from OpenGL.GLU import *
 from sys import maxint
+from numpy import arange, array, concatenate, cumsum, empty, hypot as hypots, newaxis, repeat, tile as repeatarray, zeros, float32, float64
 if __debug__:
     from traceback import print_exc
 
@@ -56,6 +57,7 @@ except NameError:
     gluTessVertex = GLU._gluTessVertex
 
 from clutterdef import ObjectDef, PolygonDef, DrapedDef, ExcludeDef, FacadeDef, ForestDef, LineDef, NetworkDef, NetworkFallback, ObjectFallback, DrapedFallback, FacadeFallback, ForestFallback, LineFallback, SkipDefs, BBox
+from geometry import interpolate, simple
 from palette import PaletteEntry
 from prefs import Prefs
 
@@ -95,6 +97,8 @@ def PolygonFactory(name, param, nodes, lon=None, size=None, hdg=None):
 
 class Clutter:
 
+    layoutattrs=()	# attributes set by layout(), see layoutstate()
+
     def __init__(self, name, lat=None, lon=None):
         self.name=name		# virtual name
         self.definition=None
@@ -107,9 +111,31 @@ class Clutter:
         return ((lon-tile[1]-0.5)*onedeg*cos(radians(lat)),
                 (0.5-(lat-tile[0]))*onedeg)
 
+    def allocate(self, vertexcache):
+        pass	# most placements just use their definition's geometry
+
+    def flush(self):
+        pass
+
+    def layoutkey(self):
+        # hashable identity of the inputs to layout() other than tile, options and terrain.
+        # None if layout() shouldn't be memoised
+        return None
+
+    def layoutstate(self):
+        # snapshot of the results of layout(), for restorelayout()
+        return tuple([getattr(self, attr) for attr in self.layoutattrs])
+
+    def restorelayout(self, state):
+        # equivalent to layout() with the same layoutkey(), tile, options and terrain as state
+        for (attr, value) in zip(self.layoutattrs, state):
+            setattr(self, attr, value)
+
 
 class Object(Clutter):
 
+    layoutattrs=('x', 'y', 'z')
+
     def __init__(self, name, lat, lon, hdg, y=None):
         Clutter.__init__(self, name, lat, lon)
         self.hdg=hdg
@@ -184,16 +210,30 @@ class Object(Clutter):
     def drawnodes(self, selectednode):
         pass
 
+    def pickdata(self):
+        # world space (triangles, line segments) that draw() would render when picking
+        obj=self.definition
+        return (batchobjects(obj, [self], obj.culled+obj.nocull)[0].reshape(-1,3,3), empty((0,2,3), float64))
+
     def clearlayout(self):
         self.x=self.y=self.z=None
 
     def islaidout(self):
         return self.x!=None
 
+    def layoutkey(self):
+        return (self.lat, self.lon)
+
     def layout(self, tile, options, vertexcache):
         (self.x,self.z)=self.position(tile, self.lat, self.lon)
         self.y=vertexcache.height(tile,options,self.x,self.z)
 
+    def extent(self):
+        # conservative world space bounds (minx, maxx, miny, maxy, minz, maxz), allowing for any heading
+        bbox=self.definition.bbox
+        r=max(hypot(bbox.minx, bbox.minz), hypot(bbox.minx, bbox.maxz), hypot(bbox.maxx, bbox.minz), hypot(bbox.maxx, bbox.maxz))
+        return (self.x-r, self.x+r, self.y, self.y+self.definition.height, self.z-r, self.z+r)
+
     def move(self, dlat, dlon, dhdg, dparam, loc, tile, options, vertexcache):
         self.lat=max(tile[0], min(tile[0]+maxres, self.lat+dlat))
         self.lon=max(tile[1], min(tile[1]+maxres, self.lon+dlon))
@@ -208,6 +248,8 @@ class Object(Clutter):
 
 class Polygon(Clutter):
 
+    layoutattrs=('lat', 'lon', 'nonsimple')
+
     def __init__(self, name, param, nodes, lon=None, size=None, hdg=None):
         if param==None: param=0
         if lon==None:
@@ -225,6 +267,8 @@ class Polygon(Clutter):
         self.param=param
         self.points=[]		# list of windings in world space (x,y,z)
         self.nonsimple=False
+        self.base=None		# start of outline in vertexcache
+        self.capacity=0		# number of vertices allocated at base
 
     def __str__(self):
         return '<"%s" %d %s>' % (self.name,self.param,self.points)
@@ -272,11 +316,10 @@ class Polygon(Clutter):
                 else:
                     glColor3f(*col)
         glDisable(GL_DEPTH_TEST)
+        base=self.base
         for winding in self.points:
-            glBegin(GL_LINE_LOOP)
-            for p in winding:
-                glVertex3f(p[0],p[1],p[2])
-            glEnd()
+            glDrawArrays(GL_LINE_LOOP, base, len(winding))
+            base+=len(winding)
         glEnable(GL_DEPTH_TEST)
         if not selected and not picking:
             glColor3f(0.8, 0.8, 0.8)	# restore
@@ -285,25 +328,87 @@ class Polygon(Clutter):
         Polygon.draw(self, True, False)	# draw lines
         glBindTexture(GL_TEXTURE_2D, 0)
         glDisable(GL_DEPTH_TEST)
-        glBegin(GL_POINTS)
-        for i in range(len(self.points)):
-            for j in range(len(self.points[i])):
-                if selectednode==(i,j):
-                    glColor3f(1.0, 1.0, 1.0)
-                else:
-                    glColor3f(1.0, 0.5, 1.0)
-                glVertex3f(*self.points[i][j])
-        glEnd()
+        glColor3f(1.0, 0.5, 1.0)
+        glDrawArrays(GL_POINTS, self.base, self.nodeindex((len(self.points),0)))
+        if selectednode:
+            glColor3f(1.0, 1.0, 1.0)
+            glDrawArrays(GL_POINTS, self.base+self.nodeindex(selectednode), 1)
         glEnable(GL_DEPTH_TEST)        
         
+    def pickdata(self):
+        # world space (triangles, line segments) that draw() would render when picking
+        return (empty((0,3,3), float64), self.outline())
+
+    def visiblenodes(self):
+        # nodes (i,j) that drawnodes() draws, and so that can be picked
+        return [(i,j) for i in range(len(self.points)) for j in range(len(self.points[i]))]
+
+    def outline(self):
+        # line segments around each winding
+        segs=[]
+        for winding in self.points:
+            n=len(winding)
+            segs.extend([(winding[j], winding[(j+1)%n]) for j in range(n)])
+        return array(segs, float64).reshape(-1,2,3)
+
+    def nodeindex(self, node):
+        # offset of node's point from base
+        (i,j)=node
+        for winding in self.points[:i]:
+            j+=len(winding)
+        return j
+
+    def vertices(self):
+        # geometry to allocate into vertexcache - just the windings' outlines
+        vdata=[p for winding in self.points for p in winding]
+        return (vdata, [(0,0)]*len(vdata))
+
+    def allocate(self, vertexcache):
+        # (re)allocate geometry into vertexcache, overwriting the previous allocation if there's room
+        (vdata, tdata)=self.vertices()
+        if self.base!=None and len(vdata)<=self.capacity:
+            vertexcache.update(self.base, vdata, tdata)
+        else:
+            self.base=vertexcache.allocate(vdata, tdata)
+            self.capacity=len(vdata)
+
+    def flush(self):
+        self.base=None
+        self.capacity=0
+
     def clearlayout(self):
         self.points=[]
 
     def islaidout(self):
         return self.points and True
 
+    def layoutkey(self):
+        return (self.definition.filename, self.definition.mtime, self.param,
+                tuple([tuple([tuple(node) for node in winding]) for winding in self.nodes]))
+
+    def layoutstate(self):
+        # windings are changed in place by updatenode, so keep a copy
+        return (Clutter.layoutstate(self), [list(winding) for winding in self.points])
+
+    def restorelayout(self, state):
+        Clutter.restorelayout(self, state[0])
+        self.points=[list(winding) for winding in state[1]]
+
+    def extent(self):
+        # world space bounds (minx, maxx, miny, maxy, minz, maxz)
+        minx=miny=minz=maxint
+        maxx=maxy=maxz=-maxint
+        for winding in self.points:
+            for p in winding:
+                minx=min(minx,p[0])
+                maxx=max(maxx,p[0])
+                miny=min(miny,p[1])
+                maxy=max(maxy,p[1])
+                minz=min(minz,p[2])
+                maxz=max(maxz,p[2])
+        return (minx, maxx, miny, maxy, minz, maxz)
+
     def layout(self, tile, options, vertexcache, selectednode=None):
-        global tess
         self.lat=self.lon=0
         self.points=[]
         self.nonsimple=False
@@ -331,24 +436,13 @@ class Polygon(Clutter):
         self.lat=self.lat/len(self.nodes[0])
         self.lon=self.lon/len(self.nodes[0])
 
+        if not isinstance(self, Facade):
+            self.allocate(vertexcache)	# Facade allocates once it has laid out its walls
+
         if isinstance(self, Draped):
             return selectednode	# Draped does its own tesselation
 
-        # tessellate. This is just to check polygon is simple
-        try:
-            tris=[]
-            gluTessBeginPolygon(tess, tris)
-            for i in range(len(self.nodes)):
-                gluTessBeginContour(tess)
-                for j in range(len(self.nodes[i])):
-                    gluTessVertex(tess, [self.points[i][j][0], 0, self.points[i][j][2]], (self.points[i][j], False, None))
-                gluTessEndContour(tess)
-            gluTessEndPolygon(tess)
-            if not tris:
-                if __debug__: print "Polygon layout failed"
-                self.nonsimple=True
-        except:
-            # Combine required -> not simple
+        if not simple(self.points):
             if __debug__: print "Polygon layout failed"
             self.nonsimple=True
         
@@ -426,16 +520,9 @@ class Polygon(Clutter):
         (x,z)=self.position(tile, lat, lon)
         y=vertexcache.height(tile,options,x,z)
         self.points[i][j]=(x,y,z)
+        vertexcache.update(self.base+self.nodeindex(node), [self.points[i][j]], [(0,0)])
         return node
 
-    def picknodes(self):
-        for i in range(len(self.points)):
-            for j in range(len(self.points[i])):
-                glLoadName((i<<24)+j)
-                glBegin(GL_POINTS)
-                glVertex3f(*self.points[i][j])
-                glEnd()
-
 
 class Beach(Polygon):
     # Editing would zap extra vertex parameters that we don't understand,
@@ -452,9 +539,14 @@ class Beach(Polygon):
         # Don't draw selected so can't be picked
         if not picking: Polygon.draw(self, selected, picking)
 
+    def pickdata(self):
+        return (empty((0,3,3), float64), empty((0,2,3), float64))
+
 
 class Draped(Polygon):
 
+    layoutattrs=Polygon.layoutattrs+('tris',)
+
     def __init__(self, name, param, nodes, lon=None, size=None, hdg=None):
         Polygon.__init__(self, name, param, nodes, lon, size, hdg)
         self.tris=[]	# tesellated tris
@@ -516,6 +608,11 @@ class Draped(Polygon):
             glDepthMask(GL_TRUE)
             glDisable(GL_POLYGON_OFFSET_FILL)
         
+    def pickdata(self):
+        if self.nonsimple:
+            return Polygon.pickdata(self)
+        return (array([t[0] for t in self.tris], float64).reshape(-1,3,3), self.outline())
+
     def move(self, dlat, dlon, dhdg, dparam, loc, tile, options, vertexcache):
         if self.param==65535:
             n=len(self.nodes[0])
@@ -600,6 +697,7 @@ class Draped(Polygon):
             (x,z)=self.position(tile, lat, lon)
             y=vertexcache.height(tile,options,x,z)
             self.points[i][j]=(x,y,z)
+            vertexcache.update(self.base+self.nodeindex(node), [self.points[i][j]], [(0,0)])
             return node
         else:
             return Polygon.updatenode(self, node, lat, lon, tile, options, vertexcache)
@@ -671,55 +769,18 @@ class Draped(Polygon):
             gluTessEndContour(csgt)
         abox=BBox(minx, maxx, minz, maxz)
 
-        for (bbox, meshtris) in vertexcache.getMeshdata(tile,options):
-            if not abox.intersects(bbox): continue
-            for meshtri in meshtris:
-                (meshpt, coeffs)=meshtri
-                # tesselator is expensive - minimise mesh triangles
-                tbox=BBox()
-                for m in range(3):
-                    tbox.include(meshpt[m][0], meshpt[m][2])
-                if not abox.intersects(tbox):
-                    continue
-                gluTessBeginContour(csgt)
-                for m in range(3):
-                    x=meshpt[m][0]
-                    z=meshpt[m][2]
-                    # check if mesh point is inside a polygon triangle
-                    # in which case calculate a uv position
-                    # http://astronomy.swin.edu.au/~pbourke/geometry/insidepoly
-                    for t in range(0,len(tris),3):
-                        inside=False
-                        ptj=tris[t+2][0]
-                        for i in range(t,t+3):
-                            pti=tris[i][0]
-                            if z==pti[2]==ptj[2] and x <= max(pti[0],ptj[0]) and x >= min(pti[0],ptj[0]):
-                                inside = True	# on the line
-                                break
-                            elif (((pti[2] <= z and z < ptj[2]) or
-                                   (ptj[2] <= z and z < pti[2])) and
-                                  (x < (ptj[0]-pti[0]) * (z - pti[2]) / (ptj[2] - pti[2]) + pti[0])):
-                                inside = not inside
-                            ptj=pti
-                        if inside:	# inside polygon triange tris[t:t+3]
-                            x0=tris[t][0][0]
-                            z0=tris[t][0][2]
-                            x1=tris[t+1][0][0]-x0
-                            z1=tris[t+1][0][2]-z0
-                            x2=tris[t+2][0][0]-x0
-                            z2=tris[t+2][0][2]-z0
-                            xp=x-x0
-                            zp=z-z0
-                            a=(xp*z2-x2*zp)/(x1*z2-x2*z1)
-                            b=(xp*z1-x1*zp)/(x2*z1-x1*z2)
-                            uv=(tris[t][2][0]+a*(tris[t+1][2][0]-tris[t][2][0])+b*(tris[t+2][2][0]-tris[t][2][0]),
-                                tris[t][2][1]+a*(tris[t+1][2][1]-tris[t][2][1])+b*(tris[t+2][2][1]-tris[t][2][1]))
-                            break
-                    else:
-                        # Provide something in case tessellation screws up
-                        uv=(0,0)
-                    gluTessVertex(csgt, [x,0,z], (meshpt[m],True, uv))
-                gluTessEndContour(csgt)
+        # tesselator is expensive - minimise mesh triangles
+        meshtris=vertexcache.getMeshdata(tile,options).overlapping(abox)
+        # uv position of each mesh point that's inside a polygon triangle
+        uvs=interpolate(array([t[0] for t in tris], float64)[:,[0,2]].reshape(-1,3,2),
+                        array([t[2] for t in tris], float64).reshape(-1,3,2),
+                        meshtris[:,:,0].ravel(), meshtris[:,:,2].ravel()).reshape(-1,3,2)
+        for (meshpt, meshuv) in zip(meshtris.tolist(), uvs.tolist()):
+            gluTessBeginContour(csgt)
+            for m in range(3):
+                # (0,0) for points outside the polygon, in case tessellation screws up
+                gluTessVertex(csgt, [meshpt[m][0],0,meshpt[m][2]], (meshpt[m], True, tuple(meshuv[m])))
+            gluTessEndContour(csgt)
 
         gluTessEndPolygon(csgt)
         return selectednode
@@ -783,6 +844,8 @@ class Exclude(Polygon):
                                       (max(floor(self.lat), min(floor(self.lat)+1, round2res(lat))))))
         self.param=param
         self.points=[]		# list of windings in world space (x,y,z)
+        self.base=None		# start of outline in vertexcache
+        self.capacity=0		# number of vertices allocated at base
 
     def clone(self):
         return Exclude(self.name, self.param, [list(w) for w in self.nodes])
@@ -834,9 +897,11 @@ class Exclude(Polygon):
 
 class Facade(Polygon):
 
+    layoutattrs=Polygon.layoutattrs+('quads', 'roof')
+
     def __init__(self, name, param, nodes, lon=None, size=None, hdg=None):
         Polygon.__init__(self, name, param, nodes, lon, size, hdg)
-        self.quads=[]		# list of points (x,y,z,s,t)
+        self.quads=empty((0,5), float64)	# N x 5 array of points (x,y,z,s,t)
         self.roof=[]		# list of points (x,y,z,s,t)
 
     def clone(self):
@@ -876,9 +941,13 @@ class Facade(Polygon):
         else:
             return '%s  Height: %-3d  (%d nodes)' % (latlondisp(dms, self.lat, self.lon), self.param, len(self.nodes[0]))
 
+    def extent(self):
+        (minx, maxx, miny, maxy, minz, maxz)=Polygon.extent(self)
+        return (minx, maxx, miny, maxy+self.param, minz, maxz)	# walls and roof
+
     def draw(self, selected, picking):
         fac=self.definition
-        if self.nonsimple or (not self.quads and not self.roof):
+        if self.nonsimple or (not len(self.quads) and not self.roof):
             Polygon.draw(self, selected, picking)
             return
         elif picking:
@@ -887,20 +956,23 @@ class Facade(Polygon):
             glBindTexture(GL_TEXTURE_2D, fac.texture)
             if fac.two_sided:
                 glDisable(GL_CULL_FACE)
-        if self.quads:
-            glBegin(GL_QUADS)
-            for p in self.quads:
-                glTexCoord2f(p[3],p[4])
-                glVertex3f(p[0],p[1],p[2])
-            glEnd()
+        base=self.base+self.nodeindex((len(self.points),0))	# walls follow outline
+        if len(self.quads):
+            glDrawArrays(GL_QUADS, base, len(self.quads))
         if self.roof:
-            glBegin(GL_TRIANGLE_FAN)	# Better for concave
-            for p in self.roof+[self.roof[1]]:
-                glTexCoord2f(p[3],p[4])
-                glVertex3f(p[0],p[1],p[2])
-            glEnd()
+            glDrawArrays(GL_TRIANGLE_FAN, base+len(self.quads), len(self.roof)+1)	# Better for concave
         if not picking and fac.two_sided:
             glEnable(GL_CULL_FACE)
+
+    def pickdata(self):
+        if self.nonsimple or (not len(self.quads) and not self.roof):
+            return Polygon.pickdata(self)
+        q=self.quads[:,:3].reshape(-1,4,3)
+        tris=[q[:,[0,1,2]], q[:,[0,2,3]]]
+        if self.roof:
+            roof=[p[:3] for p in self.roof+[self.roof[1]]]
+            tris.append(array([(roof[0], roof[i], roof[i+1]) for i in range(1, len(roof)-1)], float64).reshape(-1,3,3))
+        return (concatenate(tris), self.outline())
         
     def move(self, dlat, dlon, dhdg, dparam, loc, tile, options, vertexcache):
         dparam=max(dparam, 1-self.param)	# can't have height 0
@@ -908,7 +980,7 @@ class Facade(Polygon):
         
     def layout(self, tile, options, vertexcache, selectednode=None):
         selectednode=Polygon.layout(self, tile, options, vertexcache, selectednode)
-        self.quads=[]
+        self.quads=empty((0,5), float64)
         self.roof=[]
         try:
             self.layoutquads(tile, options, vertexcache)
@@ -917,9 +989,20 @@ class Facade(Polygon):
             if __debug__:
                 print "Facade layout failed:"
                 print_exc()
-            self.quads=[]
+            self.quads=empty((0,5), float64)
             self.roof=[]
+        self.allocate(vertexcache)
         return selectednode
+
+    def vertices(self):
+        # outline, then walls, then roof
+        (vdata, tdata)=Polygon.vertices(self)
+        if self.roof:
+            roof=array(self.roof+[self.roof[1]], float64)
+        else:
+            roof=empty((0,5), float64)
+        return (concatenate([array(vdata, float64).reshape(-1,3), self.quads[:,:3], roof[:,:3]]),
+                concatenate([array(tdata, float64).reshape(-1,2), self.quads[:,3:], roof[:,3:]]))
         
     # Helper for layout
     def subdiv(self, size, scale, divs, ends, isvert):
@@ -964,21 +1047,40 @@ class Facade(Polygon):
             return (points,size/cumsize)
 
 
+    # Helper for layout
+    def strip(self, size, isvert):
+        # subdiv() of a wall of this size as arrays of texture coords (k x 2) and cumulative
+        # distance along the wall (k+1). Cached per definition since walls repeat a lot.
+        fac=self.definition
+        key=(size, isvert)
+        if key in fac.subdivs:
+            value=fac.subdivs.pop(key)	# move to most recently used
+            fac.subdivs[key]=value
+            return value
+        if isvert:
+            (divs, points)=(fac.vert, self.subdiv(size, fac.vscale, fac.vert, fac.vends, True)[0])
+            scale=fac.vscale	# not scaled to fit
+        else:
+            (divs, (points, scale))=(fac.horiz, self.subdiv(size, fac.hscale, fac.horiz, fac.hends, False))
+        st=array([divs[i] for i in points], float64).reshape(-1,2)
+        cum=zeros(len(st)+1, float64)
+        cumsum(scale*(st[:,1]-st[:,0]), out=cum[1:])
+        if len(fac.subdivs)>=4096: fac.subdivs.popitem(False)	# drop least recently used
+        fac.subdivs[key]=(st, cum)
+        return (st, cum)
+
     # Helper for layout
     def layoutquads(self, tile, options, vertexcache):
         fac=self.definition
         points=self.points[0]
         n=len(points)
 
-        (vert,vscale)=self.subdiv(self.param, fac.vscale, fac.vert,fac.vends, True)
-        roofheight=0
-        for i in range(len(vert)):
-            roofheight+=(fac.vert[vert[i]][1]-fac.vert[vert[i]][0])
-        roofheight*=fac.vscale	# not scaled to fit
+        (vst,vcum)=self.strip(self.param, True)
+        roofheight=(vst[:,1]-vst[:,0]).sum()*fac.vscale	# not scaled to fit
         
         if fac.roof_slope:
             roofpts=[]
-            dist=sin(radians(fac.roof_slope))*fac.vscale*(fac.vert[vert[-1]][1]-fac.vert[vert[-1]][0])
+            dist=sin(radians(fac.roof_slope))*fac.vscale*(vst[-1,1]-vst[-1,0])
             for i in range(n):
                 if i==n-1 and not fac.ring:
                     tonext=(points[i][0]-points[i-1][0],
@@ -1007,71 +1109,47 @@ class Facade(Polygon):
         else:
             roofpts=[(points[i][0], points[i][1]+roofheight, points[i][2]) for i in range(n)]
 
-        for wall in range(n-1+fac.ring):
-            size=hypot(points[(wall+1)%n][0]-points[wall][0],
-                       points[(wall+1)%n][2]-points[wall][2])
-            if size==0: continue
-            h=((points[(wall+1)%n][0]-points[wall][0])/size,
-               (points[(wall+1)%n][1]-points[wall][1])/size,
-               (points[(wall+1)%n][2]-points[wall][2])/size)
-            r=((roofpts[(wall+1)%n][0]-roofpts[wall][0])/size,
-               (roofpts[(wall+1)%n][1]-roofpts[wall][1])/size,
-               (roofpts[(wall+1)%n][2]-roofpts[wall][2])/size)
-            (horiz,hscale)=self.subdiv(size, fac.hscale, fac.horiz, fac.hends,False)
-            cumheight=0
-            for i in range(len(vert)-1):
-                heightinc=fac.vscale*(fac.vert[vert[i]][1]-fac.vert[vert[i]][0])
-                cumwidth=0
-                for j in range(len(horiz)):
-                    widthinc=hscale*(fac.horiz[horiz[j]][1]-fac.horiz[horiz[j]][0])
-                    self.quads.append((points[wall][0]+h[0]*cumwidth,
-                                       points[wall][1]+h[1]*cumwidth+cumheight,
-                                       points[wall][2]+h[2]*cumwidth,
-                                       fac.horiz[horiz[j]][0],
-                                       fac.vert[vert[i]][0]))
-                    self.quads.append((points[wall][0]+h[0]*cumwidth,
-                                       points[wall][1]+h[1]*cumwidth+cumheight+heightinc,
-                                       points[wall][2]+h[2]*cumwidth,
-                                       fac.horiz[horiz[j]][0],
-                                       fac.vert[vert[i]][1]))
-                    self.quads.append((points[wall][0]+h[0]*(cumwidth+widthinc),
-                                       points[wall][1]+h[1]*(cumwidth+widthinc)+cumheight+heightinc,
-                                       points[wall][2]+h[2]*(cumwidth+widthinc),
-                                       fac.horiz[horiz[j]][1],
-                                       fac.vert[vert[i]][1]))
-                    self.quads.append((points[wall][0]+h[0]*(cumwidth+widthinc),
-                                       points[wall][1]+h[1]*(cumwidth+widthinc)+cumheight,
-                                       points[wall][2]+h[2]*(cumwidth+widthinc),
-                                       fac.horiz[horiz[j]][1],
-                                       fac.vert[vert[i]][0]))
-                    cumwidth+=widthinc
-                cumheight+=heightinc
+        # walls. Each has a grid of quads: rows from vertical subdivision, plus a penthouse row
+        # up to the roof, by columns from the wall's horizontal subdivision.
+        pts=array(points, float64)
+        roofs=array(roofpts, float64)
+        walls=arange(n-1+fac.ring)
+        d=pts[(walls+1)%n]-pts[walls]
+        size=hypots(d[:,0], d[:,2])
+        walls=walls[size!=0]
+        if len(vst) and len(walls):
+            (d, size)=(d[size!=0], size[size!=0])
+            h=d/size[:,newaxis]
+            r=(roofs[(walls+1)%n]-roofs[walls])/size[:,newaxis]
+            (sts, cums)=zip(*[self.strip(x, False) for x in size.tolist()])
+            wall=repeat(arange(len(walls)), [len(x) for x in sts])	# of each column
+            st=concatenate(sts)
+            cw0=concatenate([x[:-1] for x in cums])[:,newaxis]
+            cw1=concatenate([x[1:] for x in cums])[:,newaxis]
+            (base0, base1)=(pts[walls][wall]+h[wall]*cw0, pts[walls][wall]+h[wall]*cw1)
+            nrows=len(vst)-1
+            quads=empty((nrows+1, len(st), 4, 5), float64)
+            body=quads[:nrows]
+            body[:,:,0,:3]=body[:,:,1,:3]=base0
+            body[:,:,2,:3]=body[:,:,3,:3]=base1
+            body[:,:,[0,3],1]+=vcum[:nrows,newaxis,newaxis]
+            body[:,:,[1,2],1]+=vcum[1:nrows+1,newaxis,newaxis]
+            body[:,:,[0,1],3]=st[:,[0]]
+            body[:,:,[2,3],3]=st[:,[1]]
+            body[:,:,[0,3],4]=vst[:nrows,0,newaxis,newaxis]
+            body[:,:,[1,2],4]=vst[:nrows,1,newaxis,newaxis]
             # penthouse
-            cumwidth=0
-            for j in range(len(horiz)):
-                if not len(vert): continue
-                widthinc=hscale*(fac.horiz[horiz[j]][1]-fac.horiz[horiz[j]][0])
-                self.quads.append((points[wall][0]+h[0]*cumwidth,
-                                   points[wall][1]+h[1]*cumwidth+cumheight,
-                                   points[wall][2]+h[2]*cumwidth,
-                                   fac.horiz[horiz[j]][0],
-                                   fac.vert[vert[-1]][0]))
-                self.quads.append((roofpts[wall][0]+r[0]*cumwidth,
-                                   roofpts[wall][1]+r[1]*cumwidth,
-                                   roofpts[wall][2]+r[2]*cumwidth,
-                                   fac.horiz[horiz[j]][0],
-                                   fac.vert[vert[-1]][1]))
-                self.quads.append((roofpts[wall][0]+r[0]*(cumwidth+widthinc),
-                                   roofpts[wall][1]+r[1]*(cumwidth+widthinc),
-                                   roofpts[wall][2]+r[2]*(cumwidth+widthinc),
-                                   fac.horiz[horiz[j]][1],
-                                   fac.vert[vert[-1]][1]))
-                self.quads.append((points[wall][0]+h[0]*(cumwidth+widthinc),
-                                   points[wall][1]+h[1]*(cumwidth+widthinc)+cumheight,
-                                   points[wall][2]+h[2]*(cumwidth+widthinc),
-                                   fac.horiz[horiz[j]][1],
-                                   fac.vert[vert[-1]][0]))
-                cumwidth+=widthinc
+            pent=quads[nrows]
+            pent[:,0,:3]=base0
+            pent[:,1,:3]=roofs[walls][wall]+r[wall]*cw0
+            pent[:,2,:3]=roofs[walls][wall]+r[wall]*cw1
+            pent[:,3,:3]=base1
+            pent[:,[0,3],1]+=vcum[nrows]
+            pent[:,[0,1],3]=st[:,[0]]
+            pent[:,[2,3],3]=st[:,[1]]
+            pent[:,[0,3],4]=vst[nrows,0]
+            pent[:,[1,2],4]=vst[nrows,1]
+            self.quads=quads.reshape(-1,5)
 
         # roof
         if n<=2 or not fac.ring or not fac.roof: return
@@ -1256,6 +1334,8 @@ class Network(Polygon):
                 self.nodes[0].append((max(floor(lon), min(floor(lon)+1, round2res(self.lon+sin(i)*size))),
                                       (max(floor(lat), min(floor(lat)+1, round2res(self.lat+cos(i)*size))))))
         self.laidoutwithelevation=False
+        self.base=None		# start of points in vertexcache
+        self.capacity=0		# number of vertices allocated at base
             
     def __str__(self):
         return '<"%s" %d %s>' % (self.name,self.index,self.nodes)
@@ -1317,26 +1397,37 @@ class Network(Polygon):
             glBindTexture(GL_TEXTURE_2D, 0)
             if not selected: glColor3f(*self.definition.color)
         glDisable(GL_DEPTH_TEST)
-        glBegin(GL_LINE_STRIP)
-        for p in self.points[0]:
-            glVertex3f(p[0],p[1],p[2])
-        glEnd()
+        glDrawArrays(GL_LINE_STRIP, self.base, len(self.points[0]))
         glEnable(GL_DEPTH_TEST)
         if not (selected or picking):
             glColor3f(0.8, 0.8, 0.8)	# restore
 
+    def pickdata(self):
+        # XXX disable networks
+        return (empty((0,3,3), float64), empty((0,2,3), float64))
+
+    def visiblenodes(self):
+        return [(0,j) for j in range(len(self.points[0])) if self.nodes[0][j][3]]	# iscontrolnode
+
     def drawnodes(self, selectednode):
         glBindTexture(GL_TEXTURE_2D, 0)
         glDisable(GL_DEPTH_TEST)
-        glBegin(GL_POINTS)
-        for j in range(len(self.points[0])):
-            if self.nodes[0][j][3]:	# iscontrolnode
-                if selectednode==(0,j):
-                    glColor3f(1.0, 1.0, 1.0)
-                else:
-                    glColor3f(1.0, 0.5, 1.0)
-                glVertex3f(*self.points[0][j])
-        glEnd()
+        glColor3f(1.0, 0.5, 1.0)
+        # runs of control nodes
+        nodes=self.nodes[0]
+        n=len(self.points[0])
+        j=0
+        while j<n:
+            if nodes[j][3]:	# iscontrolnode
+                k=j+1
+                while k<n and nodes[k][3]: k+=1
+                glDrawArrays(GL_POINTS, self.base+j, k-j)
+                j=k
+            else:
+                j+=1
+        if selectednode and nodes[selectednode[1]][3]:
+            glColor3f(1.0, 1.0, 1.0)
+            glDrawArrays(GL_POINTS, self.base+selectednode[1], 1)
         glEnable(GL_DEPTH_TEST)        
 
     def clearlayout(self):
@@ -1346,6 +1437,9 @@ class Network(Polygon):
     def islaidout(self):
         return self.points and True
 
+    def layoutkey(self):
+        return None	# layout rewrites nodes
+
     def layout(self, tile, options, vertexcache, selectednode=None):
 
         return selectednode	# XXX disable networks
@@ -1374,9 +1468,46 @@ class Network(Polygon):
 
         self.lat=self.lat/n
         self.lon=self.lon/n
+        self.allocate(vertexcache)
         return selectednode
 
 
+def layoutobjects(objects, tile, options, vertexcache):
+    # Equivalent to calling layout() on each of a list of Objects, but with one height query
+    if not objects: return
+    xz=[obj.position(tile, obj.lat, obj.lon) for obj in objects]
+    ys=vertexcache.heights(tile, options, [x for (x,z) in xz], [z for (x,z) in xz]).tolist()
+    for i in range(len(objects)):
+        (objects[i].x, objects[i].z)=xz[i]
+        objects[i].y=ys[i]
+
+
+def batchobjects(definition, objects, capacity):
+    # Returns (vertices, texcoords) arrays with room for capacity vertices, holding the
+    # definition's geometry placed at each Object's position and heading. The culled
+    # triangles of all the Objects come first, followed by all the nocull triangles.
+    # The spare room is zeroed since it's uploaded along with the rest.
+    v=array(definition.vdata, float32)
+    t=array(definition.tdata, float32)
+    n=len(objects)
+    vdata=zeros((capacity,3), float32)
+    tdata=zeros((capacity,2), float32)
+    if not n: return (vdata, tdata)
+    # as glTranslatef(x, y, z); glRotatef(-hdg, 0,1,0)
+    coshdg=array([cos(radians(obj.hdg)) for obj in objects])[:,None]
+    sinhdg=array([sin(radians(obj.hdg)) for obj in objects])[:,None]
+    pos=array([(obj.x, obj.y, obj.z) for obj in objects])
+    verts=empty((n,len(v),3), float32)
+    verts[:,:,0]=coshdg*v[:,0] - sinhdg*v[:,2] + pos[:,0:1]
+    verts[:,:,1]=v[:,1] + pos[:,1:2]
+    verts[:,:,2]=sinhdg*v[:,0] + coshdg*v[:,2] + pos[:,2:3]
+    c=definition.culled
+    used=n*len(v)
+    vdata[:used]=concatenate((verts[:,:c].reshape(-1,3), verts[:,c:].reshape(-1,3)))
+    tdata[:used]=concatenate((repeatarray(t[:c],(n,1)), repeatarray(t[c:],(n,1))))
+    return (vdata, tdata)
+
+
 def latlondisp(dms, lat, lon):
     if dms:
         if lat>=0:
@@ -1,7 +1,9 @@
 import codecs
+from collections import OrderedDict
+from itertools import chain
 from math import fabs
 from os import listdir
-from os.path import basename, dirname, exists, join, normpath, sep, splitext
+from os.path import basename, dirname, exists, getmtime, join, normpath, sep, splitext
 from sys import maxint
 
 from OpenGL.GL import *
@@ -86,11 +88,17 @@ class ClutterDef:
     OUTLINELAYER=LAYERNAMES.index('roads')*11+5	# for draped & exclusions
     DEFAULTLAYER=LAYERNAMES.index('objects')*11+5
 
+    mtime=None		# modification time of filename when loaded, or None
+
     def __init__(self, filename, vertexcache):
         self.filename=filename
         if filename:
             if filename[0]=='*':	# this application's resource
                 self.filename=join('Resources', filename[1:])
+            try:
+                self.mtime=getmtime(self.filename)
+            except:
+                pass
             self.texpath=dirname(self.filename)        
             co=sep+'custom objects'+sep
             if co in self.filename.lower():
@@ -397,10 +405,20 @@ class ObjectDef(ClutterDef):
             self.nocull=len(nocull)
             self.base=None
             if texture:	# can be none
-                try:
-                    self.texture=vertexcache.texcache.get(normpath(join(self.texpath, texture)))
-                except IOError, e:
-                    self.texerr=IOError(0,e.strerror,texture)
+                texpath=normpath(join(self.texpath, texture))
+                atlas=None
+                st=list(chain(*self.tdata))
+                if 0<=min(st) and max(st)<=1:	# doesn't wrap, so can share an atlas
+                    atlas=vertexcache.texcache.getatlas(texpath)
+                if atlas:
+                    # remap into atlas - note t is flipped by the texture matrix
+                    (self.texture, u0, v0, uscale, vscale)=atlas
+                    self.tdata=[[u0+ss*uscale, 1-v0-(1-tt)*vscale] for (ss,tt) in self.tdata]
+                else:
+                    try:
+                        self.texture=vertexcache.texcache.get(texpath)
+                    except IOError, e:
+                        self.texerr=IOError(0,e.strerror,texture)
             self.allocate(vertexcache)
 
     def allocate(self, vertexcache, defs=None):
@@ -639,6 +657,7 @@ class FacadeDef(PolygonDef):
         self.vert=[]
         self.hends=[0,0]
         self.vends=[0,0]
+        self.subdivs=OrderedDict()	# (size, isvert) -> (st, cumulative distance) in LRU order, see Facade.strip
     
         h=open(self.filename, 'rU')
         if not h.readline().strip()[0] in ['I','A']:
@@ -733,6 +752,7 @@ class FacadeFallback(PolygonDef):
         self.vert=[(0.0,1.0)]
         self.hends=[0,0]
         self.vends=[0,0]
+        self.subdivs=OrderedDict()
 
 
 class ForestDef(PolygonDef):
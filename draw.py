@@ -14,11 +14,19 @@ try:
 except:
     def glInitMultisampleARB(): return True    
 
-from math import acos, atan2, cos, sin, floor, hypot, pi, radians
-from os.path import basename, join
-from struct import unpack
+try:
+    from OpenGL.GL.EXT.framebuffer_object import *
+except:
+    def glInitFramebufferObjectEXT(): return False
+
+from math import acos, atan2, ceil, cos, sin, floor, log, pi, radians
+from numpy import arange, array, asarray, concatenate, cumsum, empty, fromstring, load, minimum, repeat, savez, searchsorted, argsort, unique, zeros, float64, int32, uint8
+from hashlib import md5
+from os import fdopen, getenv, makedirs, rename, unlink
+from os.path import basename, dirname, exists, expanduser, isdir, join
 
 from sys import exit, platform, version
+from tempfile import mkstemp
 import wx
 import wx.glcanvas
 if __debug__:
@@ -26,17 +34,19 @@ if __debug__:
     from traceback import print_exc
 
 from files import VertexCache, sortfolded, readApt
+from geometry import drapepavements, flatten
 from fixed8x13 import fixed8x13
-from clutter import PolygonFactory, Draped, Facade, Object, Polygon, Network, Exclude, resolution, round2res, latlondisp
+from clutter import PolygonFactory, Beach, Draped, Facade, Object, Polygon, Network, Exclude, resolution, round2res, latlondisp, layoutobjects, batchobjects
 from clutterdef import BBox, ClutterDef, ObjectDef
 from MessageBox import myMessageBox
 from prefs import Prefs
-from version import appname
+from version import appname, appversion
 
 onedeg=1852*60	# 1 degree of longitude at equator (60nm) [m]
 f2m=0.3041	# 1 foot [m] (not accurate, but what X-Plane appears to use)
 
 sband=12	# width of mouse scroll band around edge of window
+beztolerance=0.125	# for flattening pavement curves [m]. Not from the view, so that cached pavements can be reused at any zoom
 
 debugapt=__debug__ and False
 
@@ -72,6 +82,223 @@ class ClickModes:
     Move=6
     
 
+class Selection(list):
+    # list of placements in order of selection, with constant-time membership test.
+    # Placements compare by identity so can be held in a set. A placement is only held once.
+    # Methods that could replace placements in place aren't supported.
+    def __init__(self, placements=()):
+        list.__init__(self)
+        self.members=set()
+        self.extend(placements)
+
+    def __contains__(self, placement):
+        return placement in self.members
+
+    def append(self, placement):
+        if not placement in self.members:
+            list.append(self, placement)
+            self.members.add(placement)
+
+    def insert(self, index, placement):
+        if not placement in self.members:
+            list.insert(self, index, placement)
+            self.members.add(placement)
+
+    def extend(self, placements):
+        for placement in placements:
+            self.append(placement)
+
+    def __iadd__(self, placements):
+        self.extend(placements)
+        return self
+
+    def remove(self, placement):
+        list.remove(self, placement)
+        self.members.discard(placement)
+
+    def pop(self, index=-1):
+        placement=list.pop(self, index)
+        self.members.discard(placement)
+        return placement
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.members=set(self)
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.members=set(self)
+
+    def __setitem__(self, index, value):
+        raise TypeError, 'Selection does not support item assignment'
+
+    def __setslice__(self, i, j, value):
+        raise TypeError, 'Selection does not support item assignment'
+
+    def __imul__(self, n):
+        raise TypeError, 'Selection does not support repetition'
+
+
+# World space bounds of a tile's pickable placements, in picking priority order, with a
+# uniform grid on x,z for fast lookup. Grid layout as files.MeshData.
+# The placements overlapping grid cell (i,j) are items[index[start[k]:start[k+1]]] where k=j*nx+i
+class PickIndex:
+
+    def __init__(self, layers, density=4):
+        # layers is [[Clutter]] by layer. density is the target number of placements per grid cell
+        items=[]
+        for layer in range(len(layers)-1,-1,-1):	# favour higher layers
+            for placement in layers[layer]:
+                if not isinstance(placement, Beach):	# can't be picked
+                    items.append(placement)
+        extents=array([placement.extent() for placement in items], float64).reshape(-1,6)
+        laidout=(extents[:,0]<=extents[:,1]).nonzero()[0]	# skip empty placements
+        self.items=[items[i] for i in laidout]
+        self.extents=extents=extents[laidout]
+        n=len(extents)
+        if not n:
+            (self.x0, self.z0, self.cell, self.nx, self.nz, self.ymin, self.ymax)=(0, 0, 1.0, 0, 0, 0, 0)
+            self.start=zeros(1, int32)
+            self.index=zeros(0, int32)
+            return
+
+        (minx,maxx,minz,maxz)=(extents[:,0], extents[:,1], extents[:,4], extents[:,5])
+        self.ymin=extents[:,2].min()
+        self.ymax=extents[:,3].max()
+        self.x0=x0=minx.min()
+        self.z0=z0=minz.min()
+        self.cell=cell=max(1.0, ((maxx.max()-x0)*(maxz.max()-z0)*density/n)**0.5)
+        self.nx=nx=int((maxx.max()-x0)/cell)+1
+        self.nz=nz=int((maxz.max()-z0)/cell)+1
+        ix0=((minx-x0)/cell).astype(int32)
+        iz0=((minz-z0)/cell).astype(int32)
+        w=minimum(((maxx-x0)/cell).astype(int32), nx-1)-ix0+1
+        h=minimum(((maxz-z0)/cell).astype(int32), nz-1)-iz0+1
+        # expand each placement into the cells covered by its bounds
+        counts=w*h
+        item=repeat(arange(n, dtype=int32), counts)
+        k=arange(counts.sum(), dtype=int32)-repeat(cumsum(counts)-counts, counts)
+        w=repeat(w, counts)
+        cells=(repeat(iz0, counts)+k//w)*nx + repeat(ix0, counts)+k%w
+        order=argsort(cells, kind='mergesort')
+        self.start=searchsorted(cells[order], arange(nx*nz+1))
+        self.index=item[order]
+
+    def query(self, minx, maxx, minz, maxz):
+        # returns indices into items, in priority order, of placements in the cells overlapping the given bounds
+        i0=max(0, int(floor((minx-self.x0)/self.cell)))
+        i1=min(self.nx-1, int(floor((maxx-self.x0)/self.cell)))
+        j0=max(0, int(floor((minz-self.z0)/self.cell)))
+        j1=min(self.nz-1, int(floor((maxz-self.z0)/self.cell)))
+        if i0>i1 or j0>j1: return zeros(0, int32)
+        cells=(arange(j0, j1+1)[:,None]*self.nx + arange(i0, i1+1)).ravel()
+        first=self.start[cells]
+        counts=self.start[cells+1]-first
+        k=arange(counts.sum())-repeat(cumsum(counts)-counts, counts)
+        return unique(self.index[repeat(first, counts)+k])
+
+
+def pickhit(prims, rect):
+    # Whether any of the 2D triangles or line segments in prims (n x 3 x 2 or n x 2 x 2) overlap
+    # rect (minx, maxx, miny, maxy). Separating axis test against the rect's axes and each primitive's edge normals.
+    if not len(prims): return False
+    (minx, maxx, miny, maxy)=rect
+    (x,y)=(prims[:,:,0], prims[:,:,1])
+    overlap=(x.min(axis=1)<=maxx) & (x.max(axis=1)>=minx) & (y.min(axis=1)<=maxy) & (y.max(axis=1)>=miny)
+    corners=array([[minx,miny], [maxx,miny], [maxx,maxy], [minx,maxy]])
+    m=prims.shape[1]
+    for e in range(m):
+        normals=empty((len(prims),2), float64)
+        normals[:,0]=prims[:,e,1]-prims[:,(e+1)%m,1]
+        normals[:,1]=prims[:,(e+1)%m,0]-prims[:,e,0]
+        p=(prims*normals[:,None,:]).sum(axis=2)
+        c=normals.dot(corners.T)
+        overlap&=(p.min(axis=1)<=c.max(axis=1)) & (p.max(axis=1)>=c.min(axis=1))
+    return overlap.any()
+
+
+def pickcolour(ident, bits):
+    # (r,g,b) bytes encoding ident in a framebuffer with (red, green, blue) bits per channel
+    (rbits, gbits, bbits)=bits
+    return ((((ident>>(gbits+bbits)) & ((1<<rbits)-1)) << (8-rbits)),
+            (((ident>>bbits) & ((1<<gbits)-1)) << (8-gbits)),
+            ((ident & ((1<<bbits)-1)) << (8-bbits)))
+
+
+def pickidents(pixels, bits):
+    # sorted unique idents encoded by pickcolour in an n x 3 array of (r,g,b) bytes. 0 = background.
+    (rbits, gbits, bbits)=bits
+    pixels=asarray(pixels, int32).reshape(-1,3)
+    return unique(((pixels[:,0]>>(8-rbits)) << (gbits+bbits)) | ((pixels[:,1]>>(8-gbits)) << bbits) | (pixels[:,2]>>(8-bbits)))
+
+
+def aptcachefile(key):
+    # file holding pavements of airports near tile (key[0],key[1]) laid out with elevation mode key[2].
+    # In a per-user cache directory, so other users can't plant or read it.
+    if platform=='win32':
+        folder=join(getenv('LOCALAPPDATA') or getenv('APPDATA') or expanduser('~'), 'marginal.org', appname)
+    elif platform=='darwin':
+        folder=join(expanduser('~'), 'Library', 'Caches', appname)
+    else:
+        folder=join(getenv('XDG_CACHE_HOME') or join(expanduser('~'), '.cache'), appname.lower())
+    return join(folder, '%+03d%+04d%s.npz' % (key[0], key[1], key[2] and 'e' or ''))
+
+
+def readaptcache(key):
+    # returns {hash of airport and terrain: pavements} saved by writeaptcache, where pavements
+    # are lists of (shoulder, taxiway, runway) vertices and texture coordinates. Plain arrays, so
+    # loading runs no code. Anything unexpected is treated as not cached.
+    try:
+        data=load(aptcachefile(key), allow_pickle=False)	# numpy>=1.10
+        try:
+            if data['version'].tolist()!=[appversion]: return {}	# layout may differ between versions
+            (keys, counts, vertices, texcoords)=(data['keys'], data['counts'], data['vertices'], data['texcoords'])
+        finally:
+            data.close()
+        n=len(keys)
+        if (keys.shape!=(n,) or keys.dtype.kind!='S' or counts.shape!=(n,6) or counts.dtype.kind!='i' or
+            (counts<0).any() or (counts[:,0::2]!=counts[:,1::2]).any() or
+            vertices.shape!=(counts[:,0::2].sum(),3) or texcoords.shape!=(counts[:,1::2].sum(),2) or
+            vertices.dtype!=float64 or texcoords.dtype!=float64):
+            raise IOError
+        vertices=vertices.tolist()
+        texcoords=texcoords.tolist()
+        cache={}
+        (v,t)=(0,0)
+        for (aptkey, (sv, st, tv, tt, rv, rt)) in zip(keys.tolist(), counts.tolist()):
+            cache[aptkey]=(vertices[v:v+sv], texcoords[t:t+st],
+                           vertices[v+sv:v+sv+tv], texcoords[t+st:t+st+tt],
+                           vertices[v+sv+tv:v+sv+tv+rv], texcoords[t+st+tt:t+st+tt+rt])
+            v+=sv+tv+rv
+            t+=st+tt+rt
+        return cache
+    except:
+        return {}	# not cached
+
+
+def writeaptcache(key, cache):
+    # write atomically, so that a crash or another instance never leaves a partial file
+    filename=aptcachefile(key)
+    tmp=None
+    try:
+        if not isdir(dirname(filename)): makedirs(dirname(filename), 0700)
+        aptkeys=cache.keys()
+        (fd, tmp)=mkstemp('.tmp', '', dirname(filename))
+        h=fdopen(fd, 'wb')
+        savez(h,
+              version=array([appversion]),
+              keys=array(aptkeys, 'S32').reshape(-1),
+              counts=array([[len(a) for a in cache[aptkey]] for aptkey in aptkeys], int32).reshape(-1,6),
+              vertices=array([p for aptkey in aptkeys for a in cache[aptkey][0::2] for p in a], float64).reshape(-1,3),
+              texcoords=array([p for aptkey in aptkeys for a in cache[aptkey][1::2] for p in a], float64).reshape(-1,2))
+        h.close()
+        if platform=='win32' and exists(filename): unlink(filename)	# rename won't replace
+        rename(tmp, filename)
+    except:
+        if __debug__: print_exc()
+        if tmp and exists(tmp): unlink(tmp)
+
+
 # OpenGL Window
 class MyGL(wx.glcanvas.GLCanvas):
     def __init__(self, parent, frame):
@@ -89,6 +316,8 @@ class MyGL(wx.glcanvas.GLCanvas):
         self.centre=None	# [lat,lon] of centre
         self.airports={}	# [runways] by code
         self.runways={}		# [shoulder/taxiway/runway data] by tile
+        self.aptcache={}	# {hash of airport and terrain: pavements} by tile, see readaptcache
+        self.pool=None		# worker processes for drapeall, started by OverlayEditor.py before wx
         self.shoulderdata=None	# indices into cache (base, len)
         self.taxiwaydata=None	# indices into cache (base, len)
         self.runwaysdata=None	# indices into cache (base, len)
@@ -99,19 +328,25 @@ class MyGL(wx.glcanvas.GLCanvas):
         self.defs={}		# loaded ClutterDefs by filename
         self.placements={}	# [Clutter] by layer and tile
         self.unsorted={}	# [Clutter] by tile
+        self.layoutmemo={}	# {layout inputs: layout state} by tile, for placements whose layout was cleared
+        self.layercache=[None]*ClutterDef.LAYERCOUNT	# (current, excluded, [(list, extent, count)]) by layer of current tile
+        self.batches={}		# (layer, cell, ObjectDef) -> (base, capacity) allocation in vertexcache
+        self.freebatches=[]	# [(base, capacity)] allocations in vertexcache no longer used by a batch
+        self.cellsize=None	# granularity of layercache for view culling [m]
         self.background=None
         self.meshlist=0
         
         self.mousenow=None	# Current position (used in timer and drag)
         self.locked=0		# locked object types
-        self.selected=[]	# list of selected placements
+        self.selected=Selection()	# selected placements
         self.clickmode=None
         self.clickpos=None	# Location of mouse down
         self.clickctrl=False	# Ctrl was held down
         self.selectednode=None	# Selected node
         self.selections=[]	# List of hits for cycling picking
-        self.selectsaved=[]	# Selection at start of ctrl drag box
-        self.selectmax=4096	# max 1024 names
+        self.selectsaved=Selection()	# Selection at start of ctrl drag box
+        self.pickindex=None	# PickIndex of current tile
+        self.nodecache=None	# (camera, polygon, window x and y of its nodes) for hover
         self.draginert=True
         self.dragx=wx.SystemSettings_GetMetric(wx.SYS_DRAG_X)
         self.dragy=wx.SystemSettings_GetMetric(wx.SYS_DRAG_Y)
@@ -153,6 +388,10 @@ class MyGL(wx.glcanvas.GLCanvas):
 
         self.vertexcache=None
         self.multisample=False
+        self.fbo=False		# framebuffer objects available for newselect
+        self.pickfbo=0		# offscreen framebuffer for newselect
+        self.pickrbo=0		# and its colour renderbuffer
+        self.pickfbosize=(0,0)
 
         wx.EVT_ERASE_BACKGROUND(self, self.OnEraseBackground)
         wx.EVT_KEY_DOWN(self, self.OnKeyDown)
@@ -162,11 +401,12 @@ class MyGL(wx.glcanvas.GLCanvas):
         wx.EVT_LEFT_UP(self, self.OnLeftUp)
         wx.EVT_MIDDLE_DOWN(self, self.OnMiddleDown)
         wx.EVT_MIDDLE_UP(self, self.OnMiddleUp)
-        wx.EVT_IDLE(self, self.OnIdle)
         #wx.EVT_KILL_FOCUS(self, self.OnKill)	# debug
         
         self.timer=wx.Timer(self, wx.ID_ANY)
         wx.EVT_TIMER(self, self.timer.GetId(), self.OnTimer)
+        self.layouttimer=wx.Timer(self, wx.ID_ANY)	# full layout when node drag pauses
+        wx.EVT_TIMER(self, self.layouttimer.GetId(), self.OnLayoutTimer)
 
     def glInit(self):
         #print "Canvas Init"
@@ -181,6 +421,10 @@ class MyGL(wx.glcanvas.GLCanvas):
             self.multisample=glIsEnabled(GL_MULTISAMPLE_ARB)
         except:
             self.multisample=False
+        try:
+            self.fbo=glInitFramebufferObjectEXT() and True
+        except:
+            self.fbo=False
         #glClearDepth(1.0)
         glClearColor(0.5, 0.5, 1.0, 0.0)	# Sky
         glEnable(GL_DEPTH_TEST)
@@ -271,6 +515,7 @@ class MyGL(wx.glcanvas.GLCanvas):
         #print "up", ClickModes.DragNode
         if self.HasCapture(): self.ReleaseMouse()
         self.timer.Stop()
+        self.layouttimer.Stop()
         if self.clickmode==ClickModes.DragNode:
             self.selectednode=self.selected[0].layout(self.tile, self.options, self.vertexcache, self.selectednode)
             self.trashlists(True)	# recompute obj and pick lists
@@ -298,13 +543,12 @@ class MyGL(wx.glcanvas.GLCanvas):
         self.clickmode=None
         event.Skip()
 
-    def OnIdle(self, event):
-        if self.valid:	# can get Idles during reload under X
-            if self.clickmode==ClickModes.DragNode:
-                self.selectednode=self.selected[0].layout(self.tile, self.options, self.vertexcache, self.selectednode)
-                assert self.selectednode
-                self.Refresh()
-        event.Skip()
+    def OnLayoutTimer(self, event):
+        # node drag has paused - do the full layout that updatenode defers
+        if self.valid and self.clickmode==ClickModes.DragNode:
+            self.selectednode=self.selected[0].layout(self.tile, self.options, self.vertexcache, self.selectednode)
+            assert self.selectednode
+            self.Refresh()
 
     def OnMouseMotion(self, event):
         # Capture unreliable on Mac, so may have missed Up events. See
@@ -331,30 +575,9 @@ class MyGL(wx.glcanvas.GLCanvas):
                 return
 
             # Change cursor if over a node
-            if len(self.selected)==1 and isinstance(self.selected[0], Polygon):
-                glMatrixMode(GL_PROJECTION)
-                glPushMatrix()
-                glLoadIdentity()
-                gluPickMatrix(event.m_x,
-                              size[1]-1-event.m_y, 5,5,
-                              (0, 0, size[0], size[1]))
-                glOrtho(-self.d, self.d,
-                        -self.d*size.y/size.x, self.d*size.y/size.x,
-                        -self.d*self.cliprat, self.d*self.cliprat)
-                glMatrixMode(GL_MODELVIEW)
-                glSelectBuffer(self.selectmax)
-                glRenderMode(GL_SELECT)
-                glInitNames()
-                glPushName(0)
-                self.selected[0].picknodes()
-                selections=glRenderMode(GL_RENDER)
-                # Restore state for unproject
-                glMatrixMode(GL_PROJECTION)
-                glPopMatrix()	
-                glMatrixMode(GL_MODELVIEW)
-                if selections:
-                    self.SetCursor(self.dragcursor)	# hovering over node
-                    return
+            if len(self.selected)==1 and isinstance(self.selected[0], Polygon) and self.overnode(event.m_x, event.m_y):
+                self.SetCursor(self.dragcursor)	# hovering over node
+                return
                 
             self.SetCursor(wx.NullCursor)
             return
@@ -393,6 +616,7 @@ class MyGL(wx.glcanvas.GLCanvas):
                     self.frame.menubar.Enable(wx.ID_SAVE, True)
                     self.frame.menubar.Enable(wx.ID_UNDO, True)
             poly.updatenode(self.selectednode, lat, lon, self.tile, self.options, self.vertexcache)
+            self.layouttimer.Start(250, wx.TIMER_ONE_SHOT)	# restart
             self.Refresh()	# show updated node
             self.frame.ShowSel()
             return
@@ -459,7 +683,9 @@ class MyGL(wx.glcanvas.GLCanvas):
             glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
             self.needclear=False
         
+        dirty=self.updatelayers()
         self.vertexcache.realize(self)
+        self.compilelayers(dirty)
 
         # Static stuff: mesh, networks, navaids
         glCallList(self.meshlist)
@@ -475,11 +701,15 @@ class MyGL(wx.glcanvas.GLCanvas):
 
         glColor3f(0.8, 0.8, 0.8)	# Unpainted
         #glEnable(GL_DEPTH_TEST)
+        if __debug__: (total,visible)=(0,0)
         for layer in range(ClutterDef.LAYERCOUNT):
             #print layer, placements[layer]
-            for placement in placements[layer]:
-                if self.clickmode==ClickModes.DragBox or not placement in self.selected:
-                    placement.draw(False, False)
+            lists=self.layercache[layer][2]	# unselected placements
+            if lists:
+                for i in self.inview(array([extent for (listid, extent, count) in lists])).nonzero()[0]:
+                    glCallList(lists[i][0])
+                    if __debug__: visible+=lists[i][2]
+            if __debug__: total+=len(placements[layer])
             # pavements
             if layer in [ClutterDef.SHOULDERLAYER, ClutterDef.TAXIWAYLAYER,
                          ClutterDef.RUNWAYSLAYER]:
@@ -501,7 +731,7 @@ class MyGL(wx.glcanvas.GLCanvas):
                     if __debug__:
                         if debugapt: glPolygonMode(GL_FRONT, GL_FILL)
         if __debug__:
-            print "%6.3f time to draw" % (time.clock()-clock)
+            print "%6.3f time to draw, %d of %d placements visible" % (time.clock()-clock, visible, total)
 
         # Overlays
         glDisable(GL_POLYGON_OFFSET_FILL)
@@ -614,60 +844,93 @@ class MyGL(wx.glcanvas.GLCanvas):
         self.needclear=False
 
 
-    def newselect(self):
+    def newselect(self, rect):
+        # Colour-coded picking: returns unlocked placements, in priority order, that have visible
+        # pixels within rect (minx, maxx, miny, maxy) in eye space. Candidate placements are drawn
+        # in one pass, each in a colour encoding its id, into an offscreen framebuffer covering
+        # just rect, which is then read back. Falls back to the back buffer if no FBOs.
+        # Unlike pick(), only sees the topmost placement at each pixel so can't cycle through hits.
         if __debug__: clock=time.clock()	# Processor time
-        size = self.GetClientSize()
-        if False:#XXX fixme self.clickmode==ClickModes.DragBox:
-            # maths goes wrong if zero-sized box
-            if self.clickpos[0]==self.mousenow[0]: self.mousenow[0]+=1
-            if self.clickpos[1]==self.mousenow[1]: self.mousenow[1]-=1
-            gluPickMatrix((self.clickpos[0]+self.mousenow[0])/2,
-                          size[1]-1-(self.clickpos[1]+self.mousenow[1])/2,
-                          abs(self.clickpos[0]-self.mousenow[0]),
-                          abs(self.clickpos[1]-self.mousenow[1]),
-                          (0, 0, size[0], size[1]))
-
-        placements=self.placements[self.tile]
-
-        # Click region must be even for 
-        # XXX check the -1 alignment with mouse cursor on Windows
-        glScissor(self.clickpos[0]-2, size[1]-2-self.clickpos[1], 5,5)
+        size=self.GetClientSize()
+        scale=2.0*self.d/size.x	# eye space per pixel
+        width=max(1, int(round((rect[1]-rect[0])/scale)))
+        height=max(1, int(round((rect[3]-rect[2])/scale)))
+        (candidates, overlap, inside)=self.pickcandidates(rect)
+        candidates=[k for k in candidates[overlap] if not self.pickindex.items[k].definition.type & self.locked]
+        if not candidates: return []
+        self.vertexcache.realize(self)	# placements may have changed since last paint
+
+        glPushAttrib(GL_COLOR_BUFFER_BIT|GL_ENABLE_BIT|GL_VIEWPORT_BIT|GL_SCISSOR_BIT|GL_CURRENT_BIT)
+        if self.fbo:
+            try:
+                if not self.pickfbo:
+                    self.pickfbo=glGenFramebuffersEXT(1)
+                    self.pickrbo=glGenRenderbuffersEXT(1)
+                glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.pickfbo)
+                if width>self.pickfbosize[0] or height>self.pickfbosize[1]:
+                    self.pickfbosize=(max(width, self.pickfbosize[0]), max(height, self.pickfbosize[1]))
+                    glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, self.pickrbo)
+                    glRenderbufferStorageEXT(GL_RENDERBUFFER_EXT, GL_RGBA8, *self.pickfbosize)
+                    glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_RENDERBUFFER_EXT, self.pickrbo)
+                    if glCheckFramebufferStatusEXT(GL_FRAMEBUFFER_EXT)!=GL_FRAMEBUFFER_COMPLETE_EXT: raise IOError
+                glReadBuffer(GL_COLOR_ATTACHMENT0_EXT)
+                (x,y)=(0,0)
+            except:
+                if __debug__:
+                    print "FBOs disabled"
+                    print_exc()
+                self.fbo=False
+                glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+        if not self.fbo:
+            # draw over rect in the back buffer - it'll be redrawn by the next paint
+            (x,y)=(int(round(rect[0]/scale+size.x/2.0)), int(round(rect[2]/scale+size.y/2.0)))
+            glReadBuffer(GL_BACK)
+        bits=[glGetIntegerv(GL_RED_BITS), glGetIntegerv(GL_GREEN_BITS), glGetIntegerv(GL_BLUE_BITS)]
+        bits=[min(8,int(b)) for b in bits]
+        if len(candidates)>=1<<sum(bits):
+            # not enough colours
+            glPopAttrib()
+            if self.fbo: glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+            return self.pick(rect)
+
+        glViewport(x, y, width, height)
+        glScissor(x, y, width, height)
         glEnable(GL_SCISSOR_TEST)
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(rect[0], rect[1], rect[2], rect[3], -self.d*self.cliprat, self.d*self.cliprat)
+        glMatrixMode(GL_MODELVIEW)	# as left by OnPaint
+        for cap in [GL_TEXTURE_2D, GL_DEPTH_TEST, GL_CULL_FACE, GL_BLEND, GL_DITHER, GL_LINE_SMOOTH]:
+            glDisable(cap)
         if self.multisample: glDisable(GL_MULTISAMPLE_ARB)
-        glDisable(GL_LINE_SMOOTH)
-	glDisable(GL_DITHER)
-        glClearColor(0.0, 0.0, 1.0, 0.0)	# Impossible value
+        glClearColor(0.0, 0.0, 0.0, 0.0)	# id 0 = nothing
         glClear(GL_COLOR_BUFFER_BIT)
-        glDisable(GL_TEXTURE_2D)
-        glDisable(GL_CULL_FACE)
-        glDepthMask(GL_FALSE)			# So don't need to clear depth
-        #glDisable(GL_DEPTH_TEST)		# and don't need to do this
 
-        # Click:
-        # Select higher layer items first
-        selections=[]
-        for i in range(len(placements)):	# favour higher layers
-            if placements[i]:
-                glClear(GL_COLOR_BUFFER_BIT)
-                for j in range(len(placements[i])):
-                    #if i==82: print placements[i][j], j, j%32*8, (j%1024)/32*8, j/1024*8
-                    glColor3ub(j%32*8, (j%1024)/32*8, j/1024*8)	# 5bits/color
-                    placements[i][j].draw(False, True)
-                data=unpack('75B',glReadPixels(self.clickpos[0]-2, size[1]-2-self.clickpos[1], 5,5, GL_RGB, GL_UNSIGNED_BYTE))
-                #print i, len(data), data
-                for k in range(0, 75, 3):
-                    j=(data[k]/8)+(data[k+1]/8)*32+(data[k+2]/8)*1024
-                    if j!=(255/8*1024):
-                        print j, placements[i][j]
+        # Draw higher priority placements last so that they end up on top
+        for i in range(len(candidates)-1,-1,-1):
+            glColor3ub(*pickcolour(i+1, bits))
+            self.pickindex.items[candidates[i]].draw(False, True)
 
-        self.SwapBuffers()
+        data=glReadPixels(x, y, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+        if isinstance(data, str):
+            data=fromstring(data, uint8)
+        idents=pickidents(data, bits)
 
-        glClear(GL_COLOR_BUFFER_BIT)
-        #glEnable(GL_DEPTH_TEST)
-        if self.multisample: glEnable(GL_MULTISAMPLE_ARB)
-        glEnable(GL_LINE_SMOOTH)
-        glDisable(GL_SCISSOR_TEST)
-        if __debug__: print "%6.3f time in select" %(time.clock()-clock)
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        glPopAttrib()
+        if self.fbo:
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+            glReadBuffer(GL_BACK)
+        else:
+            self.Refresh()	# repair back buffer
+
+        # candidates are in priority order, so are idents
+        selections=[self.pickindex.items[candidates[ident-1]] for ident in idents if 0<ident<=len(candidates)]
+        if __debug__: print "%6.3f time in newselect, %d of %d candidates visible" % (time.clock()-clock, len(selections), len(candidates))
+        return selections
 
 
     def select(self):
@@ -676,52 +939,18 @@ class MyGL(wx.glcanvas.GLCanvas):
         #    self.selections=[]	# Can't remember
         if __debug__: clock=time.clock()	# Processor time
         size = self.GetClientSize()
-        glMatrixMode(GL_PROJECTION)
-        glPushMatrix()
-        glLoadIdentity()
+        scale=2.0*self.d/size.x	# eye space per pixel
         if self.clickmode==ClickModes.DragBox:
-            # maths goes wrong if zero-sized box
-            if self.clickpos[0]==self.mousenow[0]: self.mousenow[0]+=1
-            if self.clickpos[1]==self.mousenow[1]: self.mousenow[1]-=1
-            gluPickMatrix((self.clickpos[0]+self.mousenow[0])/2,
-                          size[1]-1-(self.clickpos[1]+self.mousenow[1])/2,
-                          abs(self.clickpos[0]-self.mousenow[0]),
-                          abs(self.clickpos[1]-self.mousenow[1]),
-                          (0, 0, size[0], size[1]))
+            (x0,x1)=(min(self.clickpos[0], self.mousenow[0]), max(self.clickpos[0], self.mousenow[0]))
+            (y0,y1)=(min(self.clickpos[1], self.mousenow[1]), max(self.clickpos[1], self.mousenow[1]))
         else:	# at point
-            gluPickMatrix(self.clickpos[0],
-                          size[1]-1-self.clickpos[1], 5,5,
-                          (0, 0, size[0], size[1]))
-        glOrtho(-self.d, self.d,
-                -self.d*size.y/size.x, self.d*size.y/size.x,
-                -self.d*self.cliprat, self.d*self.cliprat)
-        glMatrixMode(GL_MODELVIEW)
-
-        glSelectBuffer(self.selectmax)
-        glRenderMode(GL_SELECT)
-        glInitNames()
-        glPushName(0)
-        glDisable(GL_TEXTURE_2D)
-        glDisable(GL_DEPTH_TEST)
-        glDisable(GL_CULL_FACE)
-        if self.multisample: glDisable(GL_MULTISAMPLE_ARB)
-        glDisable(GL_LINE_SMOOTH)
-        placements=self.placements[self.tile]
-        for i in range(len(placements)-1,-1,-1):	# favour higher layers
-            for j in range(len(placements[i])):
-                if not placements[i][j].definition.type & self.locked:
-                    glLoadName((i<<24)+j)
-                    placements[i][j].draw(False, True)
-        glEnable(GL_DEPTH_TEST)
-        if self.multisample: glEnable(GL_MULTISAMPLE_ARB)
-        glEnable(GL_LINE_SMOOTH)
-
-        selections=[]
-        try:
-            for min_depth, max_depth, (name,) in glRenderMode(GL_RENDER):
-                selections.append(placements[int(name)>>24][int(name)&0xffffff])
-        except:	# overflow
-            if __debug__: print_exc()
+            (x0,x1)=(self.clickpos[0]-2.5, self.clickpos[0]+2.5)
+            (y0,y1)=(self.clickpos[1]-2.5, self.clickpos[1]+2.5)
+        rect=((x0-size.x/2.0)*scale, (x1-size.x/2.0)*scale, (size.y/2.0-y1)*scale, (size.y/2.0-y0)*scale)
+        if self.options&Prefs.PICKCOLOUR:
+            selections=self.newselect(rect)
+        else:
+            selections=self.pick(rect)
 
         # Select poly node?
         self.selectednode=None
@@ -735,26 +964,11 @@ class MyGL(wx.glcanvas.GLCanvas):
             if trysel:
                 #print "selnodes",
                 # First look for nodes in same polygon
-                glSelectBuffer(self.selectmax)
-                glRenderMode(GL_SELECT)
-                glInitNames()
-                glPushName(0)
-                trysel.picknodes()
-                selectnodes=[]
-                try:
-                    for min_depth, max_depth, (name,) in glRenderMode(GL_RENDER):
-                        selectnodes.append((int(name)>>24, int(name)&0xffffff))
-                except:	# overflow
-                    pass
+                selectnodes=self.picknodes(trysel, rect)
                 if selectnodes:
                     self.clickmode=ClickModes.DragNode
-                    self.selected=[trysel]
+                    self.selected=Selection([trysel])
                     self.selectednode=selectnodes[0]
-            
-        # Restore state for unproject
-        glMatrixMode(GL_PROJECTION)
-        glPopMatrix()	
-        glMatrixMode(GL_MODELVIEW)
 
         if self.selectednode:
             self.trashlists()	# selection changes
@@ -764,14 +978,12 @@ class MyGL(wx.glcanvas.GLCanvas):
 
         if self.clickmode==ClickModes.DragBox:	# drag - add or remove all
             if self.clickctrl:
-                self.selected=list(self.selectsaved)	# reset each time
-                for i in selections:
-                    if not i in self.selected:
-                        self.selected.append(i)
-                    else:
-                        self.selected.remove(i)
+                # toggle each of selections, relative to saved selection
+                saved=self.selectsaved
+                toggled=set(selections)
+                self.selected=Selection([i for i in saved if not i in toggled]+[i for i in selections if not i in saved])
             else:
-                self.selected=list(selections)
+                self.selected=Selection(selections)
         else:			# click - Add or remove one
             if not selections:
                 self.clickmode=ClickModes.DragBox
@@ -785,18 +997,19 @@ class MyGL(wx.glcanvas.GLCanvas):
                         self.selected.append(i)
                         break
                 else:	# all selected - remove one
+                    toggled=set(selections)
                     for i in self.selected:
-                        if i in selections:
+                        if i in toggled:
                             self.selected.remove(i)
                             break
             else:
                 if not selections:
-                    self.selected=[]
+                    self.selected=Selection()
                 elif selections==self.selections and len(self.selected)==1 and self.selected[0] in self.selections:
                     # cycle through selections
-                    self.selected=[selections[(selections.index(self.selected[0])+1)%len(selections)]]
+                    self.selected=Selection([selections[(selections.index(self.selected[0])+1)%len(selections)]])
                 else:
-                    self.selected=[selections[0]]
+                    self.selected=Selection([selections[0]])
         self.selections=selections
         if __debug__:
             for selection in self.selected:
@@ -843,7 +1056,7 @@ class MyGL(wx.glcanvas.GLCanvas):
             if newnode:
                 self.undostack.append(newundo)
                 if not self.selectednode:
-                    self.selected=[placement]
+                    self.selected=Selection([placement])
                 self.selectednode=newnode
             else:
                 return False
@@ -872,7 +1085,7 @@ class MyGL(wx.glcanvas.GLCanvas):
             placements=self.placements[self.tile][layer]
             self.undostack.append(UndoEntry(self.tile, UndoEntry.ADD, [(layer, len(placements), placement)]))
             placements.append(placement)
-            self.selected=[placement]
+            self.selected=Selection([placement])
 
         self.trashlists(True)	# selection changes
         self.Refresh()
@@ -906,6 +1119,8 @@ class MyGL(wx.glcanvas.GLCanvas):
             if not (self.undostack and self.undostack[-1].equals(newundo)):
                 self.undostack.append(newundo)
 
+        self.pickindex=None	# extents changed
+        self.nodecache=None
         self.Refresh()
         self.frame.ShowSel()
         return True
@@ -937,7 +1152,7 @@ class MyGL(wx.glcanvas.GLCanvas):
                 deleted.insert(0,(layer, i, placement))	# LIFO
                 placements[layer].pop(i)
             self.undostack.append(UndoEntry(self.tile, UndoEntry.DEL, deleted))
-            self.selected=[]
+            self.selected=Selection()
 
         self.trashlists(True)	# selection changes
         self.Refresh()
@@ -953,7 +1168,7 @@ class MyGL(wx.glcanvas.GLCanvas):
         self.goto(undo.tile)	# force assignment of placements to layers
         avlat=0
         avlon=0
-        self.selected=[]
+        self.selected=Selection()
         self.selectednode=None
         placements=self.placements[undo.tile]
 
@@ -986,7 +1201,7 @@ class MyGL(wx.glcanvas.GLCanvas):
     def clearsel(self):
         if self.selected:
             self.Refresh()
-        self.selected=[]
+        self.selected=Selection()
         self.selectednode=None
         self.trashlists()	# selection changed
 
@@ -1010,7 +1225,7 @@ class MyGL(wx.glcanvas.GLCanvas):
         definition=self.defs[self.lookup[name].file]
         placements=self.placements[self.tile][definition.layer]
         if withctrl and withshift:
-            self.selected=[]
+            self.selected=Selection()
             for placement in placements:
                 if placement.definition==definition:
                     self.selected.append(placement)
@@ -1025,12 +1240,12 @@ class MyGL(wx.glcanvas.GLCanvas):
                 return None
         else:
             start=-1
-            for placement in self.selected:
-                start=max(start,placements.index(placement))
+            for i in range(len(placements)):
+                if placements[i] in self.selected: start=i
             for i in range(start+1, len(placements)+start+1):
                 placement=placements[i%len(placements)]
                 if placement.definition==definition:
-                    self.selected=[placement]
+                    self.selected=Selection([placement])
                     break
             else:
                 return None
@@ -1117,7 +1332,7 @@ class MyGL(wx.glcanvas.GLCanvas):
             self.background=None
         self.clipboard=[]	# layers might have changed
         self.undostack=[]	# layers might have changed
-        self.selected=[]	# may not have same indices in new list
+        self.selected=Selection()	# may not have same indices in new list
         self.selectednode=None
 
         if __debug__:
@@ -1145,7 +1360,7 @@ class MyGL(wx.glcanvas.GLCanvas):
 
         if newtile!=self.tile or options&Prefs.REDRAW!=self.options&Prefs.REDRAW:
             if newtile!=self.tile:
-                self.selected=[]
+                self.selected=Selection()
                 self.selectednode=None
                 self.frame.ShowSel()
             self.valid=False
@@ -1153,6 +1368,11 @@ class MyGL(wx.glcanvas.GLCanvas):
             self.vertexcache.flush()
             # flush all array allocations
             for Def in self.defs.values(): Def.flush()
+            for placements in self.placements.values():
+                for layer in placements:
+                    for placement in layer: placement.flush()
+            for placements in self.unsorted.values():
+                for placement in placements: placement.flush()
             self.selections=[]
             self.trashlists(True, True)
 
@@ -1184,6 +1404,13 @@ class MyGL(wx.glcanvas.GLCanvas):
                 p=len(placements)/10+1
                 n=0
                 i=0
+                objects=[]
+                # layouts from the last time this tile was loaded, keyed by everything that they depend on
+                memo=self.layoutmemo.pop(newtile, {})
+                newmemo={}
+                laidout=[]	# (placement, key) to add to memo
+                restored=0
+                meshversion=self.vertexcache.getMeshdata(newtile, options).version
                 for i in range(len(placements)):
                     if i==n:
                         progress.Update(3+i/p, 'Objects')
@@ -1207,38 +1434,52 @@ class MyGL(wx.glcanvas.GLCanvas):
                         if not s in errtexs: errtexs.append(s)
                         
                     if not placement.islaidout():
-                        placement.layout(newtile, options, self.vertexcache)
+                        key=placement.layoutkey()
+                        if key!=None:
+                            key=(placement.__class__, key, options&Prefs.ELEVATION, meshversion)
+                        if key in memo:
+                            placement.restorelayout(memo[key])
+                            placement.allocate(self.vertexcache)
+                            newmemo[key]=memo[key]
+                            restored+=1
+                        else:
+                            if isinstance(placement, Object):
+                                objects.append(placement)	# laid out en masse below
+                            else:
+                                placement.layout(newtile, options, self.vertexcache)
+                            if key!=None: laidout.append((placement, key))
+                    else:
+                        placement.allocate(self.vertexcache)
                     self.placements[newtile][placement.definition.layer].append(placement)
-                if __debug__: print "%6.3f time in load&layout" % (time.clock()-clock)
+                layoutobjects(objects, newtile, options, self.vertexcache)
+                for (placement, key) in laidout:
+                    newmemo[key]=placement.layoutstate()
+                self.layoutmemo[newtile]=newmemo
+                if __debug__: print "%6.3f time in load&layout, %d of %d layouts restored" % (time.clock()-clock, restored, len(placements))
             else:
                 for placements in self.placements[newtile]:
                     for placement in placements:
                         placement.definition.allocate(self.vertexcache, self.defs)
+                        placement.allocate(self.vertexcache)
             self.options=options
 
             # Lay out runways
             progress.Update(13, 'Runways')
-            surfaces={0:  [0.125, 0.125],	# unknown
-                      1:  [0.375, 0.125],	# asphalt
-                      2:  [0.625, 0.125],	# concrete
-                      3:  [0.875, 0.125],	# grass
-                      4:  [0.125, 0.375],	# dirt,
-                      5:  [0.375, 0.375],	# gravel
-                      12: [0.125, 0.875],	# lakebed
-                      13: [0.375, 0.875],	# water
-                      14: [0.625, 0.875],	# ice
-                      15: [0.875, 0.875]}	# transparent
             key=(newtile[0],newtile[1],options&Prefs.ELEVATION)
             if key not in self.runways:
                 if __debug__: clock=time.clock()	# Processor time
                 self.runways[key]=[]
                 self.codes[newtile]=[]
-                svarray=[]
-                starray=[]
-                tvarray=[]
-                ttarray=[]
-                rvarray=[]
-                rtarray=[]
+                # pavements of each airport from the last time this tile was laid out, maybe in an earlier session
+                if key in self.aptcache:
+                    cache=self.aptcache[key]
+                else:
+                    cache=readaptcache(key)
+                newcache={}
+                terrain=self.vertexcache.meshsource(newtile, options)
+                order=[]	# keys of airports in this tile's area
+                pending=[]	# (key, helipads) of airports to be tessellated
+                jobs=[]		# their drapepavements() arguments
                 area=BBox(newtile[0]-0.05, newtile[0]+1.1,
                           newtile[1]-0.1, newtile[1]+1.2)
                 tile=BBox(newtile[0], newtile[0]+1,
@@ -1248,10 +1489,6 @@ class MyGL(wx.glcanvas.GLCanvas):
                         continue
                     if tile.inside(*loc):
                         self.codes[newtile].append((code,loc))
-                    runways=[]
-                    taxiways=[]
-                    shoulders=[]
-                    thisarea=BBox()
                     if isinstance(apt, long):
                         try:
                             thisapt=readApt(self.aptdatfile, apt)
@@ -1259,198 +1496,30 @@ class MyGL(wx.glcanvas.GLCanvas):
                         except:
                             thisapt=[]
                     else:
-                        thisapt=list(apt)
-                    thisapt.reverse()	# draw in reverse order
-                    newthing=None
-                    for thing in thisapt:
-                        if isinstance(thing, tuple):
-                            # convert to pavement style
-                            if not isinstance(thing[0], tuple):
-                                # old pre-850 style or 850 style helipad
-                                (lat,lon,h,length,width,stop1,stop2,surface,shoulder,isrunway)=thing
-                                if isrunway:
-                                    kind=runways
-                                else:
-                                    kind=taxiways
-                                (cx,cz)=self.aptlatlon2m(lat,lon)
-                                length1=length/2+stop1
-                                length2=length/2+stop2
-                                h=radians(h)
-                                coshdg=cos(h)
-                                sinhdg=sin(h)
-                                p1=[cx-length1*sinhdg, cz+length1*coshdg]
-                                p2=[cx+length2*sinhdg, cz-length2*coshdg]
-                                # Special handling for helipads, of which
-                                # there are loads
-                                if len(thisapt)==1 and length+stop1+stop2<61 and width<61:	# 200ft
-                                    if not tile.inside(lat,lon):
-                                        continue
-                                    #if __debug__: print code, "small"
-                                    if surface in surfaces:
-                                        col=surfaces[surface]
-                                    else:
-                                        col=surfaces[0]
-                                    xinc=width/2*coshdg
-                                    zinc=width/2*sinhdg
-                                    rvarray.extend([[p1[0]+xinc, self.vertexcache.height(newtile,options, p1[0]+xinc, p1[1]+zinc), p1[1]+zinc],
-                                                    [p1[0]-xinc, self.vertexcache.height(newtile,options, p1[0]-xinc, p1[1]-zinc), p1[1]-zinc],
-                                                    [p2[0]-xinc, self.vertexcache.height(newtile,options, p2[0]-xinc, p2[1]-zinc), p2[1]-zinc],
-                                                    [p1[0]+xinc, self.vertexcache.height(newtile,options, p1[0]+xinc, p1[1]+zinc), p1[1]+zinc],
-                                                    [p2[0]-xinc, self.vertexcache.height(newtile,options, p2[0]-xinc, p2[1]-zinc), p2[1]-zinc],
-                                                    [p2[0]+xinc, self.vertexcache.height(newtile,options, p2[0]+xinc, p2[1]+zinc), p2[1]+zinc]])
-                                    rtarray.extend([col,col,col,col,col,col])
-                                    continue
-                            else:
-                                # new 850 style runway
-                                ((lat1,lon1),(lat2,lon2),width,stop1,stop2,surface,shoulder)=thing
-                                kind=runways
-                                (x1,z1)=self.latlon2m(lat1,lon1)
-                                (x2,z2)=self.latlon2m(lat2,lon2)
-                                h=-atan2(x1-x2,z1-z2)
-                                coshdg=cos(h)
-                                sinhdg=sin(h)
-                                p1=[x1-stop1*sinhdg, z1+stop1*coshdg]
-                                p2=[x2+stop2*sinhdg, z2-stop2*coshdg]
-                            xinc=width/2*coshdg
-                            zinc=width/2*sinhdg
-                            newthing=[surface,
-                                      [[p1[0]+xinc, p1[1]+zinc],
-                                       [p1[0]-xinc, p1[1]-zinc],
-                                       [p2[0]-xinc, p2[1]-zinc],
-                                       [p2[0]+xinc, p2[1]+zinc]]]
-                            kind.append(newthing)
-                            if shoulder:
-                                xinc=width*0.75*coshdg
-                                zinc=width*0.75*sinhdg
-                                newthing=[shoulder,
-                                          [[p1[0]+xinc, p1[1]+zinc],
-                                           [p1[0]-xinc, p1[1]-zinc],
-                                           [p2[0]-xinc, p2[1]-zinc],
-                                           [p2[0]+xinc, p2[1]+zinc]]]
-                                shoulders.append(newthing)
-                            for i in range(4):
-                                thisarea.include(*newthing[1][i])
+                        thisapt=apt
+                    aptkey=md5(repr((code, thisapt, terrain))).hexdigest()
+                    order.append(aptkey)
+                    if aptkey in cache:
+                        newcache[aptkey]=cache[aptkey]
+                    else:
+                        (helipads, kinds, meshtris)=self.aptoutlines(newtile, options, thisapt)
+                        if kinds:
+                            pending.append((aptkey, helipads))
+                            jobs.append((kinds, meshtris))
                         else:
-                            # new 850 style taxiway
-                            newthing=[thing[0]]
-                            for i in range(1,len(thing)):
-                                winding=[]
-                                for pt in thing[i]:
-                                    (x,z)=self.latlon2m(pt[0],pt[1])
-                                    thisarea.include(x,z)
-                                    if len(pt)<4:
-                                        winding.append([x,z])
-                                    else:
-                                        (xb,zb)=self.latlon2m(pt[2],pt[3])
-                                        thisarea.include(xb,zb)
-                                        winding.append([x,z,xb,zb])
-                                newthing.append(winding)
-                            taxiways.append(newthing)
-
-                    if not runways and not taxiways:
-                        continue	# didn't add anything (except helipads)
-                    
-                    # Find patches under this airport
-                    #if __debug__: print code, len(taxiways), len(runways),
-                    meshtris=[]
-                    for (bbox, tris) in self.vertexcache.getMeshdata(newtile,options):
-                        if thisarea.intersects(bbox):
-                            # tesselator is expensive - minimise mesh triangles
-                            for tri in tris:
-                                (pt, coeffs)=tri
-                                tbox=BBox()
-                                for i in range(3):
-                                    tbox.include(pt[i][0], pt[i][2])
-                                if thisarea.intersects(tbox):
-                                    meshtris.append(tri)
-                    if not meshtris:
-                        #if __debug__: print 0
-                        continue	# airport is wholly outside this tile
-                    #if __debug__: print len(meshtris),
-
-                    for (kind,varray,tarray) in [(shoulders, svarray, starray),
-                                                 (taxiways, tvarray, ttarray),
-                                                 (runways,  rvarray, rtarray)]:
-                        lastcol=None
-                        pavements=[]
-                        for pave in kind:
-                            # tessellate similar surfaces together
-                            if pave[0] in surfaces:
-                                col=surfaces[pave[0]]
-                            else:
-                                col=surfaces[0]
-                            if col!=lastcol:
-                                if lastcol:
-                                    gluTessEndPolygon(tess)
-                                if pavements:
-                                    # tessellate existing against terrain
-                                    gluTessBeginPolygon(csgt, (varray,tarray))
-                                    for i in range(0,len(pavements),3):
-                                        gluTessBeginContour(csgt)
-                                        for j in range(i,i+3):
-                                            gluTessVertex(csgt, [pavements[j][0][0],0,pavements[j][0][2]], pavements[j])
-                                        gluTessEndContour(csgt)
-                                    for meshtri in meshtris:
-                                        (meshpt, coeffs)=meshtri
-                                        gluTessBeginContour(csgt)
-                                        for m in range(3):
-                                            x=meshpt[m][0]
-                                            z=meshpt[m][2]
-                                            gluTessVertex(csgt, [x,0,z], (meshpt[m],True, lastcol))
-                                        gluTessEndContour(csgt)
-                                    gluTessEndPolygon(csgt)
-                                lastcol=col
-                                pavements=[]
-                                gluTessBeginPolygon(tess, pavements)
-
-                            # generate tris in pavements
-                            for i in range(1,len(pave)):
-                                gluTessBeginContour(tess)
-                                edge=pave[i]
-                                n=len(edge)
-                                last=None
-                                for j in range(n):
-                                    if len(edge[j])==len(edge[(j+1)%n])==2:
-                                        points=[edge[j]]
-                                    else:
-                                        cpoints=[(edge[j][0],edge[j][1])]
-                                        if len(edge[j])!=2:
-                                            cpoints.append((edge[j][2],edge[j][3]))
-                                        if len(edge[(j+1)%n])!=2:
-                                            cpoints.append((2*edge[(j+1)%n][0]-edge[(j+1)%n][2],2*edge[(j+1)%n][1]-edge[(j+1)%n][3]))
-                                            
-                                        cpoints.append((edge[(j+1)%n][0],edge[(j+1)%n][1]))
-                                        points=[self.bez(cpoints, u/4.0) for u in range(4)]	# X-Plane stops at or before 8
-                                    for pt in points:
-                                        if pt==last: continue
-                                        last=pt
-                                        (x,z)=pt
-                                        y=self.vertexcache.height(newtile,options,x,z,meshtris)
-                                        gluTessVertex(tess, [x,0,z], ([x,y,z], False, col))
-                                gluTessEndContour(tess)
-
-                        # tessellate last against terrain
-                        if lastcol:
-                            gluTessEndPolygon(tess)
-                        if pavements:	# may have no taxiways
-                            gluTessBeginPolygon(csgt, (varray,tarray))
-                            for i in range(0,len(pavements),3):
-                                gluTessBeginContour(csgt)
-                                for j in range(i,i+3):
-                                    gluTessVertex(csgt, [pavements[j][0][0],0,pavements[j][0][2]], pavements[j])
-                                gluTessEndContour(csgt)
-                            for meshtri in meshtris:
-                                (meshpt, coeffs)=meshtri
-                                gluTessBeginContour(csgt)
-                                for m in range(3):
-                                    x=meshpt[m][0]
-                                    z=meshpt[m][2]
-                                    gluTessVertex(csgt, [x,0,z], (meshpt[m],True, lastcol))
-                                gluTessEndContour(csgt)
-                            gluTessEndPolygon(csgt)
-
-                        assert(len(varray)==len(tarray))
-                    #if __debug__: print ' '
+                            newcache[aptkey]=([], [], [], [])+helipads
+                if __debug__: print "%d of %d airports' pavements cached" % (len(order)-len(pending), len(order))
+                # tessellate against terrain
+                for ((aptkey, (rvarray, rtarray)), ((svarray, starray), (tvarray, ttarray), (dvarray, dtarray))) in zip(pending, self.drapeall(jobs)):
+                    newcache[aptkey]=(svarray, starray, tvarray, ttarray, rvarray+dvarray, rtarray+dtarray)
+                arrays=([],[],[],[],[],[])
+                for aptkey in order:
+                    for i in range(len(arrays)):
+                        arrays[i].extend(newcache[aptkey][i])
+                if set(newcache)!=set(cache):
+                    writeaptcache(key, newcache)
+                self.aptcache[key]=newcache
+                (svarray, starray, tvarray, ttarray, rvarray, rtarray)=arrays
 
                 varray=svarray+tvarray+rvarray
                 tarray=starray+ttarray+rtarray
@@ -1461,20 +1530,19 @@ class MyGL(wx.glcanvas.GLCanvas):
                 if __debug__: print "%6.3f time in runways" % (time.clock()-clock)
             else:
                 (varray,tarray,shoulderlen,taxiwaylen,runwaylen)=self.runways[key]
+            base=self.vertexcache.allocate(varray, tarray)
             if shoulderlen:
-                self.shoulderdata=(len(self.vertexcache.varray), shoulderlen)
+                self.shoulderdata=(base, shoulderlen)
             else:
                 self.shoulderdata=None
             if taxiwaylen:
-                self.taxiwaydata=(len(self.vertexcache.varray)+shoulderlen, taxiwaylen)
+                self.taxiwaydata=(base+shoulderlen, taxiwaylen)
             else:
                 self.taxiwaydata=None
             if runwaylen:
-                self.runwaysdata=(len(self.vertexcache.varray)+shoulderlen+taxiwaylen, runwaylen)
+                self.runwaysdata=(base+shoulderlen+taxiwaylen, runwaylen)
             else:
                 self.runwaysdata=None
-            self.vertexcache.varray.extend(varray)
-            self.vertexcache.tarray.extend(tarray)
 
             progress.Update(14, 'Navaids')
             objs={2:  'lib/airport/NAVAIDS/NDB_3.obj',
@@ -1514,6 +1582,9 @@ class MyGL(wx.glcanvas.GLCanvas):
                 
             # Prepare static stuff: mesh, networks, navaids
             progress.Update(15, 'Done')
+            nets=[]
+            for (roadtype, points) in self.vertexcache.getNets(newtile,options):
+                nets.append((roadtype, self.vertexcache.allocate(points, [(0,0)]*len(points)), len(points)))
             self.vertexcache.realize(self)
             self.meshlist=glGenLists(1)
             glNewList(self.meshlist, GL_COMPILE)
@@ -1550,15 +1621,12 @@ class MyGL(wx.glcanvas.GLCanvas):
 
             # networks
             glDisable(GL_TEXTURE_2D)
-            for (roadtype, points) in self.vertexcache.getNets(newtile,options):
+            for (roadtype, base, count) in nets:
                 if roadtype<=len(self.defnetdefs) and self.defnetdefs[roadtype].color:
                     glColor3f(*self.defnetdefs[roadtype].color)
                 else:
                     glColor3f(0.5,0.5,0.5)
-                glBegin(GL_LINE_STRIP)
-                for (x,y,z) in points:
-                    glVertex3f(x,y,z)
-                glEnd()
+                glDrawArrays(GL_LINE_STRIP, base, count)
 
             # navaids
             glColor3f(0.8, 0.8, 0.8)	# Unpainted
@@ -1640,128 +1708,371 @@ class MyGL(wx.glcanvas.GLCanvas):
 
         self.Refresh()
 
-    def bez(self, p, mu):
-        # http://local.wasp.uwa.edu.au/~pbourke/curves/bezier/index.html
-        mum1=1-mu
-        if len(p)==3:
-            mu2  = mu*mu
-            mum12= mum1*mum1
-            return (round(p[0][0]*mum12 + 2*p[1][0]*mum1*mu + p[2][0]*mu2,6),
-                    round(p[0][1]*mum12 + 2*p[1][1]*mum1*mu + p[2][1]*mu2,6))
-        elif len(p)==4:
-            mu3  = mu*mu*mu
-            mum13= mum1*mum1*mum1
-            return (round(p[0][0]*mum13 + 3*p[1][0]*mu*mum1*mum1 + 3*p[2][0]*mu*mu*mum1 + p[3][0]*mu3,6),
-                    round(p[0][1]*mum13 + 3*p[1][1]*mu*mum1*mum1 + 3*p[2][1]*mu*mu*mum1 + p[3][1]*mu3,6))
-        else:
-            raise ArithmeticError
-        
+    def aptoutlines(self, newtile, options, thisapt):
+        # Returns ((vertices, texcoords) of helipads, [shoulders, taxiways, runways], terrain
+        # triangles under the airport) for drapepavements(). Shoulders etc are [(texcoord,
+        # [contour])] where contour=[(x,z)] with the curves flattened to within beztolerance.
+        surfaces={0:  [0.125, 0.125],	# unknown
+                  1:  [0.375, 0.125],	# asphalt
+                  2:  [0.625, 0.125],	# concrete
+                  3:  [0.875, 0.125],	# grass
+                  4:  [0.125, 0.375],	# dirt,
+                  5:  [0.375, 0.375],	# gravel
+                  12: [0.125, 0.875],	# lakebed
+                  13: [0.375, 0.875],	# water
+                  14: [0.625, 0.875],	# ice
+                  15: [0.875, 0.875]}	# transparent
+        rvarray=[]
+        rtarray=[]
+        tile=BBox(newtile[0], newtile[0]+1,
+                  newtile[1], newtile[1]+1)
+        runways=[]
+        taxiways=[]
+        shoulders=[]
+        thisarea=BBox()
+        thisapt=list(thisapt)
+        thisapt.reverse()	# draw in reverse order
+        newthing=None
+        for thing in thisapt:
+            if isinstance(thing, tuple):
+                # convert to pavement style
+                if not isinstance(thing[0], tuple):
+                    # old pre-850 style or 850 style helipad
+                    (lat,lon,h,length,width,stop1,stop2,surface,shoulder,isrunway)=thing
+                    if isrunway:
+                        kind=runways
+                    else:
+                        kind=taxiways
+                    (cx,cz)=self.aptlatlon2m(lat,lon)
+                    length1=length/2+stop1
+                    length2=length/2+stop2
+                    h=radians(h)
+                    coshdg=cos(h)
+                    sinhdg=sin(h)
+                    p1=[cx-length1*sinhdg, cz+length1*coshdg]
+                    p2=[cx+length2*sinhdg, cz-length2*coshdg]
+                    # Special handling for helipads, of which
+                    # there are loads
+                    if len(thisapt)==1 and length+stop1+stop2<61 and width<61:	# 200ft
+                        if not tile.inside(lat,lon):
+                            continue
+                        #if __debug__: print code, "small"
+                        if surface in surfaces:
+                            col=surfaces[surface]
+                        else:
+                            col=surfaces[0]
+                        xinc=width/2*coshdg
+                        zinc=width/2*sinhdg
+                        xs=[p1[0]+xinc, p1[0]-xinc, p2[0]-xinc, p2[0]+xinc]
+                        zs=[p1[1]+zinc, p1[1]-zinc, p2[1]-zinc, p2[1]+zinc]
+                        ys=self.vertexcache.heights(newtile,options, xs, zs).tolist()
+                        rvarray.extend([[xs[i], ys[i], zs[i]] for i in [0,1,2,0,2,3]])
+                        rtarray.extend([col,col,col,col,col,col])
+                        continue
+                else:
+                    # new 850 style runway
+                    ((lat1,lon1),(lat2,lon2),width,stop1,stop2,surface,shoulder)=thing
+                    kind=runways
+                    (x1,z1)=self.latlon2m(lat1,lon1)
+                    (x2,z2)=self.latlon2m(lat2,lon2)
+                    h=-atan2(x1-x2,z1-z2)
+                    coshdg=cos(h)
+                    sinhdg=sin(h)
+                    p1=[x1-stop1*sinhdg, z1+stop1*coshdg]
+                    p2=[x2+stop2*sinhdg, z2-stop2*coshdg]
+                xinc=width/2*coshdg
+                zinc=width/2*sinhdg
+                newthing=[surface,
+                          [[p1[0]+xinc, p1[1]+zinc],
+                           [p1[0]-xinc, p1[1]-zinc],
+                           [p2[0]-xinc, p2[1]-zinc],
+                           [p2[0]+xinc, p2[1]+zinc]]]
+                kind.append(newthing)
+                if shoulder:
+                    xinc=width*0.75*coshdg
+                    zinc=width*0.75*sinhdg
+                    newthing=[shoulder,
+                              [[p1[0]+xinc, p1[1]+zinc],
+                               [p1[0]-xinc, p1[1]-zinc],
+                               [p2[0]-xinc, p2[1]-zinc],
+                               [p2[0]+xinc, p2[1]+zinc]]]
+                    shoulders.append(newthing)
+                for i in range(4):
+                    thisarea.include(*newthing[1][i])
+            else:
+                # new 850 style taxiway
+                newthing=[thing[0]]
+                for i in range(1,len(thing)):
+                    winding=[]
+                    for pt in thing[i]:
+                        (x,z)=self.latlon2m(pt[0],pt[1])
+                        thisarea.include(x,z)
+                        if len(pt)<4:
+                            winding.append([x,z])
+                        else:
+                            (xb,zb)=self.latlon2m(pt[2],pt[3])
+                            thisarea.include(xb,zb)
+                            winding.append([x,z,xb,zb])
+                    newthing.append(winding)
+                taxiways.append(newthing)
+
+        if not runways and not taxiways:
+            return ((rvarray, rtarray), [], None)	# didn't add anything (except helipads)
+
+        # Find patches under this airport
+        meshtris=self.vertexcache.getMeshdata(newtile,options).overlapping(thisarea)
+        if not len(meshtris):
+            return ((rvarray, rtarray), [], None)	# airport is wholly outside this tile
+
+        kinds=[]
+        for kind in [shoulders, taxiways, runways]:
+            groups=[]	# similar surfaces are tessellated together
+            for pave in kind:
+                if pave[0] in surfaces:
+                    col=surfaces[pave[0]]
+                else:
+                    col=surfaces[0]
+                if not groups or col!=groups[-1][0]:
+                    groups.append((col, []))
+                for i in range(1,len(pave)):
+                    groups[-1][1].append(flatten(pave[i], beztolerance))
+            kinds.append(groups)
+        return ((rvarray, rtarray), kinds, meshtris)
+
+    def drapeall(self, jobs):
+        # Returns [drapepavements(job)] for each job, using the pool of worker processes if there is one.
+        # The pool isn't created here since forking after wx and OpenGL have started isn't safe.
+        if self.pool and len(jobs)>1:
+            try:
+                return self.pool.map(drapepavements, jobs)
+            except:
+                if __debug__: print_exc()
+                self.pool=None	# run serially from now on
+        return map(drapepavements, jobs)
+
+    def eyeaxes(self):
+        # Eye space x and y axes in world space. See getworldloc.
+        (cose,sine)=(cos(radians(self.e)), sin(radians(self.e)))
+        (cosh,sinh)=(cos(radians(self.h)), sin(radians(self.h)))
+        return array([[cosh, 0, sinh], [sine*sinh, cose, -sine*cosh]])
+
+    def toeye(self, points):
+        # project world space points (... x 3) to eye space x,y (... x 2)
+        return (points-array([self.x, self.y, self.z])).dot(self.eyeaxes().T)
+
+    def pickcandidates(self, rect):
+        # returns (indices into pickindex.items in priority order, mask of those whose bounds overlap rect,
+        # mask of those whose bounds lie wholly within rect) for rect (minx, maxx, miny, maxy) in eye space
+        if not self.pickindex:
+            self.pickindex=PickIndex(self.placements[self.tile])
+        index=self.pickindex
+        if not index.items: return (zeros(0, int32), zeros(0, bool), zeros(0, bool))
+
+        # Bounds on the ground of the volume swept by rect along the view direction, between the lowest and highest placements
+        axes=self.eyeaxes()
+        sine=sin(radians(self.e))
+        view=array([cos(radians(self.e))*sin(radians(self.h)), -sine, -cos(radians(self.e))*cos(radians(self.h))])
+        corners=array([[rect[0],rect[2]], [rect[1],rect[2]], [rect[1],rect[3]], [rect[0],rect[3]]]).dot(axes)+array([self.x, self.y, self.z])
+        swept=[corners+((corners[:,1]-y)/sine)[:,None]*view for y in [index.ymin, index.ymax]]
+        swept=concatenate(swept)
+        candidates=index.query(swept[:,0].min(), swept[:,0].max(), swept[:,2].min(), swept[:,2].max())
+
+        # Project bounds into eye space
+        extents=index.extents[candidates]
+        centres=self.toeye((extents[:,0::2]+extents[:,1::2])/2)
+        halves=((extents[:,1::2]-extents[:,0::2])/2).dot(abs(axes.T))
+        (lo,hi)=(centres-halves, centres+halves)
+        overlap=(lo[:,0]<=rect[1]) & (hi[:,0]>=rect[0]) & (lo[:,1]<=rect[3]) & (hi[:,1]>=rect[2])
+        inside=(lo[:,0]>=rect[0]) & (hi[:,0]<=rect[1]) & (lo[:,1]>=rect[2]) & (hi[:,1]<=rect[3])
+        return (candidates, overlap, inside)
+
+    def pick(self, rect):
+        # returns unlocked placements, in priority order, that overlap rect (minx, maxx, miny, maxy) in eye space
+        (candidates, overlap, inside)=self.pickcandidates(rect)
+        selections=[]
+        for i in overlap.nonzero()[0]:
+            placement=self.pickindex.items[candidates[i]]
+            if placement.definition.type & self.locked: continue
+            if not inside[i]:
+                # exact test against what would be drawn
+                (tris, lines)=placement.pickdata()
+                if not (pickhit(self.toeye(tris), rect) or pickhit(self.toeye(lines), rect)): continue
+            selections.append(placement)
+        return selections
+
+    def overnode(self, mx, my):
+        # is the mouse over a node of the single selected polygon?
+        size=self.GetClientSize()
+        camera=(self.x, self.y, self.z, self.h, self.e, self.d, size.x, size.y)
+        placement=self.selected[0]
+        if not self.nodecache or self.nodecache[0]!=camera or self.nodecache[1]!=placement:
+            points=[placement.points[i][j] for (i,j) in placement.visiblenodes()]
+            if not points: return False
+            scale=2.0*self.d/size.x	# eye space per pixel
+            (x,y)=self.toeye(array(points, float64)).T
+            self.nodecache=(camera, placement, x/scale+size.x/2.0, size.y/2.0-y/scale)
+        (camera, placement, x, y)=self.nodecache
+        return ((abs(x-mx)<=2.5) & (abs(y-my)<=2.5)).any()	# same 5x5 region as select
+
+    def picknodes(self, placement, rect):
+        # returns nodes (i,j) of a Polygon that lie within rect (minx, maxx, miny, maxy) in eye space
+        nodes=placement.visiblenodes()
+        if not nodes: return []
+        (x,y)=self.toeye(array([placement.points[i][j] for (i,j) in nodes], float64)).T
+        return [nodes[k] for k in ((x>=rect[0]) & (x<=rect[1]) & (y>=rect[2]) & (y<=rect[3])).nonzero()[0]]
+
+    def inview(self, extents):
+        # returns mask of which (minx, maxx, miny, maxy, minz, maxz) boxes intersect the view volume
+        axes=self.eyeaxes()
+        size=self.GetClientSize()
+        # Project each box's centre and half-size onto the axes and compare against the ortho view
+        centres=(extents[:,0::2]+extents[:,1::2])/2-array([self.x, self.y, self.z])
+        halves=(extents[:,1::2]-extents[:,0::2])/2
+        (dx,dy)=abs(centres.dot(axes.T)).T
+        (hx,hy)=halves.dot(abs(axes.T)).T
+        return (dx<=self.d+hx) & (dy<=self.d*size.y/size.x+hy)
+
+    def updatelayers(self):
+        # Find layers whose unselected placements have changed, and rebuild their Object batches.
+        # Call before realize. Returns data for compilelayers.
+        selected={}
+        if self.clickmode!=ClickModes.DragBox:	# selection in flux during box select, so draw as unselected
+            for placement in self.selected:
+                selected.setdefault(placement.definition.layer, []).append(placement)
+        # cells no larger than the view's half-width, so that few are drawn when zoomed in
+        cellsize=onedeg/2**max(4, min(10, int(ceil(log(onedeg/self.d, 2)))))
+        if cellsize!=self.cellsize:
+            self.cellsize=cellsize
+            self.layercache=[cache and (False, None, cache[2]) for cache in self.layercache]
+        dirty=[]
+        for layer in range(ClutterDef.LAYERCOUNT):
+            placements=self.placements[self.tile][layer]
+            excluded=frozenset(selected.get(layer, []))
+            cache=self.layercache[layer]
+            if cache and cache[0] and cache[1]==excluded: continue
+
+            # group by cell, and Objects within each cell by definition
+            cells={}	# cell -> ({ObjectDef: [Object]}, [Clutter], [extent])
+            for placement in placements:
+                if placement in excluded: continue
+                extent=placement.extent()
+                cell=(int(floor((extent[0]+extent[1])/(2*self.cellsize))), int(floor((extent[4]+extent[5])/(2*self.cellsize))))
+                if not cell in cells: cells[cell]=({}, [], [])
+                if isinstance(placement, Object):
+                    cells[cell][0].setdefault(placement.definition, []).append(placement)
+                else:
+                    cells[cell][1].append(placement)
+                cells[cell][2].append(extent)
+
+            tocompile=[]
+            used=set()
+            for (cell, (objects, others, extents)) in cells.iteritems():
+                batches=[]
+                for (definition, things) in objects.iteritems():
+                    key=(layer, cell, definition)
+                    used.add(key)
+                    needed=len(things)*(definition.culled+definition.nocull)
+                    if key in self.batches and needed<=self.batches[key][1]:
+                        (base, capacity)=self.batches[key]
+                    else:
+                        if key in self.batches:
+                            self.freebatches.append(self.batches.pop(key))	# outgrown
+                        # smallest free allocation that's big enough, else a new one with room to grow
+                        fits=[free for free in self.freebatches if free[1]>=needed]
+                        if fits:
+                            (base, capacity)=min(fits, key=lambda free: free[1])
+                            self.freebatches.remove((base, capacity))
+                        else:
+                            (base, capacity)=(None, needed+needed/2)
+                    (vdata, tdata)=batchobjects(definition, things, capacity)
+                    if base is None:
+                        base=self.vertexcache.allocate(vdata, tdata)
+                    else:
+                        self.vertexcache.update(base, vdata, tdata)
+                    self.batches[key]=(base, capacity)
+                    batches.append((definition, base, len(things)))
+                extents=array(extents)
+                extent=[extents[:,0].min(), extents[:,1].max(), extents[:,2].min(), extents[:,3].max(), extents[:,4].min(), extents[:,5].max()]
+                tocompile.append((batches, others, extent))
+            # release batches that are now empty
+            for key in [oldkey for oldkey in self.batches if oldkey[0]==layer and oldkey not in used]:
+                self.freebatches.append(self.batches.pop(key))
+            dirty.append((layer, excluded, tocompile))
+        return dirty
+
+    def compilelayers(self, dirty):
+        # Compile display lists for each cell of the changed layers. Call after realize.
+        for (layer, excluded, tocompile) in dirty:
+            if self.layercache[layer]:
+                for (listid, extent, count) in self.layercache[layer][2]:
+                    glDeleteLists(listid, 1)
+            lists=[]
+            for (batches, others, extent) in tocompile:
+                listid=glGenLists(1)
+                glNewList(listid, GL_COMPILE)
+                # each ObjectDef's Objects with one or two glDrawArrays
+                for (definition, base, count) in batches:
+                    glBindTexture(GL_TEXTURE_2D, definition.texture)
+                    if definition.poly:
+                        glEnable(GL_POLYGON_OFFSET_FILL)
+                    if definition.culled:
+                        glDrawArrays(GL_TRIANGLES, base, count*definition.culled)
+                    if definition.nocull:
+                        glDisable(GL_CULL_FACE)
+                        glDrawArrays(GL_TRIANGLES, base+count*definition.culled, count*definition.nocull)
+                        glEnable(GL_CULL_FACE)
+                    if definition.poly:
+                        glDisable(GL_POLYGON_OFFSET_FILL)
+                for placement in others:
+                    placement.draw(False, False)
+                glEndList()
+                lists.append((listid, extent, sum([count for (definition, base, count) in batches])+len(others)))
+            self.layercache[layer]=(True, excluded, lists)
+
     def trashlists(self, picktoo=False, terraintoo=False):
         # Should be called when selection changed
         # - with picktoo if objects have changed
         # - with terraintoo if vertexcache has been flushed
         #print "i", objectstoo, runwaysandterraintoo
+        self.nodecache=None
+        if picktoo:
+            self.pickindex=None
+            # force rebuild, but keep display lists for deletion
+            self.layercache=[cache and (False, None, cache[2]) for cache in self.layercache]
         if terraintoo:
+            # vertexcache allocations are gone
+            for cache in self.layercache:
+                if cache:
+                    for (listid, extent, count) in cache[2]:
+                        glDeleteLists(listid, 1)
+            self.layercache=[None]*ClutterDef.LAYERCOUNT
+            self.batches={}
+            self.freebatches=[]
             if self.meshlist: glDeleteLists(self.meshlist, 1)
             self.meshlist=0
             if self.codeslist: glDeleteLists(self.codeslist, 1)
             self.codeslist=0
 
     def getworldloc(self, mx, my):
-        self.SetCurrent()
         size = self.GetClientSize()
         mx=max(0, min(size[0]-1, mx))
         my=max(0, min(size[1]-1, size[1]-1-my))
-        glDisable(GL_TEXTURE_2D)
-        glColorMask(GL_FALSE,GL_FALSE,GL_FALSE,GL_FALSE)
-        glEnable(GL_DEPTH_TEST)
-        glCallList(self.meshlist)	# Terrain only
-        #glFinish()	# redundant
-        dz=glReadPixelsf(mx,my, 1,1, GL_DEPTH_COMPONENT)[0][0]
-        if dz==0.0 or dz==1.0:
-            mz=0.5	# treat off the tile edge as sea level
-        else:
-            mz=dz
-        (x,y,z)=gluUnProject(mx,my,mz)
-        glColorMask(GL_TRUE,GL_TRUE,GL_TRUE,GL_TRUE)
-        glClear(GL_DEPTH_BUFFER_BIT)
+        # Cast ray from the mouse position on the eye plane, along the view direction.
+        # Undo glRotatef(self.e, 1,0,0); glRotatef(self.h, 0,1,0); glTranslatef(-self.x, -self.y, -self.z)
+        ex=(2.0*mx/size[0]-1)*self.d
+        ey=(2.0*my/size[1]-1)*self.d*size.y/size.x
+        (cose,sine)=(cos(radians(self.e)), sin(radians(self.e)))
+        (cosh,sinh)=(cos(radians(self.h)), sin(radians(self.h)))
+        def toworld(x,y,z):
+            (y,z)=(y*cose+z*sine, z*cose-y*sine)
+            return (x*cosh-z*sinh, y, x*sinh+z*cosh)
+        (x,y,z)=toworld(ex,ey,0)
+        (x,y,z)=(x+self.x, y+self.y, z+self.z)
+        hit=self.vertexcache.raycast(self.tile, self.options, (x,y,z), toworld(0,0,-1))
+        if hit:
+            (x,y,z)=hit
+        # else treat off the tile edge as the eye plane
         lat=round2res(self.centre[0]-z/onedeg)
         lon=round2res(self.centre[1]+x/(onedeg*cos(radians(lat))))
-        #print "%3d %3d %.6f, %5d %5.1f %5d, %10.6f %11.6f" % (mx,my,mz, x,y,z, lat,lon)
+        #print "%3d %3d, %5d %5.1f %5d, %10.6f %11.6f" % (mx,my, x,y,z, lat,lon)
         return (lat,lon)
-
-
-# runway tessellators
-
-def tessvertex(vertex, data):
-    data.append(vertex)
-
-def tesscombine(coords, vertex, weight):
-    # Linearly interp height from vertices (location, ismesh, uv)
-    p1=vertex[0]
-    p2=vertex[1]
-    d=hypot(p2[0][0]-p1[0][0], p2[0][2]-p1[0][2])
-    if not d:
-        return p1	# p1 and p2 are colocated
-    else:
-        ratio=hypot(coords[0]-p1[0][0], coords[2]-p1[0][2])/d
-        y=p1[0][1]+ratio*(p2[0][1]-p1[0][1])
-        return ([coords[0],y,coords[2]], False, p1[2])
-    
-def tessedge(flag):
-    pass	# dummy
-
-tess=gluNewTess()
-gluTessNormal(tess, 0, -1, 0)
-gluTessProperty(tess, GLU_TESS_WINDING_RULE, GLU_TESS_WINDING_NONZERO)
-gluTessCallback(tess, GLU_TESS_VERTEX_DATA,  tessvertex)
-gluTessCallback(tess, GLU_TESS_COMBINE,      tesscombine)
-gluTessCallback(tess, GLU_TESS_EDGE_FLAG,    tessedge)	# no strips
-
-
-def csgtvertex((vertex,ismesh,colour), (varray,tarray)):
-    varray.append(vertex)
-    tarray.append(colour)
-
-def csgtcombine(coords, vertex, weight):
-    # vertex = [(location, ismesh, uv)]
-    # check for just two adjacent mesh triangles
-    if vertex[0]==vertex[1]:
-        # common case
-        return vertex[0]
-    elif vertex[0][0][0]==vertex[1][0][0] and vertex[0][0][2]==vertex[1][0][2] and vertex[0][1]:
-        # Height discontinuity in terrain mesh - eg LIEE - wtf!
-        assert not weight[2] and not vertex[2] and not weight[3] and not vertex[3] and vertex[1][1]
-        return vertex[0]
-
-    # intersection of two lines - use terrain mesh line for height
-    elif vertex[0][1]:
-        #assert weight[0] and weight[1] and weight[2] and weight[3] and vertex[1][1]
-        p1=vertex[0]
-        p2=vertex[1]
-        p3=vertex[2]
-    else:
-        assert weight[0] and weight[1] and weight[2] and weight[3]
-        p1=vertex[2]
-        p2=vertex[3]
-        p3=vertex[0]
-
-    # height
-    d=hypot(p2[0][0]-p1[0][0], p2[0][2]-p1[0][2])
-    if not d:
-        y=p1[0][1]
-    else:
-        ratio=(hypot(coords[0]-p1[0][0], coords[2]-p1[0][2])/d)
-        y=p1[0][1]+ratio*(p2[0][1]-p1[0][1])
-    return ([coords[0],y,coords[2]], True, p3[2] or p1[2])
-
-def csgtedge(flag):
-    pass	# dummy
-
-csgt = gluNewTess()
-gluTessNormal(csgt, 0, -1, 0)
-gluTessProperty(csgt, GLU_TESS_WINDING_RULE, GLU_TESS_WINDING_ABS_GEQ_TWO)
-gluTessCallback(csgt, GLU_TESS_VERTEX_DATA,  csgtvertex)
-gluTessCallback(csgt, GLU_TESS_COMBINE,      csgtcombine)
-gluTessCallback(csgt, GLU_TESS_EDGE_FLAG,    csgtedge)	# no strips
-
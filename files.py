@@ -19,25 +19,25 @@ except:	# not in 2.0.0.44
     def glInitTextureNonPowerOfTwoARB(): return False
 
 try:
-    from OpenGL.GL.ARB.vertex_buffer_object import glInitVertexBufferObjectARB, glGenBuffersARB, glBindBufferARB, glBufferDataARB, GL_ARRAY_BUFFER_ARB, GL_STATIC_DRAW_ARB
+    from OpenGL.GL.ARB.vertex_buffer_object import glInitVertexBufferObjectARB, glGenBuffersARB, glBindBufferARB, glBufferDataARB, glBufferSubDataARB, GL_ARRAY_BUFFER_ARB, GL_STATIC_DRAW_ARB
 except:
     def glInitVertexBufferObjectARB(): return False
 
 import codecs
 from glob import glob
-from math import cos, log, pi, radians
+from math import cos, hypot, log, pi, radians, sqrt
+from mmap import mmap, ACCESS_READ
 from os import listdir, mkdir
-from os.path import basename, curdir, dirname, exists, isdir, join, normpath, pardir, sep, splitext
+from os.path import basename, curdir, dirname, exists, getmtime, isdir, join, normpath, pardir, sep, splitext
 from shutil import copyfile
 from struct import unpack
 from sys import platform, maxint
 import time
 from traceback import print_exc, print_last
 import wx
-if OpenGL.__version__ >= '3':
-    from numpy import array, hstack, float32
+from numpy import arange, argsort, array, asarray, ascontiguousarray, concatenate, cumsum, empty, floor, frombuffer, inf, linspace, minimum, pad, repeat, searchsorted, unique, where, zeros, float32, float64, int32, uint8
 
-from clutterdef import BBox, KnownDefs, SkipDefs, NetworkDef
+from clutterdef import KnownDefs, SkipDefs, NetworkDef
 from DSFLib import readDSF
 from palette import PaletteEntry
 from prefs import Prefs
@@ -51,6 +51,8 @@ onedeg=1852*60	# 1 degree of longitude at equator (60nm) [m]
 f2m=0.3041	# 1 foot [m] (not accurate, but what X-Plane appears to use)
 
 GL_CLAMP_TO_EDGE=0x812F	# Not defined in PyOpenGL 2.x
+GL_TEXTURE_MAX_LEVEL=0x813D	# ditto
+GL_GENERATE_MIPMAP=0x8191
 
 # DDS surface flags
 DDSD_CAPS	= 0x00000001
@@ -70,6 +72,21 @@ DDSCAPS_COMPLEX	= 0x00000008
 DDSCAPS_TEXTURE	= 0x00001000
 DDSCAPS_MIPMAP	= 0x00400000
 
+# Returns [(offset, width, height, size)] of each surface in a DDS mipmap chain
+def ddslevels(offset, width, height, mipmaps, blocksize, compressed):
+    levels=[]
+    for i in range(max(1,mipmaps)):
+        if compressed:	# blocksize is bytes per 4x4 block
+            size=max(1,width/4)*max(1,height/4)*blocksize
+        else:		# blocksize is bytes per pixel
+            size=width*height*blocksize
+        levels.append((offset, width, height, size))
+        offset+=size
+        width=max(1,width/2)
+        height=max(1,height/2)
+    return levels
+
+
 # 2.3 version of case-insensitive sort
 # 2.4-only version is faster: sort(cmp=lambda x,y: cmp(x.lower(), y.lower()))
 def sortfolded(seq):
@@ -421,12 +438,107 @@ def readNet(filename):
     return defs
 
 
+# Terrain triangles of a tile, stored as arrays, with a uniform grid for fast point location.
+# pts:        N x 3 x 3 float32 triangle vertices
+# planes:     N x 4 (A,B,C,D) plane coefficients of each triangle
+# bboxes:     P x 4 (minx,maxx,minz,maxz) of each patch, whose triangles are pts[patchstart[p]:patchstart[p+1]]
+# tribboxes:  N x 4 (minx,maxx,minz,maxz) of each triangle
+# The triangles overlapping grid cell (i,j) are pts[index[start[k]:start[k+1]]] where k=j*nx+i
+# version:    distinguishes this from other MeshData built by the same VertexCache
+class MeshData:
+
+    def __init__(self, patches, density=2):
+        # patches is a list of vertex lists. density is the target number of triangles per grid cell
+        patches=[array(v, float64).reshape(-1,3,3) for v in patches if len(v)]
+        self.version=0
+        self.patchstart=cumsum([0]+[len(v) for v in patches])
+        self.bboxes=array([[v[:,:,0].min(), v[:,:,0].max(), v[:,:,2].min(), v[:,:,2].max()] for v in patches], float32).reshape(-1,4)
+        if patches:
+            pts=concatenate(patches)
+        else:
+            pts=zeros((0,3,3), float64)
+        n=len(pts)
+
+        # http://astronomy.swin.edu.au/~pbourke/geometry/planeline
+        (x,y,z)=(pts[:,:,0], pts[:,:,1], pts[:,:,2])
+        self.planes=planes=empty((n,4), float64)
+        planes[:,0] = y[:,0]*(z[:,1]-z[:,2]) + y[:,1]*(z[:,2]-z[:,0]) + y[:,2]*(z[:,0]-z[:,1]) # A
+        planes[:,1] = z[:,0]*(x[:,1]-x[:,2]) + z[:,1]*(x[:,2]-x[:,0]) + z[:,2]*(x[:,0]-x[:,1]) # B
+        planes[:,2] = x[:,0]*(y[:,1]-y[:,2]) + x[:,1]*(y[:,2]-y[:,0]) + x[:,2]*(y[:,0]-y[:,1]) # C
+        planes[:,3] = -(x[:,0]*(y[:,1]*z[:,2]-y[:,2]*z[:,1]) + x[:,1]*(y[:,2]*z[:,0]-y[:,0]*z[:,2]) + x[:,2]*(y[:,0]*z[:,1]-y[:,1]*z[:,0])) # D
+        self.pts=pts.astype(float32)
+        if n:
+            self.ymin=y.min()
+            self.ymax=y.max()
+        else:
+            self.ymin=self.ymax=0
+        self.tribboxes=array([x.min(axis=1), x.max(axis=1), z.min(axis=1), z.max(axis=1)], float32).T.reshape(-1,4)
+        if not n:
+            (self.x0, self.z0, self.cell, self.nx, self.nz)=(0, 0, 1.0, 0, 0)
+            self.start=zeros(1, int32)
+            self.index=zeros(0, int32)
+            return
+
+        (minx,maxx,minz,maxz)=(x.min(axis=1), x.max(axis=1), z.min(axis=1), z.max(axis=1))
+        self.x0=x0=minx.min()
+        self.z0=z0=minz.min()
+        # cell size chosen so that each cell holds ~density triangles
+        self.cell=cell=max(1.0, sqrt((maxx.max()-x0)*(maxz.max()-z0)*density/n))
+        self.nx=nx=int((maxx.max()-x0)/cell)+1
+        self.nz=nz=int((maxz.max()-z0)/cell)+1
+        ix0=((minx-x0)/cell).astype(int32)
+        iz0=((minz-z0)/cell).astype(int32)
+        w=minimum(((maxx-x0)/cell).astype(int32), nx-1)-ix0+1
+        h=minimum(((maxz-z0)/cell).astype(int32), nz-1)-iz0+1
+        # expand each triangle into the cells covered by its bounding box
+        counts=w*h
+        tri=repeat(arange(n, dtype=int32), counts)
+        k=arange(counts.sum(), dtype=int32)-repeat(cumsum(counts)-counts, counts)
+        w=repeat(w, counts)
+        cells=(repeat(iz0, counts)+k//w)*nx + repeat(ix0, counts)+k%w
+        order=argsort(cells, kind='mergesort')
+        self.start=searchsorted(cells[order], arange(nx*nz+1))
+        self.index=tri[order]
+
+    def __len__(self):
+        return len(self.pts)
+
+    def overlapping(self, bbox):
+        # returns N x 3 x 3 array of the triangles whose bounding boxes intersect bbox, found via the grid
+        if not len(self.pts): return self.pts
+        # widen by a cell since the grid was built from float64 extents and tribboxes are float32
+        i0=max(0, int(floor((bbox.minx-self.x0)/self.cell))-1)
+        i1=min(self.nx-1, int(floor((bbox.maxx-self.x0)/self.cell))+1)
+        j0=max(0, int(floor((bbox.minz-self.z0)/self.cell))-1)
+        j1=min(self.nz-1, int(floor((bbox.maxz-self.z0)/self.cell))+1)
+        if i0>i1 or j0>j1: return self.pts[:0]
+        # cells in a row are consecutive in index
+        tris=unique(concatenate([self.index[self.start[j*self.nx+i0]:self.start[j*self.nx+i1+1]] for j in range(j0,j1+1)]))
+        t=self.tribboxes[tris]
+        return self.pts[tris[(bbox.minx<=t[:,1]) & (bbox.maxx>t[:,0]) & (bbox.minz<=t[:,3]) & (bbox.maxz>t[:,2])]]
+
+    def candidates(self, bbox):
+        # returns [[p0,p1,p2]] of the triangles whose bounding boxes intersect bbox, eg for tessellation
+        return self.overlapping(bbox).tolist()
+
+    def cellof(self, xs, zs):
+        # returns (first, count) of candidate triangles in index for each (x,z)
+        i=floor((xs-self.x0)/self.cell).astype(int32)
+        j=floor((zs-self.z0)/self.cell).astype(int32)
+        ncells=self.nx*self.nz
+        k=where((i>=0) & (i<self.nx) & (j>=0) & (j<self.nz), j*self.nx+i, ncells)	# outside grid -> empty
+        first=self.start[minimum(k,ncells)]
+        return (first, self.start[minimum(k+1,ncells)]-first)
+
 class TexCache:
     
     def __init__(self):
         self.blank=0	#self.get(join('Resources','blank.png'))
         self.texs={}
         self.terraintexs=[]	# terrain textures will not be reloaded
+        self.terrainlevel=2	# mipmap level used as the base of terrain textures
+        self.atlases=[]		# [[id, shelves, top, last]] where shelf=[y, height, right] and last is the last cell added
+        self.atlased={}		# path -> (id, u, v, uscale, vscale) of textures packed into an atlas
         # Must be after init
         self.maxtexsize=glGetIntegerv(GL_MAX_TEXTURE_SIZE)
         self.npot=glInitTextureNonPowerOfTwoARB()
@@ -437,8 +549,18 @@ class TexCache:
         if self.compress: glHint(GL_TEXTURE_COMPRESSION_HINT_ARB, GL_NICEST)
         if glGetString(GL_VERSION) >= '1.2':
             self.clampmode=GL_CLAMP_TO_EDGE
+            self.mipmap=True	# can limit levels, so can use partial DDS mipmap chains
         else:
             self.clampmode=GL_CLAMP
+            self.mipmap=False
+        self.genmipmap=glGetString(GL_VERSION) >= '1.4'	# can get the GPU to generate mipmaps
+        # Small object textures are packed into shared pages. Set atlassize=0 to disable.
+        self.atlassize=min(1024, self.maxtexsize)
+        self.atlasmax=self.atlassize/4	# largest texture that will be packed
+        # Packed textures are surrounded by a gutter of repeated edge texels and placed on a grid
+        # of the gutter's width, so that mipmap levels down to log2(gutter) don't bleed.
+        self.atlasgutter=4
+        self.atlaslevels=2
 
     def reset(self):
         if cantreleasetexs:
@@ -450,16 +572,129 @@ class TexCache:
                 if self.texs[name] not in self.terraintexs:
                     a.append(self.texs[name])
                     self.texs.pop(name)
+            a.extend([page[0] for page in self.atlases])
+            self.atlases=[]
+            self.atlased={}
             if a:
                 glDeleteTextures(a)
 
+    def setquality(self, options):
+        # Choose base level of terrain textures. Returns True if changed.
+        if options&Prefs.TEXHIGH:
+            level=0
+        elif options&Prefs.TEXMEDIUM:
+            level=1
+        else:
+            level=2	# quarter size
+        if level==self.terrainlevel: return False
+        self.terrainlevel=level
+        # terrain textures must be reloaded at the new level
+        a=[]
+        for name in self.texs.keys():
+            if self.texs[name] in self.terraintexs:
+                a.append(self.texs.pop(name))
+        self.terraintexs=[]
+        if a and not cantreleasetexs:
+            glDeleteTextures(a)
+        return True
+
+    def getatlas(self, path):
+        # Pack a small texture into a shared atlas page, for objects that don't rely on wrapping.
+        # Returns (id, u, v, uscale, vscale) or None if the texture isn't suitable.
+        if path in self.atlased: return self.atlased[path]
+        if not self.atlassize or path in self.texs: return None
+        if __debug__: clock=time.clock()	# Processor time
+
+        # same search order as get()
+        (base,oldext)=splitext(path)
+        for ext in ['.png', '.PNG', '.dds', '.DDS']:
+            if exists(base+ext): break
+            else: ext=oldext
+        if ext.lower()=='.dds': return None	# leave compressed textures alone
+
+        try:
+            image = PIL.Image.open(base+ext)
+            (width,height)=image.size
+            if width>self.atlasmax or height>self.atlasmax: return None
+            for dim in [width,height]:
+                l=log(dim,2)
+                if l!=int(l): return None
+            if image.mode!='RGBA':
+                image=image.convert('RGBA')
+            data = image.tostring("raw", 'RGBA')
+        except:
+            return None	# get() will report the error
+
+        # surround with a gutter of repeated edge texels, and round up to the grid
+        g=self.atlasgutter
+        (cellwidth, cellheight)=(-(-(width+2*g)/g)*g, -(-(height+2*g)/g)*g)
+        data=pad(frombuffer(data, uint8).reshape(height, width, 4), ((g,cellheight-height-g),(g,cellwidth-width-g),(0,0)), 'edge')
+        if OpenGL.__version__ < '3':
+            data=data.tostring()
+        for page in self.atlases:
+            pos=self.atlaspack(page, cellwidth, cellheight)
+            if pos: break
+        else:
+            page=[glGenTextures(1), [], 0, None]
+            glBindTexture(GL_TEXTURE_2D, page[0])
+            glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_S,self.clampmode)
+            glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_T,self.clampmode)
+            if self.mipmap and self.genmipmap:
+                # generated by realize() once a batch of textures has been added
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, self.atlaslevels)
+            else:
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            # Not compressed - can't reliably sub-image into a compressed texture - so a page takes 4MB
+            # (5.3MB with mipmaps) even where the textures it holds would otherwise have been compressed.
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.atlassize, self.atlassize, 0, GL_RGBA, GL_UNSIGNED_BYTE, '\0'*(self.atlassize*self.atlassize*4))
+            self.atlases.append(page)
+            pos=self.atlaspack(page, cellwidth, cellheight)
+        (x,y)=pos
+        glBindTexture(GL_TEXTURE_2D, page[0])
+        glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, cellwidth, cellheight, GL_RGBA, GL_UNSIGNED_BYTE, data)
+        if self.mipmap and self.genmipmap:
+            page[3]=(x, y, cellwidth, cellheight, data)	# mipmaps are now stale
+        size=float(self.atlassize)
+        self.atlased[path]=(page[0], (x+g)/size, (y+g)/size, width/size, height/size)
+        if __debug__: print "%6.3f atlas %d at %d,%d" % (time.clock()-clock, self.atlases.index(page), x, y), basename(path)
+        return self.atlased[path]
+
+    def realize(self):
+        # need to call this before drawing atlased textures.
+        # Regenerates the mipmaps of pages that have changed, once rather than after each texture is added.
+        for page in self.atlases:
+            if page[3]:
+                (x, y, width, height, data)=page[3]
+                glBindTexture(GL_TEXTURE_2D, page[0])
+                glTexParameteri(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
+                glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, width, height, GL_RGBA, GL_UNSIGNED_BYTE, data)	# triggers generation
+                glTexParameteri(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_FALSE)
+                page[3]=None
+
+    def atlaspack(self, page, width, height):
+        # Shelf packer. Textures of the same size mean shelves of the same height fill without waste.
+        # Returns (x,y) or None if no room in this page.
+        for shelf in page[1]:
+            if shelf[1]==height and shelf[2]+width<=self.atlassize:
+                x=shelf[2]
+                shelf[2]+=width
+                return (x, shelf[0])
+        if page[2]+height<=self.atlassize:
+            y=page[2]
+            page[1].append([y, height, width])
+            page[2]+=height
+            return (0, y)
+        return None
+
     def get(self, path, wrap=True, alpha=True, downsample=False, fixsize=False):
         if not path: return self.blank
         if path in self.texs:
             return self.texs[path]
         #self.texs[path]=self.blank	# don't do this - want error reported for each file that uses this texture
 
-        #if __debug__: clock=time.clock()	# Processor time
+        if __debug__: clock=time.clock()	# Processor time
 
         # X-Plane 10 will load dds or png depending on user's compression settings.
         # We will prefer dds if the texture is to be downsampled (terrain), otherwise png (objects).
@@ -473,6 +708,7 @@ class TexCache:
                 if exists(base+ext): break
                 else: ext=oldext
 
+        h=surface=None
         try:
             if ext.lower()=='.dds':
                 # Do DDS manually - files need flipping
@@ -494,6 +730,9 @@ class TexCache:
                 (psize,pflags,fourcc,bits,redmask,greenmask,bluemask,alphamask,caps1,caps2)=unpack('<2I4s7I', h.read(40))
                 if not sflags&DDSD_MIPMAPCOUNT or not caps1&DDSCAPS_MIPMAP:
                     mipmaps=0
+                # Map the surfaces rather than reading them
+                surface=mmap(h.fileno(), 0, access=ACCESS_READ)
+                h.close()
 
                 if pflags&DDPF_FOURCC:
                     # http://oss.sgi.com/projects/ogl-sample/registry/EXT/texture_compression_s3tc.txt
@@ -504,60 +743,26 @@ class TexCache:
                         else:
                             assert size==width*height/2
                         iformat=GL_COMPRESSED_RGBA_S3TC_DXT1_EXT
+                        blocksize=8
                     elif fourcc=='DXT3':
                         if not (sflags&(DDSD_PITCH|DDSD_LINEARSIZE)):
                             size=width*height
                         else:
                             assert size==width*height
                         iformat=GL_COMPRESSED_RGBA_S3TC_DXT3_EXT
+                        blocksize=16
                     elif fourcc=='DXT5':
                         if not (sflags&(DDSD_PITCH|DDSD_LINEARSIZE)):
                             size=width*height
                         else:
                             assert size==width*height
                         iformat=GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
+                        blocksize=16
                     else:
                         raise IOError, '%s format not supported' % fourcc
-
-                    if downsample and mipmaps>=2 and width>=16 and height>=16:
-                        h.seek(4+ssize + (size*5)/4)
-                        size/=16
-                        width/=4
-                        height/=4
-                    else:	# don't downsample
-                        h.seek(4+ssize)
-                    if not alpha:	# discard alpha
-                        if iformat==GL_COMPRESSED_RGBA_S3TC_DXT1_EXT:
-                            data=h.read(size)
-                        else:
-                            data=''
-                            for i in range(size/16):
-                                data+=h.read(16)[8:]	# skip alpha
-                        iformat=GL_COMPRESSED_RGB_S3TC_DXT1_EXT
-                    else:
-                        data=h.read(size)
-                    h.close()
-                        
-                    id=glGenTextures(1)
-                    glBindTexture(GL_TEXTURE_2D, id)
-                    if wrap:
-                        glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_S,GL_REPEAT)
-                        glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_T,GL_REPEAT)
-                    else:
-                        glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_S,self.clampmode)
-                        glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_T,self.clampmode)
-                    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-                    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-                    if OpenGL.__version__ < '3':
-                        glCompressedTexImage2DARB(GL_TEXTURE_2D, 0, iformat, width, height, 0, data)
-                    else:
-                        glCompressedTexImage2DARB(GL_TEXTURE_2D, 0, iformat, width, height, 0, len(data), data)
-                    #if __debug__: print "%6.3f" % (time.clock()-clock), basename(path), wrap, alpha, downsample, fixsize
-
-                    self.texs[path]=id
-                    if downsample:
-                        self.terraintexs.append(id)
-                    return id
+                    compressed=True
+                    format=None
+                    chain=ddslevels(4+ssize, width, height, mipmaps, blocksize, True)
                     
                 elif pflags&DDPF_RGB:	# uncompressed
                     assert size==width*height*bits/8	# pitch appears unreliable
@@ -574,26 +779,35 @@ class TexCache:
                         iformat=GL_RGBA
                     elif bits==32 and not pflags&DDPF_ALPHAPIXELS and redmask==0x00ff0000 and greenmask==0x0000ff00 and bluemask==0x000000ff:
                         if not self.bgra: raise IOError, 'This video driver does not support BGRA format'
-                        format_GL_BGRA_EXT
+                        format=GL_BGRA_EXT
                         iformat=GL_RGB
                     else:
                         raise IOError, '%dbpp format not supported' % bits
-
-                    if downsample and mipmaps>=2 and width>4 and height>4:
-                        h.seek(4+ssize + (size*5)/4)
-                        size/=16
-                        width/=4
-                        height/=4
-                    else:	# don't downsample
-                        h.seek(4+ssize)
-                    data=h.read(size)
-                    h.close()
-                    
-                    # fall through
+                    compressed=False
+                    chain=ddslevels(4+ssize, width, height, mipmaps, bits/8, False)
 
                 else:	# wtf?
                     raise IOError, 'Invalid compression type'
 
+                if downsample:
+                    # Skip the finest levels, but don't go below one 4x4 block
+                    first=min(self.terrainlevel, len(chain)-1)
+                    while first and (chain[first][1]<4 or chain[first][2]<4):
+                        first-=1
+                    chain=chain[first:]
+                if not self.mipmap:
+                    chain=chain[:1]
+                if chain[-1][0]+chain[-1][3]>len(surface): raise IOError, 'This DDS file is truncated'
+                levels=[]
+                for (offset,width,height,size) in chain:
+                    data=frombuffer(surface, uint8, size, offset)
+                    if compressed and not alpha and iformat!=GL_COMPRESSED_RGBA_S3TC_DXT1_EXT:
+                        # DXT3/5 blocks are 8 bytes alpha followed by 8 bytes DXT1-style colour
+                        data=ascontiguousarray(data.reshape(-1,16)[:,8:]).reshape(-1)
+                    levels.append((width, height, data))
+                if compressed and not alpha:
+                    iformat=GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+
             else:	# supported PIL formats
                 image = PIL.Image.open(base+ext)
                 size=[image.size[0],image.size[1]]
@@ -608,8 +822,14 @@ class TexCache:
                         elif not self.npot:
                             image=image.resize((size[0], size[1]), PIL.Image.BICUBIC)
 
-                if downsample and image.size[0]>4 and image.size[1]>4:
-                    image=image.resize((image.size[0]/4,image.size[1]/4), PIL.Image.NEAREST)
+                if downsample:
+                    # Skip the finest levels, but don't go below 4x4. GL only generates mipmaps
+                    # from the base level, so shrink level 0 rather than setting the base level.
+                    level=self.terrainlevel
+                    while level and (image.size[0]>>level<4 or image.size[1]>>level<4):
+                        level-=1
+                    if level:
+                        image=image.resize((image.size[0]>>level,image.size[1]>>level), PIL.Image.NEAREST)
                 
                 if image.mode=='RGBA':
                     data = image.tostring("raw", 'RGBA')
@@ -625,17 +845,18 @@ class TexCache:
                     image=image.convert('RGB')
                     data = image.tostring("raw", 'RGB')
                     format=iformat=GL_RGB
-                width=image.size[0]
-                height=image.size[1]
-
-            # variables used: data, format, iformat, width, height
-            if not alpha:	# Discard alpha
-                iformat=GL_RGB
-            if self.compress:
-                if iformat==GL_RGB:
-                    iformat=GL_COMPRESSED_RGB_ARB
-                elif iformat==GL_RGBA:
-                    iformat=GL_COMPRESSED_RGBA_ARB                        
+                compressed=False
+                levels=[(image.size[0], image.size[1], data)]
+
+            # variables used: levels, compressed, format, iformat
+            if not compressed:
+                if not alpha:	# Discard alpha
+                    iformat=GL_RGB
+                if self.compress:
+                    if iformat==GL_RGB:
+                        iformat=GL_COMPRESSED_RGB_ARB
+                    elif iformat==GL_RGBA:
+                        iformat=GL_COMPRESSED_RGBA_ARB                        
 
             id=glGenTextures(1)
             glBindTexture(GL_TEXTURE_2D, id)
@@ -645,10 +866,33 @@ class TexCache:
             else:
                 glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_S,self.clampmode)
                 glTexParameteri(GL_TEXTURE_2D,GL_TEXTURE_WRAP_T,self.clampmode)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            generate=self.mipmap and self.genmipmap and len(levels)==1
+            if len(levels)>1:	# supplied mipmap chain - may stop short of 1x1
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(levels)-1)
+            elif generate:
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+                glTexParameteri(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
+            else:
+                glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
             glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-            glTexImage2D(GL_TEXTURE_2D, 0, iformat, width, height, 0, format, GL_UNSIGNED_BYTE, data)
-            #if __debug__: print "%6.3f" % (time.clock()-clock), basename(path), wrap, alpha, downsample, fixsize
+            uploaded=0
+            nlevels=len(levels)
+            for level in range(nlevels):
+                (width, height, data)=levels[level]
+                if compressed:
+                    if OpenGL.__version__ < '3':
+                        glCompressedTexImage2DARB(GL_TEXTURE_2D, level, iformat, width, height, 0, data.tostring())
+                    else:
+                        glCompressedTexImage2DARB(GL_TEXTURE_2D, level, iformat, width, height, 0, len(data), data)
+                else:
+                    if OpenGL.__version__ < '3' and not isinstance(data, str):
+                        data=data.tostring()
+                    glTexImage2D(GL_TEXTURE_2D, level, iformat, width, height, 0, format, GL_UNSIGNED_BYTE, data)
+                uploaded+=len(data)
+            if __debug__:
+                if generate: print "%6.3f %6dkB (%6dkB with mipmaps)" % (time.clock()-clock, uploaded/1024, uploaded/768), basename(path)
+                else: print "%6.3f %6dkB (%d levels)" % (time.clock()-clock, uploaded/1024, nlevels), basename(path)
                 
             self.texs[path]=id
             if downsample:
@@ -674,6 +918,11 @@ class TexCache:
                 print "%s unknown error" % basename(path)
                 print_exc()
             raise IOError, (0, 'unknown error')
+        finally:
+            if h: h.close()
+            if surface:
+                levels=data=None	# release views before unmapping
+                surface.close()
 
 
 class VertexCache:
@@ -681,20 +930,26 @@ class VertexCache:
     def __init__(self):
         self.ter={}		# name -> physical ter
         self.mesh={}		# tile -> [patches] where patch=(texture,f,v,t)
-        self.meshdata={}	# tile -> [(bbox, [(points, plane coeffs)])]
+        self.meshsources={}	# tile -> (DSF filename, mtime) that mesh was read from, or None
+        self.meshdata={}	# tile -> MeshData
+        self.meshversion=0	# version of the last MeshData built
         self.nets={}		# tile -> [(type, [points])]
         self.currenttile=None
         self.meshcache=[]	# [indices] of current tile
-        self.lasttri=None	# take advantage of locality of reference
 
         self.texcache=TexCache()
-        self.varray=[]
-        self.tarray=[]
+        self.arena=empty((65536,5), float32)	# interleaved GL_T2F_V3F vertex data
+        self.count=0		# number of vertices in use in arena
         self.valid=False
         self.dsfdirs=None	# [custom, global, default]
 
-        self.vbo=False # XXX (OpenGL.__version__ >= '3') and glInitVertexBufferObjectARB()
+        self.vbo=(OpenGL.__version__ >= '3') and glInitVertexBufferObjectARB()
         self.vertexbuf=0
+        self.bufsize=0		# capacity of vertexbuf [vertices]
+        self.dirtylo=maxint	# range of arena that has changed since last realize
+        self.dirtyhi=0
+        self.uploaded=0		# total bytes sent to OpenGL, for profiling
+        self.lastupload=0	# bytes sent by last realize
 
     def reset(self, terrain, dsfdirs):
         # invalidate geometry and textures
@@ -707,54 +962,79 @@ class VertexCache:
         # invalidate array indices
         self.currenttile=None
         self.meshcache=[]
-        self.varray=[]
-        self.tarray=[]
+        self.count=0	# keep arena's capacity for the next tile
+        self.dirtylo=maxint
+        self.dirtyhi=0
         self.valid=False
-        self.lasttri=None
 
     def realize(self, canvas):
         # need to call this before drawing
         if not self.valid:
-            if __debug__: clock=time.clock()	# Processor time
             if wx.VERSION >= (2,9):
                 canvas.SetCurrent(canvas.context)
+            self.texcache.realize()	# atlased textures are only added along with their geometry
+            self.lastupload=0
             if self.vbo:
-                # PyOpenGL 3b8 with numpy - broken
-                if not self.vertexbuf:
-                    from OpenGL.arrays import vbo
-                    assert vbo.get_implementation()
-                    self.vertexbuf=vbo.VBO(hstack((array(self.tarray, float32), array(self.varray, float32))).flatten())
-                    if __debug__: print "VBOs enabled! %s" % self.vertexbuf
-                self.vertexbuf.bind()
-                glInterleavedArrays(GL_T2F_V3F, 0, self.vertexbuf)
-            elif False:
-                # PyOpenGL 3b6 with numpy - also broken
-                if not self.vertexbuf:
-                    self.vertexbuf=long(glGenBuffersARB(1))
-                    if __debug__: print "VBOs enabled! %s" % self.vertexbuf
-                glBindBufferARB(GL_ARRAY_BUFFER_ARB, self.vertexbuf)
-                glBufferDataARB(GL_ARRAY_BUFFER_ARB, hstack((array(self.tarray, float32), array(self.varray, float32))).flatten(), GL_STATIC_DRAW_ARB)
-                glInterleavedArrays(GL_T2F_V3F, 0, None)
-            elif self.varray:
-                #glInterleavedArrays(GL_T2F_V3F, 0, hstack((array(self.tarray, float32), array(self.varray, float32))).flatten())	# XXX requires numpy
-                glVertexPointerf(self.varray)
-                glTexCoordPointerf(self.tarray)
-            else:	# need something or get conversion error
-                if __debug__: print "Empty arrays!"
-                glVertexPointerf([[0,0,0]])
-                glTexCoordPointerf([[0,0]])
-            if __debug__:
-                print "%6.3f time to realize arrays" % (time.clock()-clock)
+                try:
+                    if not self.vertexbuf:
+                        self.vertexbuf=long(glGenBuffersARB(1))
+                    glBindBufferARB(GL_ARRAY_BUFFER_ARB, self.vertexbuf)
+                    if not self.bufsize or self.count>self.bufsize:
+                        # (re)allocate with the arena's spare capacity so that later additions fit
+                        glBufferDataARB(GL_ARRAY_BUFFER_ARB, self.arena, GL_STATIC_DRAW_ARB)
+                        self.bufsize=len(self.arena)
+                        self.lastupload=self.arena.nbytes
+                    elif self.dirtylo<self.dirtyhi:
+                        # just the range that has changed
+                        glBufferSubDataARB(GL_ARRAY_BUFFER_ARB, self.dirtylo*self.arena.itemsize*5, (self.dirtyhi-self.dirtylo)*self.arena.itemsize*5, self.arena[self.dirtylo:self.dirtyhi])
+                        self.lastupload=(self.dirtyhi-self.dirtylo)*self.arena.itemsize*5
+                    glInterleavedArrays(GL_T2F_V3F, 0, None)
+                except:
+                    if __debug__:
+                        print "VBOs disabled"
+                        print_exc()
+                    self.vbo=False
+                    glBindBufferARB(GL_ARRAY_BUFFER_ARB, 0)
+            if not self.vbo:	# client-side arrays
+                if OpenGL.__version__ < '3':
+                    glInterleavedArrays(GL_T2F_V3F, 0, self.arena[:max(1,self.count)].tostring())
+                else:
+                    glInterleavedArrays(GL_T2F_V3F, 0, self.arena)
+                self.lastupload=self.count*self.arena.itemsize*5	# copied by OpenGL on each draw
+            self.uploaded+=self.lastupload
+            self.dirtylo=maxint
+            self.dirtyhi=0
             self.valid=True
 
     def allocate(self, vdata, tdata):
         # allocate geometry data into cache, but don't update OpenGL arrays
-        base=len(self.varray)
-        self.varray.extend(vdata)
-        self.tarray.extend(tdata)
+        base=self.count
+        n=len(vdata)
+        if base+n>len(self.arena):
+            # grow geometrically
+            arena=empty((max(2*len(self.arena), base+n),5), float32)
+            arena[:base]=self.arena[:base]
+            self.arena=arena
+        if n:
+            self.arena[base:base+n,:2]=tdata
+            self.arena[base:base+n,2:]=vdata
+        self.count=base+n
+        self.dirtylo=min(self.dirtylo, base)
+        self.dirtyhi=max(self.dirtyhi, base+n)
         self.valid=False	# new geometry -> need to update OpenGL
         return base
 
+    def update(self, base, vdata, tdata):
+        # overwrite geometry previously allocated at base
+        n=len(vdata)
+        assert base+n<=self.count
+        if n:
+            self.arena[base:base+n,:2]=tdata
+            self.arena[base:base+n,2:]=vdata
+        self.dirtylo=min(self.dirtylo, base)
+        self.dirtyhi=max(self.dirtyhi, base+n)
+        self.valid=False	# changed geometry -> need to update OpenGL
+
     def loadMesh(self, tile, options):
         key=(tile[0],tile[1],options&Prefs.TERRAIN)
         netkey=(tile[0],tile[1],options&Prefs.NETWORK)
@@ -778,6 +1058,7 @@ class VertexCache:
                 (lat, lon, placements, nets, mesh)=readDSF(dsf, False, options&Prefs.NETWORK, self.ter)
                 if mesh:
                     self.mesh[key]=mesh
+                    self.meshsources[key]=(dsf, getmtime(dsf))
                     # post-process networks
                     centrelat=lat+0.5
                     centrelon=lon+0.5
@@ -812,6 +1093,11 @@ class VertexCache:
                               [0, 0], [100, 0], [100, 100]])]
             self.nets[(tile[0],tile[1],0)]=[] # prevents reload on stepping down
             self.nets[(tile[0],tile[1],Prefs.NETWORK)]=[]
+            self.meshsources[key]=None
+
+    def meshsource(self, tile, options):
+        # identifies the terrain of a tile loaded by loadMesh
+        return self.meshsources.get((tile[0],tile[1],options&Prefs.TERRAIN))
 
     # return mesh data sorted by tex for drawing
     def getMesh(self, tile, options):
@@ -828,10 +1114,9 @@ class VertexCache:
                 bytex[(texture,flags)]=(list(v), list(t))
         # add into array
         if __debug__: clock=time.clock()	# Processor time
+        self.texcache.setquality(options)
         for (texture, flags), (v, t) in bytex.iteritems():
-            base=len(self.varray)
-            self.varray.extend(v)
-            self.tarray.extend(t)
+            base=self.allocate(v, t)
             texno=self.texcache.get(texture, flags&8, False, flags&1)
             self.meshcache.append((base, len(v), texno, flags&2))
         if __debug__: print "%6.3f time in getMesh" % (time.clock()-clock)
@@ -845,69 +1130,42 @@ class VertexCache:
         return self.nets[(tile[0],tile[1],options&Prefs.NETWORK)]
 
 
-    # create sets of bounding boxes for height testing
+    # create arrays of terrain triangles for height testing
     def getMeshdata(self, tile, options):
-        if not options&Prefs.ELEVATION:
-            mlat=max(abs(tile[0]),abs(tile[0]+1))
-            return [(BBox(-onedeg*cos(radians(mlat))/2, onedeg*cos(radians(mlat))/2, -onedeg/2,onedeg/2),
-                     [([[-onedeg*cos(radians(tile[0]+1))/2, 0,-onedeg/2],
-                        [ onedeg*cos(radians(tile[0]  ))/2, 0, onedeg/2],
-                        [-onedeg*cos(radians(tile[0]  ))/2, 0, onedeg/2]],
-                       [0,0,0,0]),
-                      ([[-onedeg*cos(radians(tile[0]+1))/2, 0,-onedeg/2],
-                        [ onedeg*cos(radians(tile[0]+1))/2, 0,-onedeg/2],
-                        [ onedeg*cos(radians(tile[0]  ))/2, 0, onedeg/2]],
-                       [0,0,0,0])])]
         key=(tile[0],tile[1],options&Prefs.ELEVATION)
         if key in self.meshdata:
             return self.meshdata[key]	# don't reload
-        meshdata=[]
-        tot=0
         if __debug__: clock=time.clock()	# Processor time
-        for (texture, flags, v, t) in self.mesh[(tile[0],tile[1],options&Prefs.TERRAIN)]:
-            if not flags&1: continue	# not interested in overlays
-            minx=minz=maxint
-            maxx=maxz=-maxint
-            tris=[]
-            for i in range(0,len(v),3):
-                minx=min(minx, v[i][0], v[i+1][0], v[i+2][0])
-                maxx=max(maxx, v[i][0], v[i+1][0], v[i+2][0])
-                minz=min(minz, v[i][2], v[i+1][2], v[i+2][2])
-                maxz=max(maxz, v[i][2], v[i+1][2], v[i+2][2])
-                tris.append(([v[i], v[i+1], v[i+2]], [0,0,0,0]))
-            meshdata.append((BBox(minx, maxx, minz, maxz), tris))
-            tot+=len(tris)
-        if __debug__: print "%6.3f time in getMeshdata" % (time.clock()-clock)
-        #print len(meshdata), "patches,", tot, "tris,", tot/len(meshdata), "av"
+        if not options&Prefs.ELEVATION:
+            meshdata=MeshData([[[-onedeg*cos(radians(tile[0]+1))/2, 0,-onedeg/2],
+                                [ onedeg*cos(radians(tile[0]  ))/2, 0, onedeg/2],
+                                [-onedeg*cos(radians(tile[0]  ))/2, 0, onedeg/2],
+                                [-onedeg*cos(radians(tile[0]+1))/2, 0,-onedeg/2],
+                                [ onedeg*cos(radians(tile[0]+1))/2, 0,-onedeg/2],
+                                [ onedeg*cos(radians(tile[0]  ))/2, 0, onedeg/2]]])
+        else:
+            # not interested in overlays
+            meshdata=MeshData([v for (texture, flags, v, t) in self.mesh[(tile[0],tile[1],options&Prefs.TERRAIN)] if flags&1])
+        if __debug__:
+            print "%6.3f time in getMeshdata" % (time.clock()-clock)
+            if len(meshdata): print "%d tris, %dkB, %dx%d grid, %.1f tris/cell" % (len(meshdata), (meshdata.pts.nbytes+meshdata.planes.nbytes+meshdata.tribboxes.nbytes+meshdata.index.nbytes+meshdata.start.nbytes)/1024, meshdata.nx, meshdata.nz, len(meshdata.index)/float(meshdata.nx*meshdata.nz))
+        self.meshversion+=1
+        meshdata.version=self.meshversion
         self.meshdata[key]=meshdata
         return meshdata
             
 
-    def height(self, tile, options, x, z, likely=[]):
-        # returns height of mesh at (x,z) using tri if supplied
+    def height(self, tile, options, x, z):
+        # returns height of mesh at (x,z)
         if not options&Prefs.ELEVATION: return 0
-
-        # first test candidates
-        if likely:
-            h=self.heighttest(likely, x, z)
-            if h!=None: return h
-        if self.lasttri and (self.lasttri not in likely):
-            h=self.heighttest([self.lasttri], x, z)
-            if h!=None: return h
-
-        # test all patches then
-        for (bbox, tris) in self.getMeshdata(tile,options):
-            if not bbox.inside(x,z): continue
-            h=self.heighttest(tris, x, z)
-            if h!=None: return h
-        
-        # dunno
-        return 0
-
-    def heighttest(self, tris, x, z):
-        # helper for above
-        for tri in tris:
-            (pt, coeffs)=tri
+        meshdata=self.getMeshdata(tile, options)
+        if x<meshdata.x0 or z<meshdata.z0: return 0
+        i=int((x-meshdata.x0)/meshdata.cell)
+        j=int((z-meshdata.z0)/meshdata.cell)
+        if i>=meshdata.nx or j>=meshdata.nz: return 0
+        k=j*meshdata.nx+i
+        candidates=meshdata.index[meshdata.start[k]:meshdata.start[k+1]]
+        for (t,pt) in zip(candidates.tolist(), meshdata.pts[candidates].tolist()):
             # http://astronomy.swin.edu.au/~pbourke/geometry/insidepoly
             c=False
             for i in range(3):
@@ -917,16 +1175,74 @@ class VertexCache:
                     (x < (pt[j][0]-pt[i][0]) * (z - pt[i][2]) / (pt[j][2] - pt[i][2]) + pt[i][0])):
                     c = not c
             if c:
-                self.lasttri=tri
-                # http://astronomy.swin.edu.au/~pbourke/geometry/planeline
-                if not coeffs[3]:
-                    coeffs[0] = pt[0][1]*(pt[1][2]-pt[2][2]) + pt[1][1]*(pt[2][2]-pt[0][2]) + pt[2][1]*(pt[0][2]-pt[1][2]) # A
-                    coeffs[1] = pt[0][2]*(pt[1][0]-pt[2][0]) + pt[1][2]*(pt[2][0]-pt[0][0]) + pt[2][2]*(pt[0][0]-pt[1][0]) # B
-                    coeffs[2] = pt[0][0]*(pt[1][1]-pt[2][1]) + pt[1][0]*(pt[2][1]-pt[0][1]) + pt[2][0]*(pt[0][1]-pt[1][1]) # C
-                    coeffs[3] = -(pt[0][0]*(pt[1][1]*pt[2][2]-pt[2][1]*pt[1][2]) + pt[1][0]*(pt[2][1]*pt[0][2]-pt[0][1]*pt[2][2]) + pt[2][0]*(pt[0][1]*pt[1][2]-pt[1][1]*pt[0][2])) # D
-                return -(coeffs[0]*x + coeffs[2]*z + coeffs[3]) / coeffs[1]
-        # no hit
-        return None
+                (a,b,c,d)=meshdata.planes[t].tolist()
+                return -(a*x + c*z + d) / b
+        
+        # dunno
+        return 0
+
+    def heights(self, tile, options, xs, zs, default=0):
+        # returns array of heights of mesh at each (x,z) - vectorized version of height()
+        # points not on the mesh get the default height
+        xs=asarray(xs, float64)
+        zs=asarray(zs, float64)
+        ys=zeros(len(xs), float64)
+        ys[:]=default
+        if not len(xs): return ys
+        meshdata=self.getMeshdata(tile, options)	# flat if not options&Prefs.ELEVATION
+        (first, count)=meshdata.cellof(xs, zs)
+
+        # Test the n-th candidate of each point that hasn't been resolved yet
+        todo=arange(len(xs))[count>0]
+        n=0
+        while len(todo):
+            t=meshdata.index[first[todo]+n]
+            x=xs[todo]
+            z=zs[todo]
+            pt=meshdata.pts[t]
+            # http://astronomy.swin.edu.au/~pbourke/geometry/insidepoly
+            c=zeros(len(todo), bool)
+            for e in range(3):
+                (xi,zi)=(pt[:,e,0], pt[:,e,2])
+                (xj,zj)=(pt[:,(e+1)%3,0], pt[:,(e+1)%3,2])
+                crosses=((zi<=z) & (z<zj)) | ((zj<=z) & (z<zi))
+                c^=crosses & (x < (xj-xi) * (z-zi) / where(crosses, zj-zi, 1) + xi)
+            coeffs=meshdata.planes[t[c]]
+            ys[todo[c]]=-(coeffs[:,0]*x[c] + coeffs[:,2]*z[c] + coeffs[:,3]) / coeffs[:,1]
+            n+=1
+            todo=todo[~c & (count[todo]>n)]
+        return ys
+
+    def raycast(self, tile, options, origin, direction):
+        # returns the first intersection (x,y,z) of a downward ray with the mesh, or None if it misses
+        (ox,oy,oz)=origin
+        (dx,dy,dz)=direction
+        meshdata=self.getMeshdata(tile, options)
+        if not len(meshdata) or dy>=0: return None
+        # only need to consider the part of the ray within the mesh's height range
+        ttop=(meshdata.ymax-oy)/dy
+        tbot=(meshdata.ymin-oy)/dy
+        # sample at half the grid spacing so that we don't step over a cell
+        n=min(4096, int((tbot-ttop)*hypot(dx,dz)*2/meshdata.cell)+2)
+        for i in range(2):	# coarse, then refine within the first interval found
+            ts=linspace(ttop, tbot, n)
+            hs=self.heights(tile, options, ox+ts*dx, oz+ts*dz, -inf)
+            below=(oy+ts*dy <= hs).nonzero()[0]	# misses are at -inf, so don't count
+            if not len(below): return None
+            j=below[0]
+            if not j:
+                t=ts[0]
+                break
+            (ttop,tbot)=(ts[j-1],ts[j])
+            n=64
+        else:
+            # interpolate between last sample above and first below, if both on the mesh
+            if hs[j-1]!=-inf:
+                (above,under)=(oy+ttop*dy-hs[j-1], oy+tbot*dy-hs[j])
+                t=ttop+(tbot-ttop)*above/(above-under)
+            else:
+                t=tbot
+        return (ox+t*dx, oy+t*dy, oz+t*dz)
         
 
 
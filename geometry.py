@@ -0,0 +1,406 @@
+# Planar geometry helpers that don't need an OpenGL context.
+#
+# Points are (x,z) or (x,y,z) tuples - only the first and last coordinates are used,
+# ie these work on the ground plane of world space or on (lon,lat).
+
+from numpy import arange, argsort, array, asarray, bincount, ceil, clip, concatenate, cross, cumsum, empty, hypot, inf, lexsort, maximum, minimum, newaxis, repeat, roll, searchsorted, sign, sqrt, where, zeros, float64, int32
+
+
+def area2(winding):
+    # returns twice the signed area of a closed winding. Positive if CCW in (x,z) with z up
+    n=len(winding)
+    a=0
+    for j in range(n):
+        a+=winding[j][0]*winding[(j+1)%n][-1]-winding[(j+1)%n][0]*winding[j][-1]
+    return a
+
+
+def orient(p, q, r):
+    # >0 if p,q,r turn left, <0 if right, 0 if collinear
+    return (q[0]-p[0])*(r[-1]-p[-1]) - (q[-1]-p[-1])*(r[0]-p[0])
+
+
+def onsegment(p, q, r):
+    # is r, which is collinear with p and q, within the bounds of segment pq?
+    return min(p[0],q[0])<=r[0]<=max(p[0],q[0]) and min(p[-1],q[-1])<=r[-1]<=max(p[-1],q[-1])
+
+
+def intersects(p1, p2, q1, q2):
+    # do closed segments p1p2 and q1q2 have any point in common?
+    d1=orient(q1, q2, p1)
+    d2=orient(q1, q2, p2)
+    d3=orient(p1, p2, q1)
+    d4=orient(p1, p2, q2)
+    if ((d1>0 and d2<0) or (d1<0 and d2>0)) and ((d3>0 and d4<0) or (d3<0 and d4>0)):
+        return True
+    return ((d1==0 and onsegment(q1, q2, p1)) or
+            (d2==0 and onsegment(q1, q2, p2)) or
+            (d3==0 and onsegment(p1, p2, q1)) or
+            (d4==0 and onsegment(p1, p2, q2)))
+
+
+def simple(windings):
+    # Is the polygon formed by windings simple? ie each winding has at least three distinct
+    # nodes and non-zero area, and no edge touches any other except that consecutive edges of
+    # a winding meet at their shared node. Orientation of the windings doesn't matter.
+    # Shamos-Hoey sweep: O(n log n) in the number of edges.
+    edges=[]	# (left, right, winding, index)
+    for i in range(len(windings)):
+        winding=[(p[0], p[-1]) for p in windings[i]]
+        n=len(winding)
+        if n<3 or not area2(winding): return False
+        for j in range(n):
+            (p,q)=(winding[j], winding[(j+1)%n])
+            if p==q: return False	# repeated node
+            if q<p: (p,q)=(q,p)
+            edges.append((p, q, i, j))
+    sizes=[len(w) for w in windings]
+
+    def adjacent(a, b):
+        # share a node by construction
+        (ea, eb)=(edges[a], edges[b])
+        if ea[2]!=eb[2]: return False
+        n=sizes[ea[2]]
+        return (ea[3]-eb[3])%n in [1, n-1]
+
+    def crosses(a, b):
+        (p1, p2)=edges[a][:2]
+        (q1, q2)=edges[b][:2]
+        if not adjacent(a, b):
+            return intersects(p1, p2, q1, q2)
+        # consecutive edges only meet legitimately if they don't fold back over each other
+        if p1 in (q1, q2):
+            (shared, p, q)=(p1, p2, q2 if q1==p1 else q1)
+        else:
+            (shared, p, q)=(p2, p1, q2 if q1==p2 else q1)
+        return orient(shared, p, q)==0 and (onsegment(shared, p, q) or onsegment(shared, q, p))
+
+    # Sweep left to right. At each x the status holds the edges cut by the sweep line, in
+    # order of z. Until the first intersection is found that order doesn't change between
+    # events, so an edge's place is found when it's inserted.
+    events=[]
+    for k in range(len(edges)):
+        events.append((edges[k][0], 0, k))	# insertions before deletions at the same point
+        events.append((edges[k][1], 1, k))
+    events.sort()
+
+    def before(a, b):
+        # does edge a lie below edge b where b starts?
+        (p1, p2)=edges[a][:2]
+        q=edges[b][0]
+        d=orient(p1, p2, q)
+        if d: return d>0
+        if q>p2: return True	# beyond a on the same line
+        if q<p1: return False
+        # b starts on a - order by direction
+        return orient(p1, p2, edges[b][1])>0
+
+    status=[]
+    for (point, kind, k) in events:
+        if not kind:
+            # binary search for k's position in status
+            (lo, hi)=(0, len(status))
+            while lo<hi:
+                mid=(lo+hi)//2
+                if before(status[mid], k):
+                    lo=mid+1
+                else:
+                    hi=mid
+            status.insert(lo, k)
+            if lo>0 and crosses(status[lo-1], k): return False
+            if lo<len(status)-1 and crosses(k, status[lo+1]): return False
+        else:
+            i=status.index(k)
+            status.pop(i)
+            if 0<i<len(status) and crosses(status[i-1], status[i]): return False
+    return True
+
+
+def gridindex(minx, maxx, minz, maxz, density=2):
+    # Uniform grid over N boxes, laid out as files.MeshData. Returns (x0, z0, cell, nx, nz, start, index)
+    # where the boxes overlapping grid cell (i,j) are index[start[k]:start[k+1]], in order, and k=j*nx+i.
+    # density is the target number of boxes per cell.
+    n=len(minx)
+    x0=minx.min()
+    z0=minz.min()
+    cell=sqrt((maxx.max()-x0)*(maxz.max()-z0)*density/n) or max(maxx.max()-x0, maxz.max()-z0) or 1.0
+    nx=int((maxx.max()-x0)/cell)+1
+    nz=int((maxz.max()-z0)/cell)+1
+    ix0=((minx-x0)/cell).astype(int32)
+    iz0=((minz-z0)/cell).astype(int32)
+    w=minimum(((maxx-x0)/cell).astype(int32), nx-1)-ix0+1
+    h=minimum(((maxz-z0)/cell).astype(int32), nz-1)-iz0+1
+    # expand each box into the cells it covers
+    counts=w*h
+    box=repeat(arange(n, dtype=int32), counts)
+    k=arange(counts.sum(), dtype=int32)-repeat(cumsum(counts)-counts, counts)
+    w=repeat(w, counts)
+    cells=(repeat(iz0, counts)+k//w)*nx + repeat(ix0, counts)+k%w
+    order=argsort(cells, kind='mergesort')
+    return (x0, z0, cell, nx, nz, searchsorted(cells[order], arange(nx*nz+1)), box[order])
+
+
+def interpolate(tris, uvs, xs, zs):
+    # Returns N x 2 uvs at the points (xs,zs), interpolated across the first of the T x 3 x 2
+    # triangles tris (with T x 3 x 2 uvs) that contains each point, or (0,0) if none does.
+    # Vectorised barycentric solve against the few triangles in each point's cell of a grid.
+    n=len(xs)
+    out=zeros((n,2), float64)
+    if not len(tris) or not n: return out
+    p0=tris[:,0,:]
+    (e1, e2)=(tris[:,1,:]-p0, tris[:,2,:]-p0)
+    det=e1[:,0]*e2[:,1]-e2[:,0]*e1[:,1]
+    valid=(det!=0)
+    det=where(valid, det, 1)
+    (du1, du2)=(uvs[:,1,:]-uvs[:,0,:], uvs[:,2,:]-uvs[:,0,:])
+    eps=1e-6	# include points on edges
+
+    # widen the triangles' bounds by the slack that eps allows
+    (lo, hi)=(tris.min(axis=1), tris.max(axis=1))
+    slack=(hi-lo).max(axis=1)*eps*2
+    (x0, z0, cell, nx, nz, start, index)=gridindex(lo[:,0]-slack, hi[:,0]+slack, lo[:,1]-slack, hi[:,1]+slack)
+    i=((xs-x0)/cell).astype(int32)
+    j=((zs-z0)/cell).astype(int32)
+    ncells=nx*nz
+    k=where((xs>=x0) & (i<nx) & (zs>=z0) & (j<nz), j*nx+i, ncells)	# outside grid -> empty
+    first=start[minimum(k,ncells)]
+    count=start[minimum(k+1,ncells)]-first
+
+    # Test the m-th candidate of each point that hasn't been resolved yet
+    todo=arange(n)[count>0]
+    m=0
+    while len(todo):
+        t=index[first[todo]+m]
+        xp=xs[todo]-p0[t,0]
+        zp=zs[todo]-p0[t,1]
+        a=(xp*e2[t,1]-e2[t,0]*zp)/det[t]
+        b=(e1[t,0]*zp-xp*e1[t,1])/det[t]
+        inside=valid[t] & (a>=-eps) & (b>=-eps) & (a+b<=1+eps)
+        t=t[inside]
+        out[todo[inside]]=uvs[t,0,:] + a[inside][:,newaxis]*du1[t] + b[inside][:,newaxis]*du2[t]
+        m+=1
+        todo=todo[~inside & (count[todo]>m)]
+    return out
+
+
+def flatten(nodes, tolerance, maxsegs=64):
+    # Returns the closed contour [(x,z)] through apt.dat-style nodes [x,z] or [x,z,cx,cz]
+    # where (cx,cz) is a Bezier control point. Each curve is split into as few equal steps
+    # of its parameter as keep the chords within tolerance of it, using Wang's bound on the
+    # second differences of its control points. Quadratics are raised to cubics so that all
+    # of a contour's curves are evaluated together.
+    n=len(nodes)
+    if not n: return []
+    p=array([node[:2] for node in nodes], float64)
+    c=array([node[2:4] if len(node)>2 else node[:2] for node in nodes], float64)
+    curved=array([len(node)>2 for node in nodes])
+    j=arange(n)
+    k=(j+1)%n
+    (b0, b3)=(p[j], p[k])
+    (c1, c2)=(c[j], 2*p[k]-c[k])	# control points at each end
+    quad=where((curved[j] & ~curved[k])[:,newaxis], c1, c2)	# control point if only one end is curved
+    both=(curved[j] & curved[k])[:,newaxis]
+    b1=where(both, c1, b0+(quad-b0)*(2/3.0))
+    b2=where(both, c2, b3+(quad-b3)*(2/3.0))
+    (d1, d2)=(b2-2*b1+b0, b3-2*b2+b1)
+    dd=maximum(hypot(d1[:,0], d1[:,1]), hypot(d2[:,0], d2[:,1]))
+    m=clip(ceil(sqrt(0.75*dd/tolerance)), 1, maxsegs).astype(int32)	# n(n-1)/8 = 3/4 for cubics
+    m[~(curved[j] | curved[k])]=1	# straight
+    s=repeat(j, m)
+    t=((arange(len(s))-repeat(cumsum(m)-m, m)) / repeat(m, m).astype(float64))[:,newaxis]
+    u=1-t
+    pts=(u*u*u*b0[s] + 3*u*u*t*b1[s] + 3*u*t*t*b2[s] + t*t*t*b3[s]).round(6)
+    contour=[]
+    last=None
+    for pt in pts.tolist():
+        pt=tuple(pt)
+        if pt==last: continue
+        last=pt
+        contour.append(pt)
+    return contour
+
+
+def drape(groups, meshtris, chunk=1<<11):
+    # GL-free equivalent of tessellating the contours of each (colour, [contour]) in groups
+    # with the non-zero winding rule and intersecting the result with the terrain triangles
+    # meshtris (N x 3 x 3), where contour is [(x,z)]. Returns [[x,y,z]] vertices of triangles
+    # lying on the terrain, in order of groups, and the colour of each vertex.
+    # The terrain triangles under each group are clipped together by drapetris, in chunks
+    # to bound memory use.
+    varray=[]
+    tarray=[]
+    tris=asarray(meshtris, float64).reshape(-1,3,3)
+    (txmin, txmax)=(tris[:,:,0].min(axis=1), tris[:,:,0].max(axis=1))
+    (tzmin, tzmax)=(tris[:,:,2].min(axis=1), tris[:,:,2].max(axis=1))
+    for (col, contours) in groups:
+        edges=[]	# (left x, z, right x, z, direction). Vertical edges have direction 0.
+        for contour in contours:
+            if len(contour)<2: continue
+            p=array(contour, float64)[:,[0,-1]]
+            q=roll(p, -1, axis=0)
+            d=sign(q[:,0]-p[:,0])
+            (left, right)=(where((d>0)[:,newaxis], p, q), where((d>0)[:,newaxis], q, p))
+            edges.append(concatenate([left, right, d[:,newaxis]], axis=1)[(p!=q).any(axis=1)])
+        e=concatenate(edges) if edges else empty((0,5), float64)
+        if not len(e): continue
+        (ezmin, ezmax)=(e[:,[1,3]].min(axis=1), e[:,[1,3]].max(axis=1))
+        todo=((txmax>=e[:,0].min()) & (txmin<=e[:,2].max()) & (tzmax>=ezmin.min()) & (tzmin<=ezmax.max())).nonzero()[0]
+        for s in range(0, len(todo), chunk):
+            pts=drapetris(tris[todo[s:s+chunk]], e, ezmin, ezmax)
+            varray.extend(pts.tolist())
+            tarray.extend([col]*len(pts))
+    return (varray, tarray)
+
+
+def drapepavements(job):
+    # Drapes each of an airport's [shoulders, taxiways, runways] on the terrain meshtris.
+    # Module-level and GL-free so that it can run in a worker process.
+    (kinds, meshtris)=job
+    return [drape(groups, meshtris) for groups in kinds]
+
+
+def edgez(e, x):
+    # z of the lines through edges e (... x 4+ of left x, z, right x, z) at x
+    return e[...,1]+(e[...,3]-e[...,1])*(x-e[...,0])/(e[...,2]-e[...,0])
+
+
+def pairs(groups):
+    # index pairs (i,j), i<j, of the elements of each run of equal values in sorted groups
+    counts=bincount(groups)
+    end=(cumsum(counts))[groups]
+    m=end-arange(len(groups))-1	# partners of each element
+    i=repeat(arange(len(groups)), m)
+    j=i+1+arange(len(i))-repeat(cumsum(m)-m, m)
+    return (i, j)
+
+
+def drapetris(tris, e, ezmin, ezmax):
+    # Helper for drape: returns vertices (N x 3) of the parts of the terrain triangles tris that
+    # lie inside the pavement with edges e. Triangles that no edge crosses are
+    # wholly inside or outside. The others are cut into vertical slabs at the x of their corners
+    # and of the ends and crossings of the lines within them. No lines cross within a slab, so
+    # there the pavement is trapezoids between consecutive edges where the winding number,
+    # counted from below, is non-zero. All the triangles are processed together.
+    (x, z)=(tris[:,:,0], tris[:,:,2])
+    (xmin, xmax)=(x.min(axis=1), x.max(axis=1))
+    (zmin, zmax)=(z.min(axis=1), z.max(axis=1))
+    (u, v)=(tris[:,1]-tris[:,0], tris[:,2]-tris[:,0])
+    normal=cross(u, v)
+    flip=(u[:,0]*v[:,2]-u[:,2]*v[:,0])<0	# emit triangles with the same facing as tris
+    ok=normal[:,1]!=0	# not vertical
+
+    # (triangle, edge) pairs where the edge spans some of the triangle's x and isn't above it
+    (pt, pe)=((e[:,0]<=xmax[:,newaxis]) & (e[:,2]>=xmin[:,newaxis]) & (ezmin<=zmax[:,newaxis]) & ok[:,newaxis]).nonzero()
+    ep=e[pe]
+    crossing=ezmax[pe]>=zmin[pt]
+    crossed=zeros(len(tris), bool)
+    crossed[pt[crossing]]=True
+
+    # wholly inside or outside pavement - winding number at centroid
+    (cx, cz)=(x.mean(axis=1), z.mean(axis=1))
+    k=((ep[:,0]<=cx[pt]) & (cx[pt]<ep[:,2])).nonzero()[0]
+    k=k[edgez(ep[k], cx[pt[k]])<cz[pt[k]]]
+    whole=ok & ~crossed & (bincount(pt[k], ep[k,4], len(tris))!=0)
+    if not crossed.any(): return tris[whole].reshape(-1,3)
+
+    # lines in each crossed triangle - crossing edges and the triangle's own non-vertical edges
+    a=tris[:,[0,1,2]][:,:,[0,2]]
+    b=tris[:,[1,2,0]][:,:,[0,2]]
+    swap=(a[:,:,0]>b[:,:,0])[:,:,newaxis]
+    tedges=concatenate([where(swap, b, a), where(swap, a, b)], axis=2)	# T x 3 x (left x, z, right x, z)
+    (tt, tk)=(crossed[:,newaxis] & (tedges[:,:,0]<tedges[:,:,2])).nonzero()
+    # slab boundaries: corners, edge ends within the triangle, and crossings of lines
+    xs=[x[crossed].reshape(-1)]
+    ts=[repeat(crossed.nonzero()[0], 3)]
+    for k in [0,2]:
+        within=crossing & (xmin[pt]<ep[:,k]) & (ep[:,k]<xmax[pt])
+        xs.append(ep[within,k])
+        ts.append(pt[within])
+    edge=crossing & (ep[:,0]<ep[:,2])
+    lt=concatenate([pt[edge], tt])
+    lines=concatenate([ep[edge,:4], tedges[tt,tk]])
+    order=argsort(lt, kind='mergesort')
+    (lt, lines)=(lt[order], lines[order])
+    (i, j)=pairs(lt)
+    t=lt[i]
+    (li, lj)=(lines[i], lines[j])
+    lo=maximum(maximum(li[:,0], lj[:,0]), xmin[t])
+    hi=minimum(minimum(li[:,2], lj[:,2]), xmax[t])
+    common=lo<hi
+    (li, lj, lo, hi, t)=(li[common], lj[common], lo[common], hi[common], t[common])
+    f=edgez(li, lo)-edgez(lj, lo)	# difference in z between the lines at the ends of their common span
+    g=edgez(li, hi)-edgez(lj, hi)
+    meet=((f<0) & (0<g)) | ((g<0) & (0<f))
+    xs.append((lo+(hi-lo)*f/where(meet, f-g, 1))[meet])
+    ts.append(t[meet])
+    (xs, ts)=(concatenate(xs), concatenate(ts))
+    order=lexsort((xs, ts))
+    (xs, ts)=(xs[order], ts[order])
+    slab=((ts[1:]==ts[:-1]) & (xs[1:]-xs[:-1]>1e-9)).nonzero()[0]
+    (st, xa, xb)=(ts[slab], xs[slab], xs[slab+1])
+    xm=(xa+xb)/2
+
+    # the triangle's lower and upper edges in each slab
+    te=tedges[st]
+    spans=(te[:,:,0]<=xm[:,newaxis]) & (xm[:,newaxis]<te[:,:,2])
+    zt=edgez(where(spans[:,:,newaxis], te, [0,0,1,0]), xm[:,newaxis])
+    good=spans.sum(axis=1)==2
+    (st, xa, xb, xm, te, spans, zt)=(st[good], xa[good], xb[good], xm[good], te[good], spans[good], zt[good])
+    r=arange(len(st))
+    lower=te[r, where(spans, zt, inf).argmin(axis=1)]
+    upper=te[r, where(spans, zt, -inf).argmax(axis=1)]
+    (zlo, zhi)=(edgez(lower, xm), edgez(upper, xm))
+
+    # pavement edges that span each slab - those below set its winding number, those within are events
+    counts=bincount(pt, minlength=len(tris))
+    n=counts[st]
+    sp=repeat(r, n)
+    ek=ep[repeat(cumsum(counts)[st]-n, n)+arange(len(sp))-repeat(cumsum(n)-n, n)]
+    spanning=(ek[:,0]<=xm[sp]) & (xm[sp]<ek[:,2])
+    (sp, ek)=(sp[spanning], ek[spanning])
+    zm=edgez(ek, xm[sp])
+    below=zm<zlo[sp]
+    w0=bincount(sp[below], ek[below,4], len(st)).round().astype(int32)
+    within=~below & (zm<=zhi[sp])
+    (sp, ek, zm)=(sp[within], ek[within], zm[within])
+    order=lexsort((zm, sp))
+    (sp, ek)=(sp[order], ek[order])
+
+    # runs of non-zero winding number up each slab, from lower or an edge to an edge or upper
+    d=ek[:,4].astype(int32)
+    c=cumsum(d)
+    first=searchsorted(sp, sp)	# first event in each event's slab
+    after=w0[sp]+c-c[first]+d[first]
+    before=after-d
+    top=w0+bincount(sp, d, len(st)).round().astype(int32)
+    ev=arange(len(sp))
+    (opens, closes)=((before==0) & (after!=0), (before!=0) & (after==0))
+    (fromlower, toupper)=(w0!=0, top!=0)
+    runslab=concatenate([r[fromlower], sp[opens]])
+    order=lexsort((concatenate([zeros(fromlower.sum(), int32)-1, ev[opens]]), runslab))
+    (runslab, starts)=(runslab[order], concatenate([lower[fromlower], ek[opens,:4]])[order])
+    endslab=concatenate([sp[closes], r[toupper]])
+    order=lexsort((concatenate([ev[closes], zeros(toupper.sum(), int32)+len(sp)]), endslab))
+    ends=concatenate([ek[closes,:4], upper[toupper]])[order]
+    return concatenate([tris[whole].reshape(-1,3),
+                        trapezoids(tris, normal, flip, st[runslab], xa[runslab], xb[runslab], starts, ends)])
+
+
+def trapezoids(tris, normal, flip, t, xa, xb, lower, upper):
+    # Helper for drapetris: vertices of the triangles covering the slab xa-xb of each terrain
+    # triangle t between lines lower and upper, with heights on the terrain
+    (z1a, z1b)=(edgez(lower, xa), edgez(lower, xb))
+    (z2a, z2b)=(maximum(z1a, edgez(upper, xa)), maximum(z1b, edgez(upper, xb)))
+    (pa, pb, pc, pd)=(array([xa, z1a]).T, array([xb, z1b]).T, array([xb, z2b]).T, array([xa, z2a]).T)
+    corners=[]
+    owners=[]
+    for (keep, a, b, c) in [(z1b!=z2b, pa, pb, pc), (z1a!=z2a, pa, pc, pd)]:	# skip degenerate
+        f=flip[t[keep]][:,newaxis]
+        (a, b, c)=(a[keep], b[keep], c[keep])
+        corners.append(array([a, where(f, c, b), where(f, b, c)]).transpose(1,0,2))
+        owners.append(t[keep])
+    pts=concatenate(corners).reshape(-1,2)
+    owner=repeat(concatenate(owners), 3)
+    (p0, n)=(tris[owner,0], normal[owner])
+    ys=p0[:,1]-(n[:,0]*(pts[:,0]-p0[:,0])+n[:,2]*(pts[:,1]-p0[:,2]))/n[:,1]
+    return array([pts[:,0], ys, pts[:,1]]).T
@@ -11,7 +11,12 @@ class Prefs:
     ELEVATION=2
     DMS=4
     NETWORK=8
-    REDRAW=TERRAIN|ELEVATION|NETWORK	# options that cause meshlist to be recalculated
+    TEXHIGH=16		# terrain textures at full resolution
+    TEXMEDIUM=32	# terrain textures at half resolution. Neither -> quarter resolution
+    TEXQUALITY=TEXHIGH|TEXMEDIUM
+    PICKCOLOUR=64	# select placements by their drawn pixels rather than by their geometry
+    WORKERS=128		# drape airport pavements in worker processes. Takes effect on restart
+    REDRAW=TERRAIN|ELEVATION|NETWORK|TEXQUALITY	# options that cause meshlist to be recalculated
     
     def __init__(self):
         self.filename=None
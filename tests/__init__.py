@@ -0,0 +1,11 @@
+# Tests. Run from the top level with: python -m pytest tests
+# or: python -m unittest discover tests
+#
+# GL tests use an offscreen Mesa context through EGL, so need no display.
+
+import os
+from sys import platform
+
+if platform.startswith('linux') and not os.environ.get('DISPLAY'):
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+    os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
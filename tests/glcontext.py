@@ -0,0 +1,34 @@
+# Offscreen GL context for tests. makecurrent() returns False if no context can be made, in
+# which case GL tests should skip.
+
+context=None
+
+def makecurrent():
+    global context
+    if context: return True
+    try:
+        from OpenGL import EGL
+        display=EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        if not EGL.eglInitialize(display, None, None): return False
+        config=EGL.EGLConfig()	# may be left null - drawing is to framebuffer objects
+        EGL.eglChooseConfig(display, [EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE], config, 1, EGL.EGLint())
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        ctx=EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+        if not ctx or not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, ctx): return False
+        context=(display, ctx)
+        return True
+    except:
+        return False
+
+
+def offscreen(width, height):
+    # Bind a new RGBA framebuffer object of the given size for drawing. Returns its id.
+    from OpenGL.GL import glBindFramebuffer, glBindRenderbuffer, glFramebufferRenderbuffer, glGenFramebuffers, glGenRenderbuffers, glRenderbufferStorage, glViewport, GL_COLOR_ATTACHMENT0, GL_FRAMEBUFFER, GL_RENDERBUFFER, GL_RGBA8
+    fbo=glGenFramebuffers(1)
+    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+    rbo=glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, rbo)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, rbo)
+    glViewport(0, 0, width, height)
+    return fbo
@@ -0,0 +1,95 @@
+import os
+import unittest
+from os.path import dirname, exists
+from tempfile import mkdtemp
+from shutil import rmtree
+from sys import platform
+
+import tests
+
+try:
+    import wx
+    havedeps=True
+except ImportError:
+    havedeps=False
+
+if havedeps:
+    from numpy import array, savez
+    import draw
+    from draw import aptcachefile, readaptcache, writeaptcache
+
+
+key=(51, -1, 2)
+
+
+@unittest.skipUnless(havedeps, 'needs wx')
+class TestAptCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir=mkdtemp()
+        self.environ=dict(os.environ)
+        for var in ['XDG_CACHE_HOME', 'LOCALAPPDATA', 'HOME']:
+            os.environ[var]=self.dir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        rmtree(self.dir)
+
+    def pavements(self, n):
+        v=[[float(i), 1.5, -float(i)] for i in range(n)]
+        t=[[i/8.0, 0.25] for i in range(n)]
+        return (v[:1], t[:1], v[1:3], t[1:3], v[3:], t[3:])
+
+    def test_location(self):
+        filename=aptcachefile(key)
+        self.assertTrue(filename.startswith(self.dir))
+        self.assertNotEqual(aptcachefile((51, -1, 0)), filename)
+
+    def test_roundtrip(self):
+        self.assertEqual(readaptcache(key), {})
+        cache={'0'*32: self.pavements(9), 'f'*32: self.pavements(3), 'e'*32: ([], [], [], [], [], [])}
+        writeaptcache(key, cache)
+        filename=aptcachefile(key)
+        self.assertTrue(exists(filename))
+        self.assertEqual(os.listdir(dirname(filename)), [os.path.basename(filename)])	# no temporary left behind
+        if platform!='win32':
+            self.assertEqual(os.stat(dirname(filename)).st_mode & 0077, 0)
+        self.assertEqual(readaptcache(key), cache)
+        writeaptcache(key, {})	# replaces
+        self.assertEqual(readaptcache(key), {})
+
+    def test_version(self):
+        writeaptcache(key, {'0'*32: self.pavements(4)})
+        appversion=draw.appversion
+        try:
+            draw.appversion=appversion+1
+            self.assertEqual(readaptcache(key), {})
+        finally:
+            draw.appversion=appversion
+
+    def test_bad(self):
+        writeaptcache(key, {})
+        filename=aptcachefile(key)
+        h=open(filename, 'wb')
+        h.write('not a cache')
+        h.close()
+        self.assertEqual(readaptcache(key), {})
+
+        # wrong shapes
+        for (vertices, counts) in [([[0,0,0]]*4, [[1,1,1,1,1,1]]),
+                                   ([[0,0,0]]*3, [[1,1,1,1,0,0]]),
+                                   ([[0,0]]*3, [[1,1,1,1,1,1]]),
+                                   ([[0,0,0]]*4, [[2,1,1,1,1,1]])]:
+            savez(filename, version=array([draw.appversion]), keys=array(['0'*32]),
+                  counts=array(counts, 'i'), vertices=array(vertices, float), texcoords=array([[0,0]]*3, float))
+            self.assertEqual(readaptcache(key), {})
+
+        # objects would need unpickling
+        savez(filename, version=array([draw.appversion]), keys=array([('0'*32, None)], object)[:,0],
+              counts=array([[1,1,1,1,1,1]], 'i'), vertices=array([[0,0,0]]*3, float), texcoords=array([[0,0]]*3, float))
+        self.assertEqual(readaptcache(key), {})
+
+
+if __name__=='__main__':
+    unittest.main()
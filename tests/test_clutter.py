@@ -0,0 +1,256 @@
+import unittest
+from os.path import join
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import tests
+from tests.glcontext import makecurrent, offscreen
+
+try:
+    import wx
+    havedeps=makecurrent()
+except ImportError:
+    havedeps=False
+
+if havedeps:
+    from OpenGL.GL import *
+    from numpy import array, float64
+    from clutter import Facade, Object, batchobjects
+    from clutterdef import FacadeDef, FacadeFallback
+    from files import VertexCache
+
+
+header='A\n800\nFACADE\n'
+wall='WALL 0 100\nSCALE 10 10\nLEFT 0 0.125\nCENTER 0.125 0.25\nRIGHT 0.25 0.5\nBOTTOM 0 0.125\nMIDDLE 0.125 0.375\nTOP 0.375 0.5\n'
+roof='ROOF 0 0.5\nROOF 1 0.5\nROOF 1 1\nROOF 0 1\n'
+facades={
+    'box':    header+'RING 1\nLOD 0 10000\n'+roof+wall,
+    'sloped': header+'RING 1\nLOD 0 10000\n'+roof+wall+'ROOF_SLOPE 30\n',
+    'fence':  header+'RING 0\nTWO_SIDED 1\nLOD 0 10000\n'+wall,
+    }
+
+tile=[0,0]
+square=[(0.5,0.5), (0.5001,0.5), (0.5001,0.5001), (0.5,0.5001)]	# about 11m a side
+oblong=[(0.5,0.5), (0.5003,0.5), (0.5003,0.50005), (0.5,0.50005)]
+
+
+@unittest.skipUnless(havedeps, 'needs wx and an offscreen GL context')
+class TestFacade(unittest.TestCase):
+
+    def setUp(self):
+        self.dir=mkdtemp()
+        self.vertexcache=VertexCache()
+        self.defs={}
+        for (name, text) in facades.items():
+            filename=join(self.dir, name+'.fac')
+            h=open(filename, 'wt')
+            h.write(text)
+            h.close()
+            self.defs[name]=FacadeDef(filename, self.vertexcache)
+        self.defs['fallback']=FacadeFallback('missing.fac', self.vertexcache)
+
+    def tearDown(self):
+        self.vertexcache.texcache.reset()
+        rmtree(self.dir)
+
+    def facade(self, name, nodes, height=20):
+        fac=Facade(name, height, [list(nodes)])
+        fac.definition=self.defs[name]
+        fac.layout(tile, 0, self.vertexcache)
+        return fac
+
+    def checkwalls(self, fac):
+        # Each wall is a grid of quads that spans the wall and rises from the ground to the
+        # roof, with texture coordinates from the definition's subdivisions.
+        definition=fac.definition
+        points=array(fac.points[0], float64)
+        n=len(points)
+        nwalls=definition.ring and n or n-1
+        (vst, vcum)=fac.strip(fac.param, True)
+        roofheight=(vst[:,1]-vst[:,0]).sum()*definition.vscale
+        quads=fac.quads.reshape(-1,4,5)
+        self.assertTrue(len(quads))
+        rows=len(vst)	# including the penthouse
+        self.assertEqual(len(quads)%rows, 0)
+        columns=quads[:len(quads)/rows]	# bottom row
+        self.assertTrue((columns[:,[0,3],1]==0).all())
+        penthouse=quads[(rows-1)*len(quads)/rows:]
+        self.assertTrue((abs(penthouse[:,[1,2],1]-roofheight)<1e-6).all())
+
+        # bottom edges of the columns run along the outline, end to end
+        edges=columns[:,[0,3]][:,:,[0,2]]
+        self.assertTrue((abs(edges[1:,0]-edges[:-1,1])<1e-6).sum()>=len(edges)-nwalls)
+        length=sum([((points[(i+1)%n]-points[i])[[0,2]]**2).sum()**0.5 for i in range(nwalls)])
+        self.assertAlmostEqual((((edges[:,1]-edges[:,0])**2).sum(axis=1)**0.5).sum(), length, 6)
+        self.assertTrue(abs(edges[0,0]-points[0][[0,2]]).max()<1e-6)
+
+        s=[s for div in definition.horiz for s in div]
+        t=[t for div in definition.vert for t in div]
+        self.assertTrue(min(s)<=quads[:,:,3].min() and quads[:,:,3].max()<=max(s))
+        self.assertTrue(min(t)<=quads[:,:,4].min() and quads[:,:,4].max()<=max(t))
+        return roofheight
+
+    def checkroof(self, fac, roofheight):
+        # fan from the centre round the outline, at the top of the walls
+        definition=fac.definition
+        roof=array(fac.roof, float64)
+        self.assertEqual(len(roof), len(fac.points[0])+1)
+        self.assertTrue((abs(roof[:,1]-roofheight)<1e-6).all())
+        (s,t)=zip(*definition.roof)
+        self.assertTrue((roof[:,3]>=min(s)-1e-6).all() and (roof[:,3]<=max(s)+1e-6).all())
+        self.assertTrue((roof[:,4]>=min(t)-1e-6).all() and (roof[:,4]<=max(t)+1e-6).all())
+        return roof
+
+    def checkbuffers(self, fac):
+        # outline, then walls, then roof fan, as draw() expects
+        (v,t)=fac.vertices()
+        expected=len(fac.points[0])+len(fac.quads)+(fac.roof and len(fac.roof)+1 or 0)
+        self.assertEqual((len(v), len(t)), (expected, expected))
+        (tris, lines)=fac.pickdata()
+        self.assertEqual(len(tris), len(fac.quads)/2+(fac.roof and len(fac.roof)-1 or 0))
+
+    def test_box(self):
+        for nodes in [square, oblong]:
+            fac=self.facade('box', nodes)
+            roofheight=self.checkwalls(fac)
+            roof=self.checkroof(fac, roofheight)
+            # flat roof sits on the walls
+            self.assertTrue(abs(roof[1:,[0,2]]-array(fac.points[0], float64)[::-1][:,[0,2]]).max()<1e-6)
+            self.checkbuffers(fac)
+
+    def test_sloped(self):
+        fac=self.facade('sloped', square)
+        roofheight=self.checkwalls(fac)
+        roof=self.checkroof(fac, roofheight)
+        # roof is inset from the walls by the sloped top row
+        points=array(fac.points[0], float64)
+        centre=points.mean(axis=0)
+        inset=((roof[1:,[0,2]]-centre[[0,2]])**2).sum(axis=1)**0.5
+        outline=((points[::-1][:,[0,2]]-centre[[0,2]])**2).sum(axis=1)**0.5
+        self.assertTrue((inset<outline-0.1).all())
+        self.checkbuffers(fac)
+
+    def test_fence(self):
+        fac=self.facade('fence', square)
+        self.checkwalls(fac)
+        self.assertEqual(fac.roof, [])
+        self.checkbuffers(fac)
+
+    def test_fallback(self):
+        fac=self.facade('fallback', square)
+        self.checkwalls(fac)
+        self.assertEqual(fac.roof, [])
+        self.checkbuffers(fac)
+
+    def test_subdivs(self):
+        # subdivisions are shared by walls of the same size, and the least recently used are dropped
+        fac=self.facade('box', square)
+        subdivs=fac.definition.subdivs
+        keys=subdivs.keys()
+        self.assertEqual(len(keys), 5)	# height, and each wall
+        self.facade('box', square)
+        self.assertEqual(subdivs.keys(), keys)
+        self.assertTrue(fac.strip(*keys[0]) is subdivs[keys[0]])
+        self.assertEqual(subdivs.keys(), keys[1:]+keys[:1])
+        for i in range(4096):
+            fac.strip(float(i), False)
+        self.assertEqual(len(subdivs), 4096)
+        self.assertTrue(keys[0] not in subdivs and (4095.0, False) in subdivs)
+
+
+class ObjectDef:
+    # one culled triangle then one nocull triangle
+    vdata=[(1,0,0), (0,0,1), (0,1,0), (1,0,0), (0,0,1), (0,2,0)]
+    tdata=[(0,0), (1,0), (0,1), (0,0), (1,0), (0,0.5)]
+    culled=3
+
+class Placement:
+    def __init__(self, x, y, z, hdg):
+        (self.x, self.y, self.z, self.hdg)=(x, y, z, hdg)
+
+
+@unittest.skipUnless(havedeps, 'needs wx')
+class TestBatchObjects(unittest.TestCase):
+
+    def test_batch(self):
+        objects=[Placement(0,0,0,0), Placement(10,2,20,90)]
+        (v,t)=batchobjects(ObjectDef, objects, 20)
+        self.assertEqual((v.shape, t.shape), ((20,3), (20,2)))
+        # culled triangles of both objects, then nocull triangles of both
+        expected=[(1,0,0), (0,0,1), (0,1,0), (10,2,21), (9,2,20), (10,3,20),
+                  (1,0,0), (0,0,1), (0,2,0), (10,2,21), (9,2,20), (10,4,20)]
+        self.assertTrue(abs(v[:12]-expected).max()<1e-5)
+        self.assertEqual(map(tuple, t[:12].tolist()), ObjectDef.tdata[:3]*2+ObjectDef.tdata[3:]*2)
+
+    def test_empty(self):
+        (v,t)=batchobjects(ObjectDef, [], 6)
+        self.assertEqual((v.shape, t.shape), ((6,3), (6,2)))
+        self.assertTrue((v==0).all() and (t==0).all())
+
+
+class Canvas:
+    # stands in for MyGL - the context is already current
+    context=None
+    def SetCurrent(self, context): pass
+
+
+@unittest.skipUnless(havedeps, 'needs wx and an offscreen GL context')
+class TestBatchDraw(unittest.TestCase):
+
+    def setUp(self):
+        self.cache=VertexCache()
+        self.fbo=offscreen(64, 64)
+
+    def tearDown(self):
+        self.cache.texcache.reset()
+        glDeleteFramebuffers(1, [self.fbo])
+        glBindBuffer(GL_ARRAY_BUFFER, 0)	# left bound by realize
+
+    def feedback(self, draw):
+        # window coordinates of each triangle drawn by draw(), in a canonical order
+        glFeedbackBuffer(4096, GL_3D)
+        glRenderMode(GL_FEEDBACK)
+        draw()
+        tris=[[v.vertex for v in prim[1:]] for prim in glRenderMode(GL_RENDER)]
+        return array(sorted(tris, key=lambda tri: [round(c, 1) for v in tri for c in v]))
+
+    def test_draw(self):
+        # batched vertices are where Object.draw's glTranslatef and glRotatef would put them
+        definition=ObjectDef()
+        (definition.texture, definition.poly, definition.nocull)=(0, False, 3)
+        definition.base=self.cache.allocate(definition.vdata, definition.tdata)
+        objects=[]
+        for (x, y, z, hdg) in [(0,0,0,0), (10,2,20,90), (-5,1,3,180), (7.5,-2,-9,37.5), (3,3,-3,271)]:
+            obj=Object('test.obj', 0, 0, hdg)
+            (obj.x, obj.y, obj.z, obj.definition)=(x, y, z, definition)
+            objects.append(obj)
+        n=len(objects)
+        (vdata, tdata)=batchobjects(definition, objects, n*6+7)
+        self.assertTrue((vdata[n*6:]==0).all() and (tdata[n*6:]==0).all())	# spare room is zeroed
+        base=self.cache.allocate(vdata, tdata)
+        self.cache.realize(Canvas())
+
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(-30, 30, -30, 30, -30, 30)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        glRotatef(30, 1,0,0)	# looking obliquely, so heights show
+        glFrontFace(GL_CW)
+        glEnable(GL_CULL_FACE)
+        def drawbatch():
+            # as MyGL.compilelayers
+            glDrawArrays(GL_TRIANGLES, base, n*definition.culled)
+            glDisable(GL_CULL_FACE)
+            glDrawArrays(GL_TRIANGLES, base+n*definition.culled, n*definition.nocull)
+            glEnable(GL_CULL_FACE)
+        each=self.feedback(lambda: [obj.draw(False, False) for obj in objects])
+        batched=self.feedback(drawbatch)
+        glDisable(GL_CULL_FACE)
+        self.assertTrue(n<len(each)<2*n)	# some culled triangles face away
+        self.assertEqual(batched.shape, each.shape)
+        self.assertTrue(abs(batched-each).max()<1e-3)
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+import unittest
+
+from math import cos, pi, sin
+from random import Random
+
+from numpy import array, float64
+
+from geometry import area2, drapepavements, flatten, interpolate, simple
+
+
+class TestSimple(unittest.TestCase):
+
+    square=[(0,0), (1,0), (1,1), (0,1)]
+
+    def test_simple(self):
+        self.assertTrue(simple([self.square]))
+        self.assertTrue(simple([self.square[::-1]]))
+        self.assertTrue(simple([[(x,0,z) for (x,z) in self.square]]))	# (x,y,z) points
+        self.assertTrue(simple([[(0,0), (2,0), (1,1)], [(1,2), (2,3), (0,3)]]))
+        self.assertTrue(simple([[(0,0), (4,0), (4,4), (0,4)], [(1,1), (1,3), (3,3), (3,1)]]))	# with a hole
+
+    def test_degenerate(self):
+        self.assertFalse(simple([[(0,0), (1,0)]]))
+        self.assertFalse(simple([[(0,0), (1,0), (2,0)]]))	# no area
+        self.assertFalse(simple([[(0,0), (1,0), (1,0), (0,1)]]))	# repeated node
+
+    def test_crossing(self):
+        self.assertFalse(simple([[(0,0), (1,1), (1,0), (0,1)]]))	# bow tie
+        self.assertFalse(simple([[(0,0), (2,0), (2,2), (1,0), (0,2)]]))	# touches an edge
+        self.assertFalse(simple([[(0,0), (3,0), (3,3), (0,3)], [(1,1), (4,1), (4,2), (1,2)]]))	# hole crosses outer
+        self.assertFalse(simple([[(0,0), (2,0), (1,0), (1,1)]]))	# folds back
+
+    def test_bruteforce(self):
+        # agrees with a pairwise test of every two edges on random polygons, mostly on small grids so
+        # that repeated nodes, collinear edges, fold-backs and zero-area windings are common
+        random=Random(44)
+        counts=[0, 0]
+        for k in range(20000):
+            grid=random.choice([2, 3, 4, 6, 10, 1000])
+            windings=[]
+            for w in range(random.choice([1, 1, 1, 2, 3])):
+                if random.random()<0.3:
+                    # star-shaped, so often simple
+                    (cx, cz, r)=(random.randint(0,grid), random.randint(0,grid), random.randint(1,grid))
+                    angles=sorted([random.uniform(0, 2*pi) for i in range(random.randint(3,8))])
+                    winding=[(cx+int(round(r*cos(a))), cz+int(round(r*sin(a)))) for a in angles]
+                    if random.random()<0.5: winding.reverse()
+                else:
+                    winding=[(random.randint(0,grid), random.randint(0,grid)) for i in range(random.randint(2,7))]
+                kind=random.random()
+                if kind<0.1 and winding:
+                    winding.insert(random.randint(0, len(winding)), random.choice(winding))	# repeated node
+                elif kind<0.2 and len(winding)>1:
+                    # fold back along the previous edge
+                    i=random.randint(1, len(winding)-1)
+                    (p, q)=(winding[i-1], winding[i])
+                    winding.insert(i+1, (q[0]+(p[0]-q[0])*random.choice([1, 2]), q[1]+(p[1]-q[1])*random.choice([1, 2])))
+                elif kind<0.25:
+                    # zero area
+                    (dx, dz)=(random.randint(-1,1), random.randint(-1,1))
+                    winding=[(i*dx, i*dz) for i in random.sample(range(-3,4), random.randint(3,5))]
+                windings.append(winding)
+            expected=bruteforce(windings)
+            self.assertEqual(simple(windings), expected, windings)
+            counts[expected]+=1
+        self.assertTrue(min(counts)>2000, counts)	# plenty of each
+
+
+def bruteforce(windings):
+    # simple() by testing every pair of edges, with its own exact integer arithmetic
+    def orient(p, q, r):
+        d=(q[0]-p[0])*(r[1]-p[1]) - (q[1]-p[1])*(r[0]-p[0])
+        return (d>0)-(d<0)
+    def between(p, q, r):
+        return min(p[0],q[0])<=r[0]<=max(p[0],q[0]) and min(p[1],q[1])<=r[1]<=max(p[1],q[1])
+    edges=[]
+    for (i, winding) in enumerate(windings):
+        n=len(winding)
+        if n<3: return False
+        if not sum([winding[j][0]*winding[(j+1)%n][1]-winding[(j+1)%n][0]*winding[j][1] for j in range(n)]): return False
+        edges.extend([(winding[j], winding[(j+1)%n], i, j, n) for j in range(n)])
+    for a in range(len(edges)):
+        (p1, p2, i, j, n)=edges[a]
+        if p1==p2: return False
+        for b in range(a+1, len(edges)):
+            (q1, q2, i2, j2, n2)=edges[b]
+            if i==i2 and (j2-j)%n in [1, n-1]:
+                # consecutive - mustn't overlap beyond their shared node
+                (shared, p, q)=(p2, p1, q2) if p2==q1 else (p1, p2, q1)
+                if not orient(shared, p, q) and (p[0]-shared[0])*(q[0]-shared[0])+(p[1]-shared[1])*(q[1]-shared[1])>0: return False
+            else:
+                (d1, d2, d3, d4)=(orient(q1, q2, p1), orient(q1, q2, p2), orient(p1, p2, q1), orient(p1, p2, q2))
+                if d1*d2<0 and d3*d4<0: return False
+                if ((not d1 and between(q1, q2, p1)) or (not d2 and between(q1, q2, p2)) or
+                    (not d3 and between(p1, p2, q1)) or (not d4 and between(p1, p2, q2))): return False
+    return True
+
+
+class TestFlatten(unittest.TestCase):
+
+    def test_straight(self):
+        self.assertEqual(flatten([], 0.1), [])
+        self.assertEqual(flatten([[0,0], [1,0], [1,1]], 0.1), [(0,0), (1,0), (1,1)])
+
+    def test_curved(self):
+        # control points for a circle of radius 1 round the origin
+        k=0.5523
+        nodes=[[1,0,1,k], [0,1,-k,1], [-1,0,-1,-k], [0,-1,k,-1]]
+        for tolerance in [0.1, 0.01, 0.001]:
+            contour=flatten(nodes, tolerance)
+            self.assertTrue(len(contour)>4)
+            self.assertEqual(contour[0], (1,0))
+            for (x,z) in contour:
+                self.assertTrue(abs((x*x+z*z)**0.5-1)<0.001)
+            # chords stay within tolerance of the curve
+            for i in range(len(contour)):
+                (x0,z0)=contour[i]
+                (x1,z1)=contour[(i+1)%len(contour)]
+                self.assertTrue(1-(((x0+x1)/2)**2+((z0+z1)/2)**2)**0.5<tolerance)
+        self.assertTrue(len(flatten(nodes, 0.001))>len(flatten(nodes, 0.1)))
+        self.assertEqual(len(flatten(nodes, 1e-12, maxsegs=8)), 32)
+
+    def test_bound(self):
+        # densely sampled curves stay within tolerance of the flattened contour, which keeps every node
+        random=Random(50)
+        for k in range(100):
+            nodes=[]
+            for i in range(random.randint(2,8)):
+                (x, z)=(random.uniform(-100,100), random.uniform(-100,100))
+                if random.random()<0.6:
+                    nodes.append([x, z, x+random.uniform(-30,30), z+random.uniform(-30,30)])
+                else:
+                    nodes.append([x, z])
+            for tolerance in [0.125, 0.25, 0.5]:
+                contour=flatten(nodes, tolerance)
+                for node in nodes:
+                    self.assertTrue((round(node[0],6), round(node[1],6)) in contour)
+                worst=max([deviation(curve(nodes, i), contour) for i in range(len(nodes))])
+                self.assertTrue(worst<=tolerance+1e-6, '%s at %s' % (worst, tolerance))
+
+    def test_quadratic(self):
+        # only one end curved - both segments either side of the curved node bend towards it
+        contour=flatten([[0,0], [1,1,2,1], [2,0]], 0.01)
+        self.assertEqual(contour[0], (0,0))
+        self.assertTrue((1,1) in contour and (2,0) in contour)
+        self.assertTrue(len(contour)>4)
+
+
+def curve(nodes, i, samples=200):
+    # samples x 2 points along the curve from node i to the next, evaluated directly
+    (p, q)=(array(nodes[i][:2], float64), array(nodes[(i+1)%len(nodes)][:2], float64))
+    (pc, qc)=(len(nodes[i])>2, len(nodes[(i+1)%len(nodes)])>2)
+    t=array([j/float(samples) for j in range(samples+1)], float64)[:,None]
+    u=1-t
+    if pc and qc:
+        (c1, c2)=(array(nodes[i][2:4]), 2*q-array(nodes[(i+1)%len(nodes)][2:4]))
+        return u*u*u*p + 3*u*u*t*c1 + 3*u*t*t*c2 + t*t*t*q
+    elif pc or qc:
+        c=array(nodes[i][2:4]) if pc else 2*q-array(nodes[(i+1)%len(nodes)][2:4])
+        return u*u*p + 2*u*t*c + t*t*q
+    else:
+        return u*p + t*q
+
+def deviation(points, contour):
+    # furthest distance of any of the points from the closed contour
+    a=array(contour, float64)
+    b=a[range(1,len(a))+[0]]
+    d=b-a
+    l2=(d*d).sum(axis=1)
+    l2[l2==0]=1
+    t=(((points[:,None,:]-a)*d).sum(axis=2)/l2).clip(0,1)	# points x segments
+    nearest=a+t[:,:,None]*d
+    return (((points[:,None,:]-nearest)**2).sum(axis=2).min(axis=1)**0.5).max()
+
+
+class TestInterpolate(unittest.TestCase):
+
+    tris=array([[(0,0), (1,0), (0,1)], [(1,0), (1,1), (0,1)]], float64)
+    uvs=array([[(0,0), (1,0), (0,1)], [(1,0), (1,1), (0,1)]], float64)
+
+    def test_inside(self):
+        xs=array([0.25, 0.75, 0.5, 0, 1], float64)
+        zs=array([0.25, 0.75, 0.5, 0, 1], float64)
+        uv=interpolate(self.tris, self.uvs, xs, zs)
+        self.assertTrue(abs(uv-array([xs, zs]).T).max()<1e-9)
+
+    def test_outside(self):
+        uv=interpolate(self.tris, self.uvs*2+1, array([2, -1, 0.5], float64), array([0.5, 0, 0.25], float64))
+        self.assertTrue(abs(uv-[(0,0), (0,0), (2,1.5)]).max()<1e-9)
+
+    def test_grid(self):
+        xs=array([i/10.0 for i in range(11)]*11, float64)
+        zs=array([i/10.0 for i in range(11) for j in range(11)], float64)
+        uv=interpolate(self.tris, self.uvs, xs, zs)
+        self.assertTrue(abs(uv-array([xs, zs]).T).max()<1e-9)
+        # many small triangles, so that points only see a few of them
+        tris=array([[(x,z), (x+1,z), (x,z+1)] for x in range(50) for z in range(50)]+
+                   [[(x+1,z), (x+1,z+1), (x,z+1)] for x in range(50) for z in range(50)], float64)
+        xs=array([i/7.0 for i in range(-7,358)]*5, float64)
+        zs=array([(i*13)%51-0.5 for i in range(365*5)], float64)
+        uv=interpolate(tris, tris*2, xs, zs)
+        inside=(xs>=0) & (xs<=50) & (zs>=0) & (zs<=50)
+        self.assertTrue(abs(uv[inside]-2*array([xs, zs]).T[inside]).max()<1e-9)
+        self.assertTrue((uv[~inside]==0).all())
+
+    def test_oldcode(self):
+        # matches the point-in-triangle loop that Draped.layout used, on random triangles with random uvs
+        random=Random(45)
+        for k in range(20):
+            tris=array([[(random.uniform(0,100), random.uniform(0,100)) for i in range(3)] for j in range(random.randint(1,40))], float64)
+            uvs=array([[(random.uniform(-1,1), random.uniform(-1,1)) for i in range(3)] for j in range(len(tris))], float64)
+            xs=array([random.uniform(-10,110) for i in range(500)], float64)
+            zs=array([random.uniform(-10,110) for i in range(500)], float64)
+            uv=interpolate(tris, uvs, xs, zs)
+            for i in range(len(xs)):
+                self.assertTrue(abs(uv[i]-oldinterpolate(tris.tolist(), uvs.tolist(), xs[i], zs[i])).max()<1e-9)
+
+    def test_empty(self):
+        self.assertEqual(interpolate(self.tris[:0], self.uvs[:0], array([0.5]), array([0.5])).tolist(), [[0,0]])
+        self.assertEqual(len(interpolate(self.tris, self.uvs, array([]), array([]))), 0)
+
+
+def oldinterpolate(tris, uvs, x, z):
+    # uv at (x,z) from the first triangle containing it, as the loop in Draped.layout used to
+    for t in range(len(tris)):
+        pts=tris[t]
+        inside=False
+        ptj=pts[2]
+        for pti in pts:
+            if z==pti[1]==ptj[1] and x <= max(pti[0],ptj[0]) and x >= min(pti[0],ptj[0]):
+                inside = True	# on the line
+                break
+            elif (((pti[1] <= z and z < ptj[1]) or
+                   (ptj[1] <= z and z < pti[1])) and
+                  (x < (ptj[0]-pti[0]) * (z - pti[1]) / (ptj[1] - pti[1]) + pti[0])):
+                inside = not inside
+            ptj=pti
+        if inside:
+            (x0, z0)=pts[0]
+            (x1, z1)=(pts[1][0]-x0, pts[1][1]-z0)
+            (x2, z2)=(pts[2][0]-x0, pts[2][1]-z0)
+            (xp, zp)=(x-x0, z-z0)
+            a=(xp*z2-x2*zp)/(x1*z2-x2*z1)
+            b=(xp*z1-x1*zp)/(x2*z1-x1*z2)
+            uv=uvs[t]
+            return (uv[0][0]+a*(uv[1][0]-uv[0][0])+b*(uv[2][0]-uv[0][0]),
+                    uv[0][1]+a*(uv[1][1]-uv[0][1])+b*(uv[2][1]-uv[0][1]))
+    return (0, 0)
+
+
+class TestDrape(unittest.TestCase):
+
+    col=[0.375, 0.125]
+
+    def setUp(self):
+        # sloping terrain 0-60 x 0-60 in 10m cells, all triangles facing the same way
+        self.tris=[]
+        for i in range(6):
+            for j in range(6):
+                p=[(x*10.0, self.height(x*10.0, z*10.0), z*10.0) for (x,z) in [(i,j), (i+1,j), (i+1,j+1), (i,j+1)]]
+                self.tris.extend([(p[0], p[1], p[2]), (p[0], p[2], p[3])])
+
+    def height(self, x, z):
+        return 0.1*x+0.2*z+1
+
+    def drape(self, contours, tris=None):
+        [(varray, tarray)]=drapepavements(([[(self.col, contours)]], tris or self.tris))
+        self.assertEqual(len(varray)%3, 0)
+        self.assertEqual(tarray, [self.col]*len(varray))
+        v=array(varray, float64).reshape(-1,3,3)
+        # on the terrain, and facing the same way as it - allowing for rounding in slivers
+        self.assertTrue((abs(v[:,:,1]-self.height(v[:,:,0], v[:,:,2]))<1e-9).all())
+        a=[area2(tri) for tri in v.tolist()]
+        self.assertTrue(all([x*area2(self.tris[0])>-1e-6 for x in a]))
+        return sum(a)/2
+
+    def rect(self, x0, z0, x1, z1):
+        return [(x0,z0), (x1,z0), (x1,z1), (x0,z1)]
+
+    def test_rect(self):
+        self.assertAlmostEqual(self.drape([self.rect(12, 13, 47, 38)]), 875)
+        self.assertAlmostEqual(self.drape([self.rect(10, 10, 20, 20)]), 100)	# on terrain edges
+        self.assertAlmostEqual(self.drape([self.rect(50, 50, 80, 70)]), 100)	# clipped to terrain
+        self.assertEqual(self.drape([self.rect(70, 70, 80, 80)]), 0)
+        self.assertAlmostEqual(self.drape([self.rect(-10, -10, 70, 70)]), 3600)	# wholly covers terrain
+
+    def test_winding(self):
+        self.assertAlmostEqual(self.drape([self.rect(5, 5, 35, 25), self.rect(25, 15, 55, 45)]), 600+900-100)	# union
+        self.assertAlmostEqual(self.drape([self.rect(5, 5, 55, 55), self.rect(15, 15, 45, 45)]), 2500)	# same way round
+        self.assertAlmostEqual(self.drape([self.rect(5, 5, 55, 55), self.rect(15, 15, 45, 45)[::-1]]), 1600)	# hole
+        self.assertAlmostEqual(self.drape([[(10,10), (50,50), (50,10), (10,50)]]), 800)	# bow tie
+
+    def test_curved(self):
+        circle=[(30+23*cos(2*pi*k/50), 30+17*sin(2*pi*k/50)) for k in range(50)]
+        self.assertAlmostEqual(self.drape([circle]), abs(area2(circle))/2)
+        square=[(30+10*cos(0.3+pi*k/2), 30+10*sin(0.3+pi*k/2)) for k in range(4)]
+        self.assertAlmostEqual(self.drape([circle, square]), abs(area2(circle))/2)	# within the ellipse
+        self.assertAlmostEqual(self.drape([circle, square[::-1]]), abs(area2(circle))/2-200)
+
+    def test_empty(self):
+        self.assertEqual(drapepavements(([[], [(self.col, [])]], self.tris)), [([], []), ([], [])])
+        self.assertEqual(self.drape([[(10,10), (20,20)]]), 0)
+
+
+if __name__=='__main__':
+    unittest.main()
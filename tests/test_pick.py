@@ -0,0 +1,110 @@
+import unittest
+
+import tests
+from tests.glcontext import makecurrent
+
+try:
+    import wx
+    havedeps=makecurrent()
+except ImportError:
+    havedeps=False
+
+if havedeps:
+    from OpenGL.GL import *
+    from numpy import arange, ones, zeros
+    from draw import MyGL, pickcolour, pickidents
+
+
+class Size:
+    x=y=100
+
+class Definition:
+    def __init__(self, type): self.type=type
+
+class Square:
+    # stands in for a placement - draws a square (x0,y0)-(x1,y1) in eye space
+    def __init__(self, x0, y0, x1, y1, type=0):
+        self.square=(x0, y0, x1, y1)
+        self.definition=Definition(type)
+    def draw(self, selected, picking):
+        (x0, y0, x1, y1)=self.square
+        glBegin(GL_QUADS)
+        for (x,y) in [(x0,y0), (x1,y0), (x1,y1), (x0,y1)]: glVertex2f(x, y)
+        glEnd()
+
+class Blank:
+    definition=Definition(0)
+    def draw(self, selected, picking): pass
+
+class PickIndex:
+    def __init__(self, items): self.items=items
+
+class VertexCache:
+    def realize(self, canvas): pass
+
+if havedeps:
+    class Canvas(MyGL):
+        # stands in for a realized MyGL with one eye space unit per pixel, looking straight
+        # down so that all placements in its pickindex are candidates
+        def __init__(self, items):
+            self.d=50
+            self.cliprat=1000
+            self.locked=0
+            self.multisample=False
+            self.fbo=True
+            self.pickfbo=0
+            self.pickfbosize=(0,0)
+            self.pickindex=PickIndex(items)
+            self.vertexcache=VertexCache()
+        def GetClientSize(self): return Size()
+        def Refresh(self): pass
+        def pickcandidates(self, rect):
+            n=len(self.pickindex.items)
+            return (arange(n), ones(n, bool), zeros(n, bool))
+
+
+@unittest.skipUnless(havedeps, 'needs wx and an offscreen GL context')
+class TestPick(unittest.TestCase):
+
+    def setUp(self):
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        (self.top, self.under, self.away)=(Square(5,5,15,15), Square(0,0,10,10), Square(40,40,45,45))
+        self.canvas=Canvas([self.top, self.under, self.away])	# in priority order
+
+    def tearDown(self):
+        if self.canvas.pickfbo:
+            glDeleteFramebuffers(1, [self.canvas.pickfbo])
+            glDeleteRenderbuffers(1, [self.canvas.pickrbo])
+
+    def test_encoding(self):
+        for bits in [(8,8,8), (5,6,5), (4,4,4)]:
+            idents=[0, 1, 2, (1<<sum(bits))-1] + [i*37 for i in range(1, (1<<sum(bits))/37)]
+            pixels=[pickcolour(i, bits) for i in idents]
+            self.assertTrue(all(0<=c<256 for p in pixels for c in p))
+            self.assertEqual(list(pickidents(pixels, bits)), sorted(set(idents)))
+
+    def test_box(self):
+        self.assertEqual(self.canvas.newselect((-20, 20, -20, 20)), [self.top, self.under])
+        self.assertEqual(self.canvas.newselect((30, 50, 30, 50)), [self.away])
+        self.assertEqual(self.canvas.newselect((20, 30, 20, 30)), [])
+
+    def test_point(self):
+        # only the topmost placement at each pixel is seen
+        self.assertEqual(self.canvas.newselect((7.5, 12.5, 7.5, 12.5)), [self.top])
+        self.assertEqual(self.canvas.newselect((1, 3, 1, 3)), [self.under])
+
+    def test_locked(self):
+        self.canvas.pickindex.items[0]=Square(5,5,15,15,1)
+        self.canvas.locked=1
+        self.assertEqual(self.canvas.newselect((-20, 20, -20, 20)), [self.under])
+
+    def test_manycandidates(self):
+        # idents above 16 bits survive the round trip through the framebuffer
+        self.canvas.pickindex.items=[self.top]+[Blank()]*70000+[self.under]
+        self.assertEqual(self.canvas.newselect((-20, 20, -20, 20)), [self.top, self.under])
+        self.assertEqual(self.canvas.newselect((1, 3, 1, 3)), [self.under])
+
+
+if __name__=='__main__':
+    unittest.main()
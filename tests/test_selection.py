@@ -0,0 +1,136 @@
+import unittest
+
+import tests
+
+try:
+    import wx
+    havedeps=True
+except ImportError:
+    havedeps=False
+
+if havedeps:
+    from draw import ClickModes, MyGL, Selection
+
+
+class Definition:
+    filename='test.obj'
+    layer=0
+
+class Placement:
+    # compares by identity, like Clutter
+    definition=Definition()
+    def __init__(self, name): self.name=name
+    def __repr__(self): return self.name
+
+class Size:
+    x=y=100
+
+class Frame:
+    def ShowSel(self): pass
+
+if havedeps:
+    class Canvas(MyGL):
+        # stands in for MyGL, with pick() returning whatever is under the box
+        def __init__(self):
+            self.d=50
+            self.options=0
+            self.selected=Selection()
+            self.selectsaved=Selection()
+            self.selections=[]
+            self.selectednode=None
+            self.clickmode=None
+            self.frame=Frame()
+            self.hits=[]
+        def GetClientSize(self): return Size()
+        def Refresh(self): pass
+        def trashlists(self): pass
+        def pick(self, rect): return list(self.hits)
+        def click(self, hits, ctrl):
+            # mouse down, as OnLeftDown
+            (self.hits, self.clickctrl, self.clickmode, self.clickpos, self.mousenow)=(hits, ctrl, ClickModes.Undecided, [10,10], [10,10])
+            self.select()
+        def drag(self, hits):
+            # mouse moved with the button down, as OnMouseMotion
+            self.hits=hits
+            self.mousenow=[60,60]
+            self.select()
+
+
+@unittest.skipUnless(havedeps, 'needs wx')
+class TestSelection(unittest.TestCase):
+
+    def setUp(self):
+        (self.a, self.b, self.c, self.d)=[Placement(name) for name in 'abcd']
+
+    def check(self, selection, expected):
+        self.assertEqual(list(selection), expected)
+        for p in [self.a, self.b, self.c, self.d]:
+            self.assertEqual(p in selection, p in expected)
+
+    def test_order(self):
+        (a,b,c,d)=(self.a, self.b, self.c, self.d)
+        self.check(Selection(), [])
+        self.check(Selection([c,a,c,b]), [c,a,b])	# held once, in order of selection
+        sel=Selection([c,a])
+        sel.append(b)
+        sel.append(c)
+        self.check(sel, [c,a,b])
+        sel.extend([d,a])
+        self.check(sel, [c,a,b,d])
+        sel+=[a,c]
+        self.check(sel, [c,a,b,d])
+
+    def test_toggle(self):
+        (a,b,c,d)=(self.a, self.b, self.c, self.d)
+        sel=Selection([a,b,c])
+        sel.remove(b)
+        self.check(sel, [a,c])
+        sel.append(b)
+        self.check(sel, [a,c,b])
+        sel.insert(0, d)
+        self.check(sel, [d,a,c,b])
+        self.assertEqual(sel.pop(), b)
+        self.check(sel, [d,a,c])
+        self.assertEqual(sel.pop(0), d)
+        self.check(sel, [a,c])
+        del sel[0]
+        self.check(sel, [c])
+        sel.extend([a,b,d])
+        del sel[1:3]
+        self.check(sel, [c,d])
+        self.assertRaises(TypeError, sel.__setitem__, 0, a)
+        self.assertRaises(TypeError, sel.__setslice__, 0, 1, [a])
+        self.check(sel, [c,d])
+
+    def test_ctrldrag(self):
+        (a,b,c,d)=(self.a, self.b, self.c, self.d)
+        canvas=Canvas()
+        canvas.click([a], True)
+        canvas.click([b], True)
+        self.check(canvas.selected, [a,b])
+        # ctrl-drag a box from empty space toggles what's in the box, relative to the selection at the start
+        canvas.click([], True)
+        self.assertEqual(canvas.clickmode, ClickModes.DragBox)
+        saved=canvas.selectsaved
+        self.check(saved, [a,b])
+        canvas.drag([b,c])
+        self.check(canvas.selected, [a,c])
+        canvas.drag([c,d,b])
+        self.check(canvas.selected, [a,c,d])
+        canvas.drag([a])
+        self.check(canvas.selected, [b])
+        canvas.drag([])
+        self.check(canvas.selected, [a,b])
+        self.assertTrue(canvas.selectsaved is saved)
+        self.check(saved, [a,b])
+        # plain click replaces the selection, ctrl-click toggles
+        canvas.click([d], False)
+        self.check(canvas.selected, [d])
+        canvas.click([c], True)
+        self.check(canvas.selected, [d,c])
+        canvas.click([d], True)
+        self.check(canvas.selected, [c])
+
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import unittest
+from os import listdir
+from os.path import exists, join
+from tempfile import mkdtemp
+from shutil import rmtree
+from struct import pack
+from sys import exc_info
+
+import tests
+from tests.glcontext import makecurrent, offscreen
+
+try:
+    import wx
+    import PIL.Image
+    havedeps=makecurrent()
+except ImportError:
+    havedeps=False
+
+if havedeps:
+    from OpenGL.GL import *
+    from numpy import frombuffer, uint8
+    from files import TexCache, DDSD_CAPS, DDSD_HEIGHT, DDSD_WIDTH, DDSD_PIXELFORMAT, DDSD_LINEARSIZE, DDPF_FOURCC, DDPF_RGB
+    from prefs import Prefs
+
+
+@unittest.skipUnless(havedeps, 'needs wx, PIL and an offscreen GL context')
+class TestTexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir=mkdtemp()
+        self.cache=TexCache()
+        self.fbos=[]
+
+    def tearDown(self):
+        self.cache.reset()
+        glDeleteFramebuffers(len(self.fbos), self.fbos)
+        rmtree(self.dir)
+
+    def png(self, name, size, colour):
+        path=join(self.dir, name)
+        PIL.Image.new('RGB', (size,size), colour).save(path)
+        return path
+
+    def dds(self, name, size, colour, fourcc=None, truncate=0):
+        # 24bit RGB, or the header of a compressed format, without mipmaps
+        path=join(self.dir, name)
+        h=open(path, 'wb')
+        flags=DDSD_CAPS|DDSD_HEIGHT|DDSD_WIDTH|DDSD_PIXELFORMAT
+        if fourcc:
+            h.write('DDS '+pack('<7I', 124, flags, size, size, 0, 0, 0)+'\0'*44)
+            h.write(pack('<2I4s5I', 32, DDPF_FOURCC, fourcc, 0, 0, 0, 0, 0))
+        else:
+            h.write('DDS '+pack('<7I', 124, flags|DDSD_LINEARSIZE, size, size, size*size*3, 0, 0)+'\0'*44)
+            h.write(pack('<2I4s5I', 32, DDPF_RGB, '\0'*4, 24, 0x0000ff, 0x00ff00, 0xff0000, 0))
+        h.write(pack('<4I', 0x1000, 0, 0, 0)+'\0'*4)
+        h.write((''.join([chr(c) for c in colour])*size*size)[:size*size*3-truncate])
+        h.close()
+        return path
+
+    def draw(self, id, size, (s0,t0,s1,t1)=(0,0,1,1)):
+        # Returns size x size x 3 colours of the texture drawn to fill size x size pixels
+        self.fbos.append(offscreen(size, size))
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        glOrtho(0, 1, 0, 1, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        glClearColor(0, 0, 0, 0)
+        glClear(GL_COLOR_BUFFER_BIT)
+        glColor3f(1, 1, 1)
+        glEnable(GL_TEXTURE_2D)
+        glTexEnvi(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_REPLACE)
+        glBindTexture(GL_TEXTURE_2D, id)
+        glBegin(GL_QUADS)
+        for (x,y) in [(0,0), (1,0), (1,1), (0,1)]:
+            glTexCoord2f(s0+x*(s1-s0), t0+y*(t1-t0))
+            glVertex2f(x, y)
+        glEnd()
+        glDisable(GL_TEXTURE_2D)
+        glFinish()
+        return frombuffer(glReadPixels(0, 0, size, size, GL_RGBA, GL_UNSIGNED_BYTE), uint8).reshape(size,size,4)[:,:,:3]
+
+    def minified(self, id):
+        # colour of the texture drawn at 4x4 pixels, ie sampled from its mipmaps
+        return tuple(self.draw(id, 4)[1,1])	# away from the edges
+
+    def test_terrain_quality(self):
+        path=self.png('terrain.png', 64, (255,0,0))
+        for (options, width) in [(0, 16), (Prefs.TEXMEDIUM, 32), (Prefs.TEXHIGH, 64)]:
+            self.cache.setquality(options)
+            id=self.cache.get(path, downsample=True)
+            glBindTexture(GL_TEXTURE_2D, id)
+            self.assertEqual(glGetTexLevelParameteriv(GL_TEXTURE_2D, 0, GL_TEXTURE_WIDTH), width)
+            self.assertEqual(self.minified(id), (255,0,0))	# would be white if mipmaps were incomplete
+
+    def test_small_terrain(self):
+        # don't go below 4x4
+        path=self.png('small.png', 8, (0,255,0))
+        self.cache.setquality(0)
+        id=self.cache.get(path, downsample=True)
+        glBindTexture(GL_TEXTURE_2D, id)
+        self.assertEqual(glGetTexLevelParameteriv(GL_TEXTURE_2D, 0, GL_TEXTURE_WIDTH), 4)
+        self.assertEqual(self.minified(id), (0,255,0))
+
+    def test_object(self):
+        path=self.png('object.png', 64, (0,0,255))
+        for options in [0, Prefs.TEXMEDIUM, Prefs.TEXHIGH]:
+            self.cache.setquality(options)
+            id=self.cache.get(path)
+            self.assertEqual(self.minified(id), (0,0,255))
+
+    def test_dds(self):
+        self.assertEqual(self.minified(self.cache.get(self.dds('rgb.dds', 16, (255,0,255)))), (255,0,255))
+        # the file and its mapping are closed on failure, even while the traceback keeps get's frame alive
+        if not exists('/proc/self/fd'): return
+        for path in [self.dds('truncated.dds', 16, (0,0,0), truncate=3), self.dds('dxt2.dds', 16, (0,0,0), 'DXT2')]:
+            fds=len(listdir('/proc/self/fd'))
+            try:
+                self.cache.get(path)
+                self.fail()
+            except IOError:
+                tb=exc_info()[2]
+                self.assertEqual(len(listdir('/proc/self/fd')), fds)
+            del tb
+
+    def test_atlas(self):
+        colours=[(255,0,0), (0,255,0), (0,0,255), (255,255,0)]
+        atlased=[self.cache.getatlas(self.png('atlas%d.png' % i, 16<<(i%2), colours[i])) for i in range(len(colours))]
+        self.assertEqual(len(set([a[0] for a in atlased])), 1)	# all in one page
+        # mipmaps are generated in one go by realize, not as each texture is added
+        glBindTexture(GL_TEXTURE_2D, atlased[0][0])
+        self.assertEqual(glGetTexLevelParameteriv(GL_TEXTURE_2D, 1, GL_TEXTURE_WIDTH), 0)
+        self.cache.realize()
+        glBindTexture(GL_TEXTURE_2D, atlased[0][0])
+        self.assertEqual(glGetTexLevelParameteriv(GL_TEXTURE_2D, self.cache.atlaslevels, GL_TEXTURE_WIDTH), self.cache.atlassize>>self.cache.atlaslevels)
+        self.assertEqual(glGetTexParameteriv(GL_TEXTURE_2D, GL_GENERATE_MIPMAP), GL_FALSE)
+        for (colour, (id, u, v, uscale, vscale)) in zip(colours, atlased):
+            # no bleeding from neighbours when magnified or minified
+            for size in [64, 8, 4]:
+                pixels=self.draw(id, size, (u, v, u+uscale, v+vscale)).reshape(-1,3)
+                self.assertTrue((pixels==colour).all(), '%s at %d: %s' % (colour, size, set(map(tuple, pixels))))
+
+
+if __name__=='__main__':
+    unittest.main()
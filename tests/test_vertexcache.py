@@ -0,0 +1,214 @@
+import unittest
+from time import clock
+
+import tests
+from tests.glcontext import makecurrent
+
+try:
+    import wx
+    havedeps=makecurrent()
+except ImportError:
+    havedeps=False
+
+if havedeps:
+    from OpenGL.GL import *
+    from OpenGL.GL.ARB.vertex_buffer_object import glBindBufferARB, glGetBufferSubDataARB, GL_ARRAY_BUFFER_ARB
+    from math import sin
+    from random import Random
+    from numpy import arange, array, float32
+    from sys import maxint
+    from files import VertexCache
+    from prefs import Prefs
+
+
+class Canvas:
+    # stands in for MyGL - the context is already current
+    context=None
+    def SetCurrent(self, context): pass
+
+
+def geometry(n, start=0):
+    # n distinct vertices and texture coordinates
+    v=arange(start*3, (start+n)*3, dtype=float32).reshape(n,3)
+    return (v, v[:,:2]+0.5)
+
+
+@unittest.skipUnless(havedeps, 'needs wx and an offscreen GL context')
+class TestVertexCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache=VertexCache()
+        self.canvas=Canvas()
+
+    def tearDown(self):
+        self.cache.texcache.reset()
+
+    def test_allocate(self):
+        cache=self.cache
+        capacity=len(cache.arena)
+        self.assertEqual(cache.allocate(*geometry(10)), 0)
+        self.assertEqual(cache.allocate(*geometry(20, 10)), 10)
+        self.assertEqual(cache.allocate([], []), 30)	# empty allocations are allowed
+        self.assertEqual(cache.count, 30)
+        self.assertEqual((cache.dirtylo, cache.dirtyhi), (0, 30))
+        self.assertFalse(cache.valid)
+        (v,t)=geometry(30)
+        self.assertTrue((cache.arena[:30,2:]==v).all() and (cache.arena[:30,:2]==t).all())
+
+        # growth keeps existing contents and capacity is kept across a flush
+        self.assertEqual(cache.allocate(*geometry(capacity, 30)), 30)
+        self.assertEqual(len(cache.arena), 2*capacity)
+        (v,t)=geometry(capacity+30)
+        self.assertTrue((cache.arena[:capacity+30,2:]==v).all() and (cache.arena[:capacity+30,:2]==t).all())
+        cache.flush()
+        self.assertEqual((cache.count, len(cache.arena)), (0, 2*capacity))
+        self.assertEqual((cache.dirtylo, cache.dirtyhi), (maxint, 0))
+
+    def test_update(self):
+        cache=self.cache
+        cache.allocate(*geometry(100))
+        cache.realize(self.canvas)
+        self.assertTrue(cache.valid)
+        self.assertEqual((cache.dirtylo, cache.dirtyhi), (maxint, 0))
+        # dirty range is the union of the changes
+        cache.update(60, *geometry(10, 500))
+        cache.update(20, *geometry(5, 600))
+        self.assertEqual((cache.dirtylo, cache.dirtyhi), (20, 70))
+        self.assertFalse(cache.valid)
+        self.assertRaises(AssertionError, cache.update, 95, *geometry(10))
+
+    def test_vbo(self):
+        cache=self.cache
+        if not cache.vbo: self.skipTest('no VBOs')
+        cache.allocate(*geometry(100))
+        cache.realize(self.canvas)
+        self.assertTrue(cache.vbo)
+        self.assertEqual(cache.bufsize, len(cache.arena))
+        self.assertEqual(cache.lastupload, cache.arena.nbytes)	# whole arena, to leave room
+        # only the changed range is uploaded
+        cache.update(40, *geometry(10, 700))
+        cache.allocate(*geometry(5, 800))
+        cache.realize(self.canvas)
+        self.assertEqual(cache.lastupload, (105-40)*5*4)
+        uploaded=glGetBufferSubDataARB(GL_ARRAY_BUFFER_ARB, 0, 105*5*4).view(float32).reshape(-1,5)
+        self.assertTrue((uploaded==cache.arena[:105]).all())
+        # nothing changed -> nothing uploaded
+        cache.valid=False
+        cache.realize(self.canvas)
+        self.assertEqual(cache.lastupload, 0)
+        # outgrowing the buffer reallocates it
+        cache.allocate(*geometry(len(cache.arena)))
+        cache.realize(self.canvas)
+        self.assertEqual((cache.bufsize, cache.lastupload), (len(cache.arena), cache.arena.nbytes))
+        glBindBufferARB(GL_ARRAY_BUFFER_ARB, 0)
+
+    def test_clientarrays(self):
+        cache=self.cache
+        cache.vbo=False
+        cache.allocate(*geometry(100))
+        cache.realize(self.canvas)
+        self.assertTrue(cache.valid)
+        self.assertEqual(cache.lastupload, 100*5*4)
+        self.assertEqual((cache.dirtylo, cache.dirtyhi), (maxint, 0))
+        self.assertEqual(glGetIntegerv(GL_ARRAY_BUFFER_BINDING), 0)
+
+
+class PatchScan:
+    # the height test that the grid replaced - tests every triangle of each patch whose bbox contains the point
+
+    def __init__(self, patches):
+        self.patches=[]
+        for v in patches:
+            tris=[v[i:i+3] for i in range(0,len(v),3)]
+            xs=[p[0] for p in v]
+            zs=[p[2] for p in v]
+            self.patches.append(((min(xs), max(xs), min(zs), max(zs)), tris))
+        self.lasttri=None
+
+    def height(self, x, z):
+        if self.lasttri:
+            h=self.heighttest([self.lasttri], x, z)
+            if h!=None: return h
+        for ((minx, maxx, minz, maxz), tris) in self.patches:
+            if not (minx<=x<=maxx and minz<=z<=maxz): continue
+            h=self.heighttest(tris, x, z)
+            if h!=None: return h
+        return 0
+
+    def heighttest(self, tris, x, z):
+        for pt in tris:
+            c=False
+            for i in range(3):
+                j=(i+1)%3
+                if ((((pt[i][2] <= z) and (z < pt[j][2])) or
+                     ((pt[j][2] <= z) and (z < pt[i][2]))) and
+                    (x < (pt[j][0]-pt[i][0]) * (z - pt[i][2]) / (pt[j][2] - pt[i][2]) + pt[i][0])):
+                    c = not c
+            if c:
+                self.lasttri=pt
+                a = pt[0][1]*(pt[1][2]-pt[2][2]) + pt[1][1]*(pt[2][2]-pt[0][2]) + pt[2][1]*(pt[0][2]-pt[1][2])
+                b = pt[0][2]*(pt[1][0]-pt[2][0]) + pt[1][2]*(pt[2][0]-pt[0][0]) + pt[2][2]*(pt[0][0]-pt[1][0])
+                c = pt[0][0]*(pt[1][1]-pt[2][1]) + pt[1][0]*(pt[2][1]-pt[0][1]) + pt[2][0]*(pt[0][1]-pt[1][1])
+                d = -pt[0][0]*(pt[1][1]*pt[2][2]-pt[2][1]*pt[1][2]) - pt[1][0]*(pt[2][1]*pt[0][2]-pt[0][1]*pt[2][2]) - pt[2][0]*(pt[0][1]*pt[1][2]-pt[1][1]*pt[0][2])
+                return -(a*x + c*z + d) / b
+        return None
+
+
+@unittest.skipUnless(havedeps, 'needs wx and an offscreen GL context')
+class TestHeight(unittest.TestCase):
+
+    # A tile of 131072 triangles in 8x8 patches, about 110km square like a real tile
+    quads=256
+    patches=8
+    size=110000.0
+
+    def setUp(self):
+        self.cache=VertexCache()
+        step=self.size/self.quads
+        random=Random(31)
+        def vertex(i, j):
+            (x,z)=(i*step-self.size/2, j*step-self.size/2)
+            return [x+(0<i<self.quads and 0.3*step*sin(i*j) or 0), 100*sin(x/5000)+50*sin(z/3000)+random.random(), z]
+        grid=[[vertex(i,j) for j in range(self.quads+1)] for i in range(self.quads+1)]
+        n=self.quads/self.patches
+        self.mesh=[]
+        for pi in range(self.patches):
+            for pj in range(self.patches):
+                v=[]
+                for i in range(pi*n, (pi+1)*n):
+                    for j in range(pj*n, (pj+1)*n):
+                        (a,b,c,d)=(grid[i][j], grid[i+1][j], grid[i+1][j+1], grid[i][j+1])
+                        v.extend([a,b,c, a,c,d])
+                self.mesh.append(v)
+        self.cache.mesh[(0,0,Prefs.TERRAIN)]=[('terrain.png', 1, patch, [[0,0]]*len(patch)) for patch in self.mesh]
+        self.options=Prefs.TERRAIN|Prefs.ELEVATION
+        # scattered across the tile, with some points off it
+        self.points=[(random.uniform(-0.55,0.55)*self.size, random.uniform(-0.55,0.55)*self.size) for k in range(500)]
+
+    def tearDown(self):
+        self.cache.texcache.reset()
+
+    def test_height(self):
+        scan=PatchScan(self.mesh)
+        start=clock()
+        expected=[scan.height(x, z) for (x,z) in self.points]
+        scantime=clock()-start
+
+        self.cache.getMeshdata((0,0), self.options)	# built once per tile, so not timed
+        start=clock()
+        actual=[self.cache.height((0,0), self.options, x, z) for (x,z) in self.points]
+        gridtime=clock()-start
+        start=clock()
+        vectorized=self.cache.heights((0,0), self.options, [x for (x,z) in self.points], [z for (x,z) in self.points])
+        vectortime=clock()-start
+
+        self.assertTrue(len([h for h in expected if h])>400)	# most points are on the tile
+        self.assertTrue(abs(array(actual)-expected).max()<0.01)	# allowing for float32 vertices
+        self.assertTrue(abs(vectorized-expected).max()<0.01)
+        # orders of magnitude faster, but leave plenty of room for a loaded machine
+        self.assertTrue(gridtime*20<scantime, 'grid %.4fs, scan %.4fs' % (gridtime, scantime))
+        self.assertTrue(vectortime*20<scantime, 'heights %.4fs, scan %.4fs' % (vectortime, scantime))
+
+
+if __name__=='__main__':
+    unittest.main()